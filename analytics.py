@@ -0,0 +1,237 @@
+"""Spending analytics, read from the monthly rollups (MonthlySpend).
+
+The rollups are kept current by every expense write, so a report reads a
+few rows per member and month instead of walking the group's expenses.
+`rebuild_rollups` recomputes them from the whole ledger when they need
+checking or repairing (`flask rebuild-rollups`): the ledger is loaded as
+NumPy columns and summed with sorts and reductions rather than a Python
+loop over rows, which keeps it practical on millions of expenses.
+
+Rollups are kept per currency, like the balances; reports add them up in
+one currency, each at its latest rate (see fx.py).
+
+    pip install numpy    # only needed to rebuild
+"""
+from collections import defaultdict
+from datetime import date
+
+from models import db, Expense, ExpenseSplit, MonthlySpend
+import database
+
+DEFAULT_MONTHS = 12
+MAX_MONTHS = 120
+
+# Members listed among the top spenders
+TOP_SPENDERS = 5
+
+# Months averaged for a report's trend line
+TREND_WINDOW = 3
+
+
+def _columns(query):
+    """A query's result as one NumPy array per column, or None if empty"""
+    import numpy as np
+
+    rows = db.session.execute(query).all()
+    if not rows:
+        return None
+    return [np.array(column) for column in zip(*rows)]
+
+
+def _months(timestamps):
+    """Datetimes to whole months since 1970, as int64"""
+    import numpy as np
+
+    return timestamps.astype("datetime64[M]").astype(np.int64)
+
+
+def _sum_by(keys, *values):
+    """Sum each of `values` over the rows of `keys` that are equal.
+
+    `keys` is a 2-D integer array, one row per record. Returns the
+    distinct keys and, for each of `values`, the per-key sums, all in
+    the same order. Sorting and add.reduceat keep the sums exact
+    integers.
+    """
+    import numpy as np
+
+    order = np.lexsort(keys.T[::-1])
+    keys = keys[order]
+    starts = np.flatnonzero(
+        np.r_[True, np.any(keys[1:] != keys[:-1], axis=1)])
+    return keys[starts], [
+        np.add.reduceat(value[order], starts) for value in values]
+
+
+def _codes(currencies):
+    """Currency codes to integers for _sum_by: the distinct codes, and each
+    row's position among them"""
+    import numpy as np
+
+    return np.unique(currencies.astype(str), return_inverse=True)
+
+
+def compute_rollups():
+    """{(group_id, month, user_id, currency): (paid, paid_count, share)}
+    from the ledger, as MonthlySpend should hold it"""
+    import numpy as np
+
+    spending = db.and_(Expense.kind == Expense.EXPENSE,
+                       Expense.group_id.isnot(None),
+                       Expense.amount.isnot(None),
+                       Expense.timestamp.isnot(None))
+    rollups = defaultdict(lambda: [0, 0, 0])
+
+    paid = _columns(
+        db.select(Expense.group_id, Expense.paid_by_id, Expense.amount,
+                  Expense.timestamp, Expense.currency)
+        .where(spending, Expense.paid_by_id.isnot(None)))
+    if paid is not None:
+        group_ids, payer_ids, amounts, timestamps, currencies = paid
+        codes, positions = _codes(currencies)
+        keys = np.column_stack([
+            group_ids.astype(np.int64), _months(timestamps),
+            payer_ids.astype(np.int64), positions.astype(np.int64)])
+        keys, (sums, counts) = _sum_by(
+            keys, amounts.astype(np.int64), np.ones(len(keys), np.int64))
+        for (group_id, month, user_id, code), total, count in zip(
+                keys.tolist(), sums.tolist(), counts.tolist()):
+            key = (group_id, month, user_id, str(codes[code]))
+            rollups[key][:2] = total, count
+
+    shares = _columns(
+        db.select(Expense.group_id, ExpenseSplit.user_id,
+                  ExpenseSplit.amount, Expense.timestamp, Expense.currency)
+        .join(Expense, Expense.id == ExpenseSplit.expense_id)
+        .where(spending))
+    if shares is not None:
+        group_ids, user_ids, amounts, timestamps, currencies = shares
+        codes, positions = _codes(currencies)
+        keys = np.column_stack([
+            group_ids.astype(np.int64), _months(timestamps),
+            user_ids.astype(np.int64), positions.astype(np.int64)])
+        keys, (sums,) = _sum_by(keys, amounts.astype(np.int64))
+        for (group_id, month, user_id, code), total in zip(
+                keys.tolist(), sums.tolist()):
+            rollups[(group_id, month, user_id, str(codes[code]))][2] = total
+
+    # Month numbers back to "YYYY-MM", once per distinct month
+    labels = {}
+    for month in {key[1] for key in rollups}:
+        labels[month] = str(np.datetime64(month, "M"))
+    return {
+        (group_id, labels[month], user_id, code): tuple(values)
+        for (group_id, month, user_id, code), values in rollups.items()
+    }
+
+
+def rebuild_rollups():
+    """Recompute MonthlySpend from the ledger.
+
+    Returns the number of rollup rows and the (group_id, month, user_id,
+    currency) of every one that had drifted.
+    """
+    expected = compute_rollups()
+    stored = {
+        (row.group_id, row.month, row.user_id, row.currency):
+            (row.paid, row.paid_count, row.share)
+        for row in db.session.execute(db.select(
+            MonthlySpend.group_id, MonthlySpend.month, MonthlySpend.user_id,
+            MonthlySpend.currency, MonthlySpend.paid,
+            MonthlySpend.paid_count, MonthlySpend.share))
+    }
+    drifted = [
+        key for key in set(expected) | set(stored)
+        if expected.get(key, (0, 0, 0)) != stored.get(key, (0, 0, 0))
+    ]
+
+    db.session.execute(db.delete(MonthlySpend))
+    if expected:
+        db.session.execute(db.insert(MonthlySpend), [
+            {"group_id": group_id, "month": month, "user_id": user_id,
+             "currency": code, "paid": paid, "paid_count": count,
+             "share": share}
+            for (group_id, month, user_id, code), (paid, count, share)
+            in expected.items()
+        ])
+    db.session.commit()
+    return len(expected), sorted(drifted)
+
+
+def month_range(months, today=None):
+    """The last `months` months, oldest first, as "YYYY-MM" keys"""
+    today = today or date.today()
+    index = today.year * 12 + today.month - 1
+    return [
+        f"{i // 12:04d}-{i % 12 + 1:02d}"
+        for i in range(index - months + 1, index + 1)
+    ]
+
+
+def group_report(group_id, months, rates):
+    """Monthly spending of a group over the last `months` months.
+
+    Totals and a moving-average trend per month, what each member paid
+    and what their share was per month, and the top spenders over the
+    period. Every series lines up with `months`; amounts are minor units
+    of the currency `rates` (an fx.Converter) converts into.
+    """
+    labels = month_range(months)
+    rows = db.session.execute(
+        MonthlySpend.for_group_query(group_id, labels[0]),
+        bind_arguments=database.reads()).all()
+    rates.load({row.currency for row in rows})
+    return report_from_rows(labels, rows, rates)
+
+
+def report_from_rows(labels, rows, rates):
+    """group_report from the rows of MonthlySpend.for_group_query, for
+    callers that run it themselves (see asgi.py); `rates` has their
+    currencies loaded"""
+    position = {month: i for i, month in enumerate(labels)}
+    total = [0] * len(labels)
+    count = [0] * len(labels)
+    members = {}
+
+    for row in rows:
+        i = position.get(row.month)
+        if i is None:
+            continue
+        member = members.setdefault(row.user_id, {
+            "id": row.user_id,
+            "name": row.name,
+            "paid": [0] * len(labels),
+            "share": [0] * len(labels),
+        })
+        paid = rates.convert(row.paid, row.currency)
+        member["paid"][i] += paid
+        member["share"][i] += rates.convert(row.share, row.currency)
+        total[i] += paid
+        count[i] += row.paid_count
+
+    for member in members.values():
+        member["total_paid"] = sum(member["paid"])
+        member["total_share"] = sum(member["share"])
+    top = sorted(members.values(), key=lambda m: m["total_paid"],
+                 reverse=True)
+
+    return {
+        "months": labels,
+        "total": total,
+        "expenses": count,
+        "trend": _moving_average(total, TREND_WINDOW),
+        "members": sorted(members.values(), key=lambda m: m["name"]),
+        "top_spenders": [
+            {"id": m["id"], "name": m["name"], "paid": m["total_paid"]}
+            for m in top[:TOP_SPENDERS] if m["total_paid"] > 0
+        ],
+    }
+
+
+def _moving_average(values, window):
+    """Mean of each value and the ones before it, up to `window` of them"""
+    averages = []
+    for i in range(len(values)):
+        recent = values[max(0, i - window + 1):i + 1]
+        averages.append(round(sum(recent) / len(recent)))
+    return averages
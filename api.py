@@ -0,0 +1,382 @@
+"""Versioned JSON API for the mobile client and internal tools.
+
+Uses the same session login as the web pages. Amounts are integer minor
+units of their currency (cents for USD): expenses and per-currency
+balances as stored, totals converted into the caller's currency, which
+responses name with its number of minor digits. GET responses carry an
+ETag, so a client sending If-None-Match gets an empty 304 when nothing
+changed.
+"""
+from datetime import date
+
+from flask import Blueprint, jsonify, request, session
+
+import analytics
+import database
+import eventlog
+import fx
+import importer
+import matrix
+import search
+from helper import decode_cursor, encode_cursor, minor_digits, page_size
+from models import db, Balance, Group, User
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Most expenses accepted by one POST /expenses call
+MAX_BATCH = 1000
+
+# Most users one search returns
+MAX_SUGGESTIONS = 25
+
+
+def _error(message, status):
+    return jsonify({"error": message}), status
+
+
+@api.before_request
+def require_login():
+    if "user_id" not in session:
+        return _error("Authentication required.", 401)
+
+
+@api.after_request
+def add_etag(response):
+    if request.method == "GET" and response.status_code == 200:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def _currency(rates):
+    """Names the currency converted amounts are in"""
+    return {"currency": rates.target,
+            "minor_digits": minor_digits(rates.target)}
+
+
+def balances_response(entries, rates):
+    """The /me/balances body for Balance.entries, converted by `rates`"""
+    groups, friends = [], []
+    totals = rates.totals(entry["balances"] for entry in entries)
+    for entry, balance in zip(entries, totals):
+        if entry["is_friend_group"]:
+            friends.append({
+                "group_id": entry["group_id"],
+                "friend_id": entry["friend_id"],
+                "name": entry["friend_name"],
+                "balance": balance,
+                "balances": entry["balances"],
+            })
+        else:
+            groups.append({
+                "group_id": entry["group_id"],
+                "name": entry["name"],
+                "balance": balance,
+                "balances": entry["balances"],
+            })
+
+    return {
+        **_currency(rates),
+        "net_balance": sum(totals),
+        "groups": groups,
+        "friends": friends,
+    }
+
+
+@api.route("/me/balances")
+def my_balances():
+    """Balance in every group and with every friend, from one query.
+
+    `balance` is converted into the caller's currency; `balances` is
+    what it is made of, per currency.
+    """
+    return jsonify(balances_response(
+        Balance.overview(session["user_id"]), fx.converter()))
+
+
+@api.route("/groups/<int:group_id>/expenses")
+def group_expenses(group_id):
+    """One page of a group's expenses, newest first"""
+    group = db.session.get(Group, group_id)
+    if group is None or not group.user_is_member(session["user_id"]):
+        return _error("Group not found.", 404)
+
+    limit = page_size(request.args.get("limit", type=int))
+    before = decode_cursor(request.args.get("before"))
+
+    # Fetch one extra row to know whether an older page exists
+    expenses = group.get_group_expenses(before=before, limit=limit + 1)
+    next_cursor = None
+    if len(expenses) > limit:
+        expenses = expenses[:limit]
+        next_cursor = encode_cursor(expenses[-1].timestamp, expenses[-1].id)
+
+    return jsonify({
+        "expenses": [
+            {
+                "id": expense.id,
+                "description": expense.description,
+                "amount": expense.amount,
+                "currency": expense.currency,
+                "kind": expense.kind,
+                "paid_by": expense.payer.username if expense.payer else None,
+                "timestamp": expense.timestamp.isoformat(),
+                "splits": {
+                    split.user.username: split.amount
+                    for split in expense.splits
+                },
+            }
+            for expense in expenses
+        ],
+        "next_cursor": next_cursor,
+    })
+
+
+@api.route("/expenses/search")
+def search_expenses():
+    """Expenses in the caller's groups whose description matches q.
+
+    Ranked best match first (newest first without q), one `page` at a
+    time; filters are group_id, payer (username), currency, min_amount and
+    max_amount (major units of `currency`, by default the caller's) and
+    since and until (YYYY-MM-DD, inclusive).
+    """
+    try:
+        filters = search.parse_filters(request.args)
+    except ValueError as error:
+        return _error(str(error), 400)
+    page = request.args.get("page", 1, type=int)
+    limit = page_size(request.args.get("limit", type=int), default=20,
+                      maximum=search.MAX_RESULTS)
+
+    expenses, more = search.search_expenses(
+        session["user_id"], request.args.get("q", ""), page=page,
+        limit=limit, **filters)
+    return jsonify(search_response(expenses, page, more))
+
+
+def search_response(expenses, page, more):
+    """The /expenses/search body for one page of results"""
+    return {
+        "expenses": [
+            {
+                "id": expense.id,
+                "group_id": expense.group_id,
+                "description": expense.description,
+                "amount": expense.amount,
+                "currency": expense.currency,
+                "kind": expense.kind,
+                "paid_by": expense.payer.username if expense.payer else None,
+                "timestamp": expense.timestamp.isoformat(),
+            }
+            for expense in expenses
+        ],
+        "next_page": page + 1 if more else None,
+    }
+
+
+@api.route("/users/search")
+def search_users():
+    """Typeahead: users whose username or a word of the name starts with q.
+
+    Leaves out the caller and, given `group_id`, that group's members.
+    """
+    user_id = session["user_id"]
+    group_id = request.args.get("group_id", type=int)
+    if group_id is not None:
+        group = db.session.get(Group, group_id)
+        if group is None or not group.user_is_member(user_id):
+            return _error("Group not found.", 404)
+
+    limit = page_size(request.args.get("limit", type=int),
+                      default=10, maximum=MAX_SUGGESTIONS)
+    users = User.search(request.args.get("q", ""), limit,
+                        exclude_user_id=user_id, exclude_group_id=group_id)
+    return jsonify(users_response(users))
+
+
+def users_response(users):
+    return {
+        "users": [
+            {"id": user.id, "username": user.username, "name": user.name}
+            for user in users
+        ],
+    }
+
+
+@api.route("/groups/<int:group_id>/balances")
+def group_balances(group_id):
+    """Net debt between every pair of members: who owes whom how much.
+
+    `debts` are converted into the caller's currency; `by_currency` are
+    the debts in each currency of the ledger, as settling up pays them.
+    `simplified` are `debts` with circular ones (A owes B, B owes C, C
+    owes A) cancelled: fewer debts, and everyone's balance the same.
+    """
+    group = db.session.get(Group, group_id)
+    if group is None or not group.user_is_member(session["user_id"]):
+        return _error("Group not found.", 404)
+    group_matrix = matrix.for_group(group)
+    rates = fx.converter().load(group_matrix.currencies())
+    return jsonify(matrix_response(group_matrix, rates))
+
+
+def matrix_response(group_matrix, rates):
+    """The /groups/<id>/balances body for a group's BalanceMatrix;
+    `rates` has its currencies loaded"""
+    converted = group_matrix.converted(rates)
+    return {
+        **_currency(rates),
+        **converted.to_dict(),
+        "simplified": converted.simplified().to_dict()["debts"],
+        "by_currency": group_matrix.to_dict()["debts"],
+    }
+
+
+@api.route("/groups/<int:group_id>/events")
+def group_events(group_id):
+    """One page of a group's expense events, newest first"""
+    group = db.session.get(Group, group_id)
+    if group is None or not group.user_is_member(session["user_id"]):
+        return _error("Group not found.", 404)
+
+    limit = page_size(request.args.get("limit", type=int))
+    before = request.args.get("before", type=int)
+
+    # Fetch one extra row to know whether an older page exists
+    events = db.session.scalars(
+        eventlog.events_query(group.id, before=before, limit=limit + 1),
+        bind_arguments=database.reads()).all()
+    return jsonify(events_response(events, limit))
+
+
+def events_response(events, limit):
+    """The /groups/<id>/events body for up to `limit` + 1 events, the
+    extra one only telling that an older page exists"""
+    next_cursor = None
+    if len(events) > limit:
+        events = events[:limit]
+        next_cursor = events[-1].id
+
+    return {
+        "events": [eventlog.to_dict(event) for event in events],
+        "next_cursor": next_cursor,
+    }
+
+
+@api.route("/groups/<int:group_id>/balances-as-of")
+def group_balances_as_of(group_id):
+    """Every member's balance at the end of `date` (YYYY-MM-DD), as
+    recorded by then: an expense counts from the day it was entered,
+    edited or deleted, not the date it carries, so back-dated expenses
+    don't change past days.
+
+    `balance` is converted into the caller's currency at that day's
+    rates; `balances` is what it is made of, per currency. Days before
+    the caller's currency has a rate are not found.
+    """
+    group = db.session.get(Group, group_id)
+    if group is None or not group.user_is_member(session["user_id"]):
+        return _error("Group not found.", 404)
+    try:
+        day = date.fromisoformat(request.args.get("date", ""))
+    except ValueError:
+        return _error("date must be YYYY-MM-DD.", 400)
+
+    try:
+        balances = eventlog.balances_as_of(group.id, day)
+    except LookupError as error:
+        return _error(str(error), 404)
+
+    by_member = eventlog.by_member(balances)
+    names = dict(db.session.execute(
+        eventlog.names_query(list(by_member))).all())
+    rates = fx.Converter(fx.viewer_currency(), day)
+    try:
+        return jsonify(as_of_response(day, by_member, names, rates))
+    except fx.MissingRate as error:
+        return _error(str(error), 404)
+
+
+def as_of_response(day, by_member, names, rates):
+    """The /groups/<id>/balances-as-of body for eventlog.by_member's
+    balances; `rates` are of `day`"""
+    members = sorted(by_member.items())
+    totals = rates.totals(amounts for _, amounts in members)
+    return {
+        **_currency(rates),
+        "date": day.isoformat(),
+        "balances": [
+            {"user_id": user_id, "name": names.get(user_id, ""),
+             "balance": total, "balances": amounts}
+            for (user_id, amounts), total in zip(members, totals)
+        ],
+    }
+
+
+@api.route("/groups/<int:group_id>/analytics")
+def group_analytics(group_id):
+    """Monthly spending of a group over the last `months` months"""
+    group = db.session.get(Group, group_id)
+    if group is None or not group.user_is_member(session["user_id"]):
+        return _error("Group not found.", 404)
+
+    months = page_size(request.args.get("months", type=int),
+                       default=analytics.DEFAULT_MONTHS,
+                       maximum=analytics.MAX_MONTHS)
+    rates = fx.converter()
+    return jsonify(analytics_response(
+        analytics.group_report(group.id, months, rates), rates))
+
+
+def analytics_response(report, rates):
+    return {**_currency(rates), **report}
+
+
+@api.route("/expenses", methods=["POST"])
+def create_expenses():
+    """Create many expenses, possibly across groups, in one call.
+
+    Expects {"expenses": [...]} where each item has `group_id`,
+    `description`, `amount` (a decimal string or number in major units,
+    like the web form), `paid_by` (username) and optionally `currency`,
+    `splits` ({username: amount}) and `date`. Invalid items are reported
+    by index and skipped; the rest are created.
+    """
+    payload = request.get_json(silent=True) or {}
+    items = payload.get("expenses")
+    if not isinstance(items, list) or not items:
+        return _error("Expected a list of expenses.", 400)
+    if len(items) > MAX_BATCH:
+        return _error(f"At most {MAX_BATCH} expenses per call.", 400)
+
+    by_group = {}
+    for index, item in enumerate(items):
+        group_id = item.get("group_id") if isinstance(item, dict) else None
+        if not isinstance(group_id, int):
+            group_id = None
+        by_group.setdefault(group_id, []).append((index, item))
+
+    user_id = session["user_id"]
+    groups = {
+        group.id: group
+        for group in Group.query.filter(Group.id.in_(by_group.keys() - {None}))
+    }
+
+    created, errors = [], []
+    for group_id, records in by_group.items():
+        group = groups.get(group_id)
+        if group is None or not group.user_is_member(user_id):
+            errors.extend(
+                {"index": index, "error": "Group not found."}
+                for index, _ in records)
+            continue
+        result = importer.import_expenses(group, records, user_id=user_id)
+        created.extend(result.expense_ids)
+        errors.extend(
+            {"index": index, "error": message}
+            for index, message in result.errors)
+
+    errors.sort(key=lambda error: error["index"])
+    status = 201 if created else 400
+    return jsonify({"created": created, "errors": errors}), status
@@ -1,32 +1,64 @@
 from flask import Flask, render_template, redirect, url_for, flash
-from flask import request, session
+from flask import request, session, stream_template
+from flask import Response, stream_with_context, send_file, abort, jsonify
+from flask_migrate import Migrate, upgrade
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_session import Session
+from sqlalchemy.exc import IntegrityError
+import click
 
 from models import db, User, Group, GroupMember, Expense, ExpenseSplit
+from models import Balance, ExpenseEvent, Friendship, MonthlySpend
 from helper import login_required, currency
+from helper import minor_digits, to_minor, to_major
+from helper import encode_cursor, decode_cursor, page_size
+from api import api
+import analytics
+import database
+import eventlog
+import exporter
+import fragments
+import fx
+import importer
+import jobs
+import matrix
+import metrics
+import queryplan
+import search
+import sessions
+import tasks
+from summary import UserSummary
 import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = \
-    f"sqlite:///{os.path.join(basedir, 'money_split.db')}"
+database.configure(
+    app, f"sqlite:///{os.path.join(basedir, 'money_split.db')}")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.secret_key = 'your_secret_key'  # Secret key for sessions
+# Signs the session cookie; see sessions.py
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY")
 app.config["SESSION_PERMANENT"] = False
 app.config['DEFAULT_CURRENCY'] = 'USD'
-app.jinja_env.globals.update(currency=currency)
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+app.jinja_env.globals.update(
+    currency=currency, minor_digits=minor_digits, to_major=to_major)
 
-db.init_app(app)
+
+@app.context_processor
+def inject_viewer_currency():
+    """The currency converted amounts are shown in"""
+    return {"viewer_currency": fx.viewer_currency()}
 
 
-# Function to execute raw SQL queries
-def execute_query(query, params=()):
-    with db.engine.connect() as connection:
-        return connection.execute(query, params)
+db.init_app(app)
+Migrate(app, db, render_as_batch=True,
+        include_object=search.include_object)
+database.init_app(app)
+fx.init_app(app)
+sessions.init_app(app)
+metrics.init_app(app)
+fragments.init_app(app)
+jobs.init_app(app)
+app.register_blueprint(api)
 
 
 @app.route('/')
@@ -38,24 +70,20 @@ def index():
         return redirect("/login")
 
     user_id = session.get("user_id")
-    user = User.query.get(user_id)
+    user = db.session.get(User, user_id)
     if user is None:
         flash("User not found. Please log in again.", "danger")
         return redirect("/logout")
 
-    net_balance = user.balance()
-    friend_groups = [
-        g for g in user.groups if g.is_friend_group and len(g.users) == 2
-    ]
-    num_friends = len(friend_groups)
-    num_groups = len([g for g in user.groups if not g.is_friend_group])
-    total_spent = sum(exp.amount for exp in user.expenses_paid)
+    summary = UserSummary.for_user(user_id)
+    net_balance, total_spent = fx.converter().totals(
+        [summary.net_balance, summary.total_spent])
 
     return render_template(
         "index.html",
         net_balance=net_balance,
-        num_groups=num_groups,
-        num_friends=num_friends,
+        num_groups=summary.num_groups,
+        num_friends=summary.num_friends,
         total_spent=total_spent
     )
 
@@ -64,16 +92,17 @@ def index():
 @login_required
 def groups_page():
     user_id = session.get("user_id")
-    user = User.query.get(user_id)
 
-    groups = [g for g in user.groups if not g.is_friend_group]
+    groups = db.session.scalars(Group.of_user_query(user_id)).all()
+    balances = Balance.for_user(user_id)
+    totals = fx.converter().totals(balances.get(g.id, {}) for g in groups)
     entries = [
         {
             "id": g.id,
             "name": g.name,
-            "balance": g.get_user_balance(user_id)
+            "balance": balance
         }
-        for g in groups
+        for g, balance in zip(groups, totals)
     ]
 
     return render_template(
@@ -93,20 +122,19 @@ def groups_page():
 @login_required
 def friends_page():
     user_id = session.get("user_id")
-    user = User.query.get(user_id)
 
-    friend_groups = [
-        g for g in user.groups if g.is_friend_group and len(g.users) == 2
-    ]
-
-    entries = []
-    for group in friend_groups:
-        friend = next(u for u in group.users if u.id != user_id)
-        entries.append({
-            "id": group.id,
+    balances = Balance.for_user(user_id)
+    friends = Friendship.for_user(user_id)
+    totals = fx.converter().totals(
+        balances.get(group_id, {}) for group_id, _ in friends)
+    entries = [
+        {
+            "id": group_id,
             "name": friend.name,
-            "balance": group.get_user_balance(user_id)
-        })
+            "balance": balance
+        }
+        for (group_id, friend), balance in zip(friends, totals)
+    ]
 
     return render_template(
         "entities_list.html",
@@ -170,6 +198,7 @@ def login():
         if user and check_password_hash(user.password, password):
             session["user_id"] = user.id
             session["name"] = user.name
+            session["currency"] = user.currency
             flash("Login successful!", "success")
             return redirect("/")
         else:
@@ -223,7 +252,25 @@ def profile():
         flash("Password updated successfully.", "success")
         return redirect("/")
 
-    return render_template("profile.html", user=user)
+    return render_template(
+        "profile.html", user=user, currencies=fx.currencies())
+
+
+@app.route("/profile/currency", methods=["POST"])
+@login_required
+def set_currency():
+    """Change the currency balances are shown in"""
+    user = db.session.get(User, session["user_id"])
+    code = request.form.get("currency", "").upper()
+    if code not in fx.currencies():
+        flash("There are no exchange rates for that currency.", "danger")
+        return redirect(url_for("profile"))
+
+    user.currency = code
+    db.session.commit()
+    session["currency"] = code
+    flash(f"Balances are now shown in {code}.", "success")
+    return redirect(url_for("profile"))
 
 
 @app.route('/create_group', methods=['GET', 'POST'])
@@ -300,47 +347,43 @@ def create_friend():
             return redirect('/create_friend')
 
         # Check if a friend group already exists between the two users
-        existing_friend_group = (
-            db.session.query(Group)
-            .join(Group.users)
-            .filter(Group.is_friend_group)
-            .filter(Group.users.any(id=current_user_id))
-            .filter(Group.users.any(id=friend.id))
-            .first()
-        )
-
-        if existing_friend_group:
+        if Friendship.between(current_user_id, friend.id):
             flash("You're already friends with this user.", "info")
             return redirect('/friends')
 
-        # Create a new friend group
+        # Create a new friend group with both users, indexed by the pair
         new_friend_group = Group(name=None, is_friend_group=True)
         db.session.add(new_friend_group)
-        db.session.commit()
+        db.session.flush()
 
-        # Add both users to the group
+        low_id, high_id = Friendship.pair(current_user_id, friend.id)
         db.session.add_all([
             GroupMember(user_id=current_user_id, group_id=new_friend_group.id),
-            GroupMember(user_id=friend.id, group_id=new_friend_group.id)
+            GroupMember(user_id=friend.id, group_id=new_friend_group.id),
+            Friendship(min_user_id=low_id, max_user_id=high_id,
+                       group_id=new_friend_group.id)
         ])
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Lost a race with the same pair being added concurrently
+            db.session.rollback()
+            flash("You're already friends with this user.", "info")
+            return redirect('/friends')
 
         flash(f"You are now friends with {friend.name}!", "success")
         return redirect('/friends')
 
-    # For GET request: get all users except current one
-    current_user_id = session.get("user_id")
-    all_users = User.query.filter(User.id != current_user_id).all()
-
+    # Users are looked up as you type (see api.search_users), not listed
     return render_template(
         "create_entity.html",
         title="Add Friend",
         header="Add a New Friend",
-        label="Select a Friend",
+        label="Find a Friend",
         field_name="friend_id",
         button_text="Add Friend",
         cancel_url="/friends",
-        users=all_users
+        search_url=url_for("api.search_users"),
     )
 
 
@@ -349,26 +392,56 @@ def create_friend():
 def invite_friends(group_id):
     """Invite friends to a group"""
     group = Group.query.get_or_404(group_id)
-
-    # Get current members (so they aren't re-added)
-    current_members_ids = [member.id for member in group.users]
-
-    # Get all users except current members
-    users = User.query.filter(User.id.notin_(current_members_ids)).all()
+    if not group.user_is_member(session.get("user_id")):
+        flash("You do not have access to this group.", "danger")
+        return redirect("/groups")
 
     if request.method == 'POST':
-        selected_user_ids = request.form.getlist('user_ids')
-
-        for user_id in selected_user_ids:
-            new_member = GroupMember(user_id=int(user_id), group_id=group.id)
-            db.session.add(new_member)
-
+        try:
+            selected_user_ids = [
+                int(user_id) for user_id in request.form.getlist('user_ids')]
+        except ValueError:
+            selected_user_ids = []
+        if not selected_user_ids:
+            flash("Please choose someone to invite.", "danger")
+            return redirect(url_for("invite_friends", group_id=group.id))
+
+        Group.bump_version(group.id)
+        # One INSERT ... SELECT; current members and unknown ids are skipped
+        invited = GroupMember.add_many(group.id, selected_user_ids)
         db.session.commit()
-        flash("Friends successfully invited!", "success")
+        if invited:
+            flash("Friends successfully invited!", "success")
+        else:
+            flash("They are already in the group.", "info")
         return redirect("/groups")
 
     return render_template(
-        'invite_friends.html', group=group, users=users, members=group.users)
+        'invite_friends.html', group=group, members=group.users,
+        search_url=url_for("api.search_users", group_id=group.id))
+
+
+def _expense_list(group):
+    """Current page of a group's expenses, rendered or from the cache"""
+    def render():
+        limit = page_size(request.args.get("limit", type=int))
+        before = decode_cursor(request.args.get("before"))
+
+        # Fetch one extra row to know whether an older page exists
+        expenses = group.get_group_expenses(before=before, limit=limit + 1)
+        next_cursor = None
+        if len(expenses) > limit:
+            expenses = expenses[:limit]
+            last = expenses[-1]
+            next_cursor = encode_cursor(last.timestamp, last.id)
+        return render_template(
+            "expense_list.html",
+            group=group,
+            expenses=expenses,
+            next_cursor=next_cursor
+        )
+
+    return fragments.cached(group, render)
 
 
 @app.route('/group/<int:group_id>')
@@ -383,11 +456,44 @@ def group_page(group_id):
         flash("You do not have access to this group.", "danger")
         return redirect("/groups")
 
-    expenses = group.get_group_expenses()
-    balance = group.get_user_balance(current_user_id)
+    def render():
+        group_matrix = matrix.for_group(group)
+        balances = group.get_user_balances(current_user_id)
+        # Every rate the page needs, in one go
+        rates = fx.converter().load({*balances, *group_matrix.currencies()})
+        debts = group_matrix.converted(rates)
+        return render_template(
+            "group.html",
+            group=group,
+            expense_list=_expense_list(group),
+            balance=rates.total(balances),
+            matrix=debts,
+            simplified=debts.simplified()
+        )
+
+    return fragments.conditional_page(group, render)
 
+
+@app.route('/group/<int:group_id>/analytics')
+@login_required
+def group_analytics(group_id):
+    """Monthly spending charts for a group, from the rollups"""
+    group = Group.query.get_or_404(group_id)
+    if not group.user_is_member(session.get("user_id")):
+        flash("You do not have access to this group.", "danger")
+        return redirect("/groups")
+
+    months = page_size(request.args.get("months", type=int),
+                       default=analytics.DEFAULT_MONTHS,
+                       maximum=analytics.MAX_MONTHS)
+    rates = fx.converter()
     return render_template(
-        "group.html", group=group, expenses=expenses, balance=balance)
+        "analytics.html",
+        group=group,
+        report=analytics.group_report(group.id, months, rates),
+        digits=minor_digits(rates.target),
+        trend_window=analytics.TREND_WINDOW,
+    )
 
 
 @app.route('/friend/<int:group_id>')
@@ -401,17 +507,17 @@ def friend_page(group_id):
         flash("You do not have access to this friend view.", "danger")
         return redirect("/friends")
 
-    expenses = group.get_group_expenses()
-    balance = group.get_user_balance(current_user_id)
     friend = next(user for user in group.users if user.id != current_user_id)
 
-    return render_template(
+    # The one cell of the pair's matrix
+    return fragments.conditional_page(group, lambda: render_template(
         "friend.html",
         group=group,
         friend=friend,
-        expenses=expenses,
-        balance=balance
-    )
+        expense_list=_expense_list(group),
+        balance=fx.converter().total(
+            matrix.for_group(group).between(current_user_id, friend.id))
+    ))
 
 
 @app.route("/group/<int:group_id>/add_expense", methods=["GET", "POST"])
@@ -421,18 +527,24 @@ def add_group_expense(group_id):
     users = group.users
 
     if request.method == "POST":
+        code = request.form.get("currency", fx.viewer_currency()).upper()
+        if code not in fx.currencies():
+            flash("There are no exchange rates for that currency.", "danger")
+            return redirect(request.url)
         try:
             description = request.form["description"]
-            amount = round(float(request.form["amount"]), 2)
+            amount = to_minor(request.form["amount"], code)
             payer_id = int(request.form["paid_by"])
         except (KeyError, ValueError):
             flash("Invalid input for expense fields.", "danger")
             return redirect(request.url)
 
+        Group.bump_version(group_id)
         # Create Expense record
         expense = Expense(
             description=description,
             amount=amount,
+            currency=code,
             paid_by_id=payer_id,
             group_id=group_id,
         )
@@ -441,11 +553,18 @@ def add_group_expense(group_id):
 
         total_split = expense.add_splits_from_form(request.form, users)
 
-        if round(total_split, 2) != amount:
+        if total_split != amount:
             db.session.rollback()
             flash("Split amounts must add up to the total expense.", "danger")
             return redirect(request.url)
 
+        splits = expense.split_amounts()
+        deltas = expense.balance_deltas(splits)
+        Balance.apply(group.id, deltas)
+        MonthlySpend.apply(group.id, expense.spend_deltas(splits))
+        ExpenseEvent.record(group.id, [ExpenseEvent.change(
+            ExpenseEvent.CREATED, expense, splits, deltas)],
+            user_id=session.get("user_id"))
         db.session.commit()
         flash("Expense added successfully!", "success")
         # Redirect based on group type
@@ -453,7 +572,170 @@ def add_group_expense(group_id):
             return redirect(url_for("friend_page", group_id=group.id))
         return redirect(url_for("group_page", group_id=group.id))
 
-    return render_template("add_expense.html", group=group, users=users)
+    return render_template(
+        "add_expense.html", group=group, users=users,
+        currencies=fx.currencies(), selected_currency=fx.viewer_currency())
+
+
+@app.route("/group/<int:group_id>/settle", methods=["GET", "POST"])
+@login_required
+def settle_group(group_id):
+    """Show and record the fewest transfers that settle a group"""
+    group = Group.query.get_or_404(group_id)
+    current_user_id = session.get("user_id")
+
+    if not group.user_is_member(current_user_id):
+        flash("You do not have access to this group.", "danger")
+        return redirect("/groups")
+
+    back_url = url_for(
+        "friend_page" if group.is_friend_group else "group_page",
+        group_id=group.id)
+
+    if request.method == "POST":
+        job = jobs.enqueue(
+            "settle_group", owner_id=current_user_id, group_id=group.id)
+        return redirect(url_for("job_status", job_id=job.id))
+
+    plan = group.settlement_plan()
+
+    user_ids = {uid for debtor, creditor, _, _ in plan
+                for uid in (debtor, creditor)}
+    names = {
+        user.id: user.name
+        for user in User.query.filter(User.id.in_(user_ids))
+    }
+    transfers = [
+        {
+            "from_name": names[debtor],
+            "to_name": names[creditor],
+            "amount": amount,
+            "currency": code
+        }
+        for debtor, creditor, amount, code in plan
+    ]
+
+    return render_template(
+        "settle.html", group=group, transfers=transfers, back_url=back_url)
+
+
+@app.route("/group/<int:group_id>/import", methods=["GET", "POST"])
+@login_required
+def import_group_expenses(group_id):
+    """Bulk import expenses into a group from a CSV or JSON Lines file"""
+    group = Group.query.get_or_404(group_id)
+
+    if not group.user_is_member(session.get("user_id")):
+        flash("You do not have access to this group.", "danger")
+        return redirect("/groups")
+
+    if request.method == "POST":
+        upload = request.files.get("file")
+        if not upload or not upload.filename:
+            flash("Please choose a file to import.", "danger")
+            return redirect(request.url)
+
+        extension = upload.filename.rsplit(".", 1)[-1].lower()
+        if extension not in importer.READERS:
+            flash("Only .csv, .jsonl and .json files can be imported.",
+                  "danger")
+            return redirect(request.url)
+
+        filename = f"upload.{extension}"
+        job = jobs.enqueue(
+            "import_expenses", owner_id=session.get("user_id"),
+            files={filename: upload}, group_id=group.id, filename=filename)
+        return redirect(url_for("job_status", job_id=job.id))
+
+    return render_template("import_expenses.html", group=group)
+
+
+@app.route("/group/<int:group_id>/export.<any(csv, json):fmt>",
+           methods=["GET", "POST"])
+@login_required
+def export_group(group_id, fmt):
+    """Download a group's full ledger as CSV or JSON.
+
+    GET streams it; POST writes it to a file in the background instead.
+    """
+    group = Group.query.get_or_404(group_id)
+
+    if not group.user_is_member(session.get("user_id")):
+        flash("You do not have access to this group.", "danger")
+        return redirect("/groups")
+
+    if request.method == "POST":
+        job = jobs.enqueue(
+            "export_group", owner_id=session.get("user_id"),
+            group_id=group.id, fmt=fmt)
+        return redirect(url_for("job_status", job_id=job.id))
+
+    if fmt == "csv":
+        body, mimetype = exporter.group_csv(group.id), "text/csv"
+    else:
+        body, mimetype = exporter.group_json(group.id), "application/json"
+    return _download(body, mimetype, f"group-{group.id}.{fmt}")
+
+
+@app.route("/history/export.csv", methods=["GET", "POST"])
+@login_required
+def export_history():
+    """Download the user's full activity as CSV, now or in the background"""
+    user_id = session.get("user_id")
+    if request.method == "POST":
+        job = jobs.enqueue("export_history", owner_id=user_id, user_id=user_id)
+        return redirect(url_for("job_status", job_id=job.id))
+
+    body = exporter.history_csv(user_id)
+    return _download(body, "text/csv", "history.csv")
+
+
+def _download(body, mimetype, filename):
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+def _own_job(job_id):
+    job = db.session.get(jobs.Job, job_id)
+    if job is None or job.user_id != session.get("user_id"):
+        abort(404)
+    return job
+
+
+@app.route("/jobs/<int:job_id>")
+@login_required
+def job_status(job_id):
+    """Progress and outcome of a background job, as a page or JSON"""
+    job = _own_job(job_id)
+    wants_json = request.accept_mimetypes.best_match(
+        ["text/html", "application/json"]) == "application/json"
+    if wants_json:
+        return jsonify(job.to_dict())
+
+    status = job.to_dict()
+    group = None
+    group_id = (status["result"] or {}).get("group_id")
+    if group_id is not None:
+        group = db.session.get(Group, group_id)
+    return render_template("job.html", job=status, group=group)
+
+
+@app.route("/jobs/<int:job_id>/download")
+@login_required
+def job_download(job_id):
+    """The file a finished export job wrote"""
+    job = _own_job(job_id)
+    result = job.to_dict()["result"] or {}
+    if "file" not in result:
+        abort(404)
+    return send_file(
+        jobs.job_path(job.id, result["file"]),
+        mimetype=result["mimetype"],
+        as_attachment=True,
+        download_name=result["file"])
 
 
 @app.route("/history")
@@ -461,48 +743,55 @@ def add_group_expense(group_id):
 def activity():
     """View all transactions (both paid and owed)"""
     user_id = session.get("user_id")
+    limit = page_size(request.args.get("limit", type=int))
+    before = decode_cursor(request.args.get("before"))
+
+    # Fetch one extra row to know whether an older page exists
+    rows = db.session.execute(
+        ExpenseSplit.activity_page_query(user_id, before, limit + 1),
+        bind_arguments=database.reads()).all()
+    transactions = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = transactions[-1]
+        next_cursor = encode_cursor(last.timestamp, last.split_id)
+
+    return stream_template(
+        "activity.html",
+        transactions=transactions,
+        next_cursor=next_cursor,
+        limit=limit
+    )
+
+
+@app.route("/search")
+@login_required
+def search_page():
+    """Find expenses, in any of the user's groups, by description"""
+    user_id = session.get("user_id")
+    text = request.args.get("q", "").strip()
+    page = request.args.get("page", 1, type=int)
+    limit = page_size(request.args.get("limit", type=int), default=20,
+                      maximum=search.MAX_RESULTS)
+
+    expenses, more = [], False
+    try:
+        filters = search.parse_filters(request.args)
+    except ValueError as error:
+        flash(str(error), "danger")
+    else:
+        if text or filters:
+            expenses, more = search.search_expenses(
+                user_id, text, page=page, limit=limit, **filters)
 
-    expenses = Expense.query.filter(
-        (Expense.paid_by_id == user_id) |
-        (Expense.id.in_(
-            db.session.query(ExpenseSplit.expense_id)
-            .filter_by(user_id=user_id)
-        ))
-    ).order_by(Expense.timestamp.desc()).all()
-
-    transactions = []
-    for expense in expenses:
-        group = Group.query.get(expense.group_id) if expense.group_id else None
-        group_name = group.name if group else None
-
-        splits = expense.splits
-        user_split = next((s for s in splits if s.user_id == user_id), None)
-
-        if expense.paid_by_id == user_id:
-            # You paid, others owe you
-            for split in splits:
-                if split.user_id != user_id and split.amount > 0:
-                    counterparty = User.query.get(split.user_id)
-                    transactions.append({
-                        "description": expense.description,
-                        "owed_amount": split.amount,
-                        "counterparty_name": counterparty.name,
-                        "group_name": group_name,
-                        "timestamp": expense.timestamp
-                    })
-
-        elif user_split:
-            # You owe someone
-            payer = User.query.get(expense.paid_by_id)
-            transactions.append({
-                "description": expense.description,
-                "owed_amount": -user_split.amount,
-                "counterparty_name": payer.name,
-                "group_name": group_name,
-                "timestamp": expense.timestamp
-            })
-
-    return render_template("activity.html", transactions=transactions)
+    return render_template(
+        "search.html",
+        args=request.args.to_dict(),
+        groups=db.session.scalars(Group.of_user_query(user_id)).all(),
+        currencies=fx.currencies(),
+        expenses=expenses,
+        next_page=page + 1 if more else None,
+    )
 
 
 @app.route("/group/<int:group_id>/edit_expense/<int:expense_id>",
@@ -521,17 +810,50 @@ def edit_group_expense(group_id, expense_id):
     members = group.users
 
     if request.method == "POST":
+        # Take the write lock before reading what the edit replaces, so a
+        # concurrent edit can't change it in between
+        Group.bump_version(group.id)
+        db.session.refresh(expense)
+        old_splits = expense.split_amounts()
+        old_deltas = expense.balance_deltas(old_splits)
+        old_spend = expense.spend_deltas(old_splits)
+        code = request.form.get("currency", expense.currency).upper()
+        if code not in fx.currencies():
+            flash("There are no exchange rates for that currency.", "danger")
+            return redirect(request.url)
+        try:
+            amount = to_minor(request.form.get("amount"), code)
+            payer_id = int(request.form.get("paid_by"))
+        except (TypeError, ValueError):
+            flash("Invalid input for expense fields.", "danger")
+            return redirect(request.url)
+
         expense.description = request.form.get("description")
-        expense.amount = float(request.form.get("amount"))
-        expense.paid_by_id = int(request.form.get("paid_by"))
+        expense.amount = amount
+        expense.currency = code
+        expense.paid_by_id = payer_id
 
-        total_split = expense.update_splits_from_form(request.form, members)
+        expense.update_splits_from_form(request.form, members)
 
-        if round(total_split, 2) != round(expense.amount, 2):
+        # Check the splits as stored now, not just the fields sent
+        splits = expense.split_amounts()
+        if sum(amount for _, amount in splits) != expense.amount:
             db.session.rollback()
             flash("Split amounts must equal the total expense.", "danger")
             return redirect(request.url)
 
+        new_deltas = expense.balance_deltas(splits)
+        Balance.apply(group.id, old_deltas, sign=-1)
+        Balance.apply(group.id, new_deltas)
+        MonthlySpend.apply(
+            group.id, MonthlySpend.change(old_spend,
+                                          expense.spend_deltas(splits)))
+        # The event carries the edit's net effect
+        for key, delta in old_deltas.items():
+            new_deltas[key] -= delta
+        ExpenseEvent.record(group.id, [ExpenseEvent.change(
+            ExpenseEvent.EDITED, expense, splits, new_deltas)],
+            user_id=session.get("user_id"))
         db.session.commit()
         flash("Expense updated successfully!", "success")
 
@@ -540,14 +862,19 @@ def edit_group_expense(group_id, expense_id):
             return redirect(url_for("friend_page", group_id=group.id))
         return redirect(url_for("group_page", group_id=group.id))
 
-    user_splits = {split.user_id: split.amount for split in expense.splits}
+    user_splits = {
+        split.user_id: to_major(split.amount, expense.currency)
+        for split in expense.splits
+    }
 
     return render_template(
         "add_expense.html",
         group=group,
         users=members,
         expense=expense,
-        user_splits=user_splits
+        user_splits=user_splits,
+        currencies=fx.currencies(),
+        selected_currency=expense.currency
     )
 
 
@@ -563,7 +890,17 @@ def delete_group_expense(group_id, expense_id):
         flash("Expense does not belong to this group.", "danger")
         return redirect(url_for("group_page", group_id=group_id))
 
-    ExpenseSplit.query.filter_by(expense_id=expense.id).delete()
+    Group.bump_version(group.id)
+    db.session.refresh(expense)
+    splits = expense.split_amounts()
+    deltas = expense.balance_deltas(splits)
+    Balance.apply(group.id, deltas, sign=-1)
+    MonthlySpend.apply(group.id, expense.spend_deltas(splits), sign=-1)
+    ExpenseEvent.record(group.id, [ExpenseEvent.change(
+        ExpenseEvent.DELETED, expense, splits,
+        {key: -delta for key, delta in deltas.items()})],
+        user_id=session.get("user_id"))
+    # Its splits go with it (ON DELETE CASCADE)
     db.session.delete(expense)
     db.session.commit()
 
@@ -574,7 +911,135 @@ def delete_group_expense(group_id, expense_id):
     return redirect(url_for("group_page", group_id=group.id))
 
 
+@app.cli.command("import-expenses")
+@click.argument("group_id", type=int)
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=importer.BATCH_SIZE, show_default=True)
+def import_expenses_command(group_id, path, batch_size):
+    """Import expenses into a group from a CSV, JSON Lines or JSON file"""
+    group = db.session.get(Group, group_id)
+    if group is None:
+        raise click.ClickException(f"No group with id {group_id}.")
+
+    extension = path.rsplit(".", 1)[-1].lower()
+    reader = importer.READERS.get(extension)
+    if reader is None:
+        raise click.ClickException(
+            "Only .csv, .jsonl and .json files are supported.")
+
+    with open(path, encoding="utf-8-sig", newline="") as stream:
+        result = importer.import_expenses(
+            group, reader(stream), batch_size=batch_size)
+
+    for line, message in result.errors:
+        click.echo(f"line {line}: {message}", err=True)
+    click.echo(f"Imported {result.imported} expenses, "
+               f"{len(result.errors)} rows skipped.")
+
+
+@app.cli.command("import-rates")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=fx.BATCH_SIZE, show_default=True)
+def import_rates_command(path, batch_size):
+    """Load exchange rates from a CSV file of date,currency,rate rows"""
+    with open(path, encoding="utf-8-sig", newline="") as stream:
+        loaded, errors = fx.import_rates(
+            fx.read_rates(stream), batch_size=batch_size)
+
+    for line, message in errors:
+        click.echo(f"line {line}: {message}", err=True)
+    click.echo(f"Loaded {loaded} rates (per {fx.base_currency()}), "
+               f"{len(errors)} rows skipped.")
+
+
+@app.cli.command("sweep-sessions")
+def sweep_sessions():
+    """Delete expired rows from the SQL session store"""
+    click.echo(f"Removed {sessions.sweep_expired()} expired sessions.")
+
+
+@app.cli.command("check-query-plans")
+@click.option("--min-rows", default=queryplan.MIN_ROWS, show_default=True,
+              help="Don't report scans of tables smaller than this.")
+def check_query_plans(min_rows):
+    """Fail if any of the main pages' queries scans a whole table"""
+    if db.engine.dialect.name != "sqlite":
+        raise click.ClickException("Query plans are only checked on SQLite.")
+    try:
+        problems = queryplan.check(app, min_rows=min_rows)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+
+    for path, statement, scans in problems:
+        click.echo(f"{path}: {'; '.join(scans)}\n"
+                   f"  {' '.join(statement.split())}\n")
+    if problems:
+        raise click.ClickException(
+            f"{len(problems)} queries scan whole tables.")
+    click.echo("All queries use indexes.")
+
+
+@app.cli.command("rebuild-balances")
+@click.option("--enqueue", is_flag=True,
+              help="Queue it for a worker instead of running it here.")
+@click.option("--rescan", is_flag=True,
+              help="Add up every expense instead of replaying the event log.")
+def rebuild_balances(enqueue, rescan):
+    """Recompute the balances table and report any drift"""
+    if enqueue:
+        job = jobs.enqueue("rebuild_balances", rescan=rescan)
+        click.echo(f"Queued job {job.id}.")
+        return
+
+    rebuilt, drifted = tasks.rebuild_balances(rescan=rescan)
+    for (group_id, user_id, code), have, want in drifted:
+        click.echo(
+            f"group {group_id} user {user_id}: stored {currency(have, code)}, "
+            f"expected {currency(want, code)}")
+    click.echo(f"Rebuilt {rebuilt} balances, {len(drifted)} drifted.")
+
+
+@app.cli.command("rebuild-rollups")
+@click.option("--enqueue", is_flag=True,
+              help="Queue it for a worker instead of running it here.")
+def rebuild_rollups(enqueue):
+    """Recompute the monthly spending rollups and report any drift"""
+    if enqueue:
+        job = jobs.enqueue("rebuild_rollups")
+        click.echo(f"Queued job {job.id}.")
+        return
+
+    rebuilt, drifted = analytics.rebuild_rollups()
+    for group_id, month, user_id, code in drifted:
+        click.echo(
+            f"group {group_id} {month} user {user_id} {code} had drifted")
+    click.echo(f"Rebuilt {rebuilt} rollups, {len(drifted)} drifted.")
+
+
+@app.cli.command("compact-events")
+@click.option("--keep-days", default=eventlog.DEFAULT_KEEP_DAYS,
+              show_default=True,
+              help="Keep every group's history for at least this many days.")
+def compact_events(keep_days):
+    """Delete old expense events already accounted for by a snapshot"""
+    events, snapshots = eventlog.compact(keep_days)
+    click.echo(f"Deleted {events} events and {snapshots} snapshots.")
+
+
+@app.cli.command("worker")
+@click.option("--threads", default=2, show_default=True,
+              help="Jobs run at once.")
+def worker(threads):
+    """Run background jobs until interrupted"""
+    pool = jobs.Pool(app, threads)
+    click.echo(f"Worker {pool.name} running {pool.threads} jobs at a time.")
+    try:
+        pool.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        upgrade()
     app.run(debug=True)
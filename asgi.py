@@ -0,0 +1,668 @@
+"""ASGI entry point, with async versions of the read-heavy pages.
+
+    pip install uvicorn aiosqlite greenlet
+    uvicorn asgi:app --workers 4
+
+The dashboard, groups, friends, group and friend pages, activity and every
+GET endpoint of the JSON API are served by the coroutines below: their
+queries go through SQLAlchemy's asyncio engine (aiosqlite, or asyncpg on
+Postgres), so a request waiting on the database doesn't hold a thread and
+one process can keep many slow requests in flight. Everything else (forms,
+writes, downloads, the search and analytics pages) is handed to the
+regular WSGI app on a pool of `WSGI_THREADS` threads (default 16).
+
+The async views run inside the WSGI app's own request context, with its
+session, hooks, error handlers and templates, and execute the same
+statements as their sync twins in app.py and api.py, so the two serve the
+same pages. Only the database I/O is awaited; session loading, the
+fragment cache and template rendering are unchanged. With
+`SESSION_BACKEND=sql`, session cache misses still block the event loop.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import asyncio
+import contextvars
+import inspect
+import io
+import os
+
+from flask import abort, flash, jsonify, make_response
+from flask import redirect, render_template, request, session
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from werkzeug.exceptions import HTTPException
+
+from app import app as wsgi_app
+from helper import decode_cursor, encode_cursor, login_required
+from helper import normalize_term, page_size
+from models import db, Balance, BalanceSnapshot, ExpenseSplit, Friendship
+from models import FxRate, Group, GroupMember, MonthlySpend, User
+from summary import UserSummary
+import analytics
+import api
+import database
+import eventlog
+import fragments
+import fx
+import matrix
+import metrics
+import search
+
+
+DEFAULT_WSGI_THREADS = 16
+
+
+class AsyncApp:
+    """Serves the registered endpoints with coroutines, the rest via WSGI"""
+
+    def __init__(self, app):
+        self.app = app
+        threads = app.config.get(
+            "WSGI_THREADS",
+            os.environ.get("WSGI_THREADS", DEFAULT_WSGI_THREADS))
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(threads), thread_name_prefix="wsgi")
+        self.engine = database.async_engine(app)
+        metrics.instrument(self.engine.sync_engine)
+        self.sessions = async_sessionmaker(
+            self.engine, expire_on_commit=False)
+        self.views = {}
+
+    def view(self, endpoint):
+        """Register a coroutine taking (db_session, **view args)"""
+        def register(function):
+            self.views[endpoint] = function
+            return function
+        return register
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            raise ValueError(f"Unsupported ASGI scope {scope['type']!r}")
+
+        endpoint = None
+        if scope["method"] in ("GET", "HEAD"):
+            environ = _environ(scope, b"")
+            endpoint = self._endpoint(environ)
+        if endpoint not in self.views:
+            await self._wsgi(scope, receive, send)
+            return
+
+        response = await self._dispatch(environ, self.views[endpoint])
+        headers = response.get_wsgi_headers(environ)
+        await _send_start(send, response.status_code, headers.items())
+        for chunk in response.get_app_iter(environ):
+            await send({"type": "http.response.body", "body": chunk,
+                        "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    def _endpoint(self, environ):
+        adapter = self.app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, _ = adapter.match()
+        except HTTPException:
+            return None
+        return endpoint
+
+    async def _dispatch(self, environ, view):
+        """What Flask's full_dispatch_request does, awaiting the view"""
+        app = self.app
+        with app.request_context(environ):
+            try:
+                try:
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        async with self.sessions() as db_session:
+                            rv = view(db_session, **request.view_args)
+                            if inspect.isawaitable(rv):
+                                rv = await rv
+                except Exception as error:
+                    rv = app.handle_user_exception(error)
+                return app.finalize_request(rv)
+            except Exception as error:
+                return app.handle_exception(error)
+
+    async def _wsgi(self, scope, receive, send):
+        """Run the WSGI app on the thread pool, streaming what it yields"""
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        environ = _environ(scope, bytes(body))
+
+        loop = asyncio.get_running_loop()
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(" ", 1)[0]), headers]
+
+        # Steps may land on different threads; running them all in one
+        # context keeps a streamed response's request context intact
+        context = contextvars.copy_context()
+
+        def run(function, *args):
+            return loop.run_in_executor(
+                self.executor, context.run, function, *args)
+
+        iterable = await run(self.app, environ, start_response)
+        chunks = iter(iterable)
+        try:
+            # The status is only known once the first chunk is produced
+            chunk = await run(next, chunks, None)
+            await _send_start(send, *started)
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body",
+                                "body": chunk, "more_body": True})
+                chunk = await run(next, chunks, None)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            if hasattr(iterable, "close"):
+                await run(iterable.close)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def _send_start(send, status, headers):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers],
+    })
+
+
+def _environ(scope, body):
+    """The WSGI environ of an ASGI request"""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode().decode("latin-1"),
+        "PATH_INFO": scope["path"].encode().decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": io.StringIO(),
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    if body and "CONTENT_LENGTH" not in environ:
+        environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
+
+
+app = AsyncApp(wsgi_app)
+
+
+async def _group_for_member(db_session, group_id, user_id):
+    """(group, is the user a member); aborts with 404 if there's no group"""
+    group = await db_session.get(Group, group_id)
+    if group is None:
+        abort(404)
+    member = await db_session.get(GroupMember, (user_id, group_id))
+    return group, member is not None
+
+
+async def _expense_page(db_session, group_id):
+    """(expenses, next cursor) of the page the request asks for"""
+    limit = page_size(request.args.get("limit", type=int))
+    before = decode_cursor(request.args.get("before"))
+
+    # Fetch one extra row to know whether an older page exists
+    expenses = (await db_session.scalars(Group.expenses_query(
+        group_id, before=before, limit=limit + 1))).all()
+    next_cursor = None
+    if len(expenses) > limit:
+        expenses = expenses[:limit]
+        next_cursor = encode_cursor(expenses[-1].timestamp, expenses[-1].id)
+    return expenses, next_cursor
+
+
+async def _expense_list(db_session, group):
+    html = fragments.lookup(group)
+    if html is None:
+        expenses, next_cursor = await _expense_page(db_session, group.id)
+        html = fragments.store(group, render_template(
+            "expense_list.html",
+            group=group,
+            expenses=expenses,
+            next_cursor=next_cursor
+        ))
+    return html
+
+
+async def _conditional_page(group, render):
+    """fragments.conditional_page, awaiting `render`"""
+    if "_flashes" in session:
+        return await render()
+    response = fragments.not_modified(group)
+    if response is None:
+        response = fragments.add_validators(
+            make_response(await render()), group)
+    return response
+
+
+async def _matrix(db_session, group):
+    """matrix.for_group, awaiting the query on a cache miss"""
+    group_matrix = matrix.lookup(group)
+    if group_matrix is None:
+        rows = (await db_session.execute(
+            Group.pair_debts_query(group.id))).all()
+        names = dict((await db_session.execute(
+            matrix.BalanceMatrix.names_query(
+                matrix.BalanceMatrix.user_ids(rows)))).all())
+        group_matrix = matrix.store(
+            group, matrix.BalanceMatrix.from_rows(rows, names))
+    return group_matrix
+
+
+async def _converter(db_session, currencies=(), converter=None):
+    """`converter` (by default fx.converter()), loaded with the rates of
+    `currencies` as Converter.load would, awaiting its queries"""
+    converter = converter or fx.converter()
+    if converter.needs_stamp():
+        converter.set_stamp(await db_session.scalar(FxRate.stamp_query()))
+    pending = converter.pending(currencies)
+    if pending:
+        converter.learn(pending, await db_session.execute(
+            FxRate.latest_query(pending, converter.day)))
+    return converter
+
+
+async def _currencies(db_session):
+    """fx.currencies(), awaiting its queries"""
+    rates = await _converter(
+        db_session, converter=fx.Converter(fx.base_currency()))
+    codes = fx.cached_currencies(rates)
+    if codes is None:
+        codes = fx.learn_currencies(rates, await db_session.scalars(
+            FxRate.currencies_query(rates.day)))
+    return codes
+
+
+async def _balances_by_group(db_session, user_id):
+    """Balance.for_user, awaiting the query"""
+    return Balance.by_group(
+        await db_session.execute(Balance.for_user_query(user_id)))
+
+
+@app.view("index")
+@login_required
+async def index(db_session):
+    user_id = session.get("user_id")
+    user = await db_session.get(User, user_id)
+    if user is None:
+        flash("User not found. Please log in again.", "danger")
+        return redirect("/logout")
+
+    summary = UserSummary.cached(user_id)
+    if summary is None:
+        summary = UserSummary.from_rows(
+            await db_session.execute(UserSummary.query(user_id)))
+        UserSummary.remember(user_id, summary)
+    converter = await _converter(
+        db_session, {*summary.net_balance, *summary.total_spent})
+    net_balance, total_spent = converter.totals(
+        [summary.net_balance, summary.total_spent])
+
+    return render_template(
+        "index.html",
+        net_balance=net_balance,
+        num_groups=summary.num_groups,
+        num_friends=summary.num_friends,
+        total_spent=total_spent
+    )
+
+
+@app.view("groups_page")
+@login_required
+async def groups_page(db_session):
+    user_id = session.get("user_id")
+
+    groups = (await db_session.scalars(Group.of_user_query(user_id))).all()
+    balances = await _balances_by_group(db_session, user_id)
+    converter = await _converter(
+        db_session, {code for each in balances.values() for code in each})
+    totals = converter.totals(balances.get(g.id, {}) for g in groups)
+    entries = [
+        {
+            "id": g.id,
+            "name": g.name,
+            "balance": balance
+        }
+        for g, balance in zip(groups, totals)
+    ]
+
+    return render_template(
+        "entities_list.html",
+        title="Groups",
+        header="Your Groups",
+        action_url="/create_group",
+        action_text="+ New Group",
+        entries=entries,
+        is_friend_view=False,
+        empty_message="You're not part of any groups yet. \
+            Create one to get started!"
+    )
+
+
+@app.view("friends_page")
+@login_required
+async def friends_page(db_session):
+    user_id = session.get("user_id")
+
+    balances = await _balances_by_group(db_session, user_id)
+    friends = (await db_session.execute(
+        Friendship.for_user_query(user_id))).all()
+    converter = await _converter(
+        db_session, {code for each in balances.values() for code in each})
+    totals = converter.totals(
+        balances.get(group_id, {}) for group_id, _ in friends)
+    entries = [
+        {
+            "id": group_id,
+            "name": friend.name,
+            "balance": balance
+        }
+        for (group_id, friend), balance in zip(friends, totals)
+    ]
+
+    return render_template(
+        "entities_list.html",
+        title="Friends",
+        header="Your Friends",
+        action_url="/create_friend",
+        action_text="+ Add New Friend",
+        entries=entries,
+        is_friend_view=True,
+        empty_message="You don't have any friends added yet. \
+            Add one to get started!"
+    )
+
+
+@app.view("group_page")
+@login_required
+async def group_page(db_session, group_id):
+    current_user_id = session.get("user_id")
+    group, is_member = await _group_for_member(
+        db_session, group_id, current_user_id)
+
+    if not is_member:
+        flash("You do not have access to this group.", "danger")
+        return redirect("/groups")
+
+    # The page's ETag carries the rates' key: have it without blocking
+    await _converter(db_session)
+
+    async def render():
+        group_matrix = await _matrix(db_session, group)
+        balances = dict((await db_session.execute(
+            Balance.of_member_query(group.id, current_user_id))).all())
+        rates = await _converter(
+            db_session, {*balances, *group_matrix.currencies()})
+        debts = group_matrix.converted(rates)
+        return render_template(
+            "group.html",
+            group=group,
+            expense_list=await _expense_list(db_session, group),
+            balance=rates.total(balances),
+            matrix=debts,
+            simplified=debts.simplified()
+        )
+
+    return await _conditional_page(group, render)
+
+
+@app.view("friend_page")
+@login_required
+async def friend_page(db_session, group_id):
+    current_user_id = session.get("user_id")
+    group, is_member = await _group_for_member(
+        db_session, group_id, current_user_id)
+
+    if not is_member or not group.is_friend_group:
+        flash("You do not have access to this friend view.", "danger")
+        return redirect("/friends")
+
+    await _converter(db_session)
+
+    async def render():
+        friend = await db_session.scalar(
+            db.select(User)
+            .join(GroupMember, GroupMember.user_id == User.id)
+            .where(GroupMember.group_id == group.id,
+                   User.id != current_user_id))
+        between = (await _matrix(db_session, group)).between(
+            current_user_id, friend.id)
+        return render_template(
+            "friend.html",
+            group=group,
+            friend=friend,
+            expense_list=await _expense_list(db_session, group),
+            balance=(await _converter(db_session, between)).total(between)
+        )
+
+    return await _conditional_page(group, render)
+
+
+@app.view("activity")
+@login_required
+async def activity(db_session):
+    user_id = session.get("user_id")
+    limit = page_size(request.args.get("limit", type=int))
+    before = decode_cursor(request.args.get("before"))
+
+    # Fetch one extra row to know whether an older page exists
+    rows = (await db_session.execute(ExpenseSplit.activity_page_query(
+        user_id, before=before, limit=limit + 1))).all()
+    transactions = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = transactions[-1]
+        next_cursor = encode_cursor(last.timestamp, last.split_id)
+
+    return render_template(
+        "activity.html",
+        transactions=transactions,
+        next_cursor=next_cursor,
+        limit=limit
+    )
+
+
+@app.view("api.my_balances")
+async def my_balances(db_session):
+    entries = Balance.entries(await db_session.execute(
+        Balance.overview_query(session["user_id"])))
+    converter = await _converter(
+        db_session,
+        {code for entry in entries for code in entry["balances"]})
+    return jsonify(api.balances_response(entries, converter))
+
+
+def _error(message, status):
+    return jsonify({"error": message}), status
+
+
+async def _member_group(db_session, group_id):
+    """The group, if the caller is a member of it; None otherwise"""
+    group = await db_session.get(Group, group_id)
+    member = await db_session.get(
+        GroupMember, (session["user_id"], group_id))
+    return group if member is not None else None
+
+
+@app.view("api.group_expenses")
+async def group_expenses(db_session, group_id):
+    if await _member_group(db_session, group_id) is None:
+        return _error("Group not found.", 404)
+
+    expenses, next_cursor = await _expense_page(db_session, group_id)
+    return jsonify({
+        "expenses": [
+            {
+                "id": expense.id,
+                "description": expense.description,
+                "amount": expense.amount,
+                "currency": expense.currency,
+                "kind": expense.kind,
+                "paid_by": expense.payer.username if expense.payer else None,
+                "timestamp": expense.timestamp.isoformat(),
+                "splits": {
+                    split.user.username: split.amount
+                    for split in expense.splits
+                },
+            }
+            for expense in expenses
+        ],
+        "next_cursor": next_cursor,
+    })
+
+
+@app.view("api.search_expenses")
+async def search_expenses(db_session):
+    payer = request.args.get("payer", "").strip()
+    payer_id = None
+    if payer:
+        payer_id = await db_session.scalar(search.payer_query(payer))
+    currencies = None
+    if request.args.get("currency", "").strip():
+        currencies = await _currencies(db_session)
+    try:
+        filters = search.parse_filters(
+            request.args, payer_id=payer_id, currencies=currencies)
+    except ValueError as error:
+        return _error(str(error), 400)
+    page = request.args.get("page", 1, type=int)
+    limit = page_size(request.args.get("limit", type=int), default=20,
+                      maximum=search.MAX_RESULTS)
+
+    expenses, more = [], False
+    query = search.page_query(
+        session["user_id"], request.args.get("q", ""), page=page,
+        limit=limit, **filters)
+    if query is not None:
+        expenses = (await db_session.scalars(query)).all()
+        expenses, more = expenses[:limit], len(expenses) > limit
+    return jsonify(api.search_response(expenses, page, more))
+
+
+@app.view("api.search_users")
+async def search_users(db_session):
+    user_id = session["user_id"]
+    group_id = request.args.get("group_id", type=int)
+    if group_id is not None:
+        if await _member_group(db_session, group_id) is None:
+            return _error("Group not found.", 404)
+
+    limit = page_size(request.args.get("limit", type=int),
+                      default=10, maximum=api.MAX_SUGGESTIONS)
+    prefix = request.args.get("q", "")
+    users = []
+    if normalize_term(prefix):
+        users = User.distinct(await db_session.execute(User.search_query(
+            prefix, limit * 2, exclude_user_id=user_id,
+            exclude_group_id=group_id)), limit)
+    return jsonify(api.users_response(users))
+
+
+@app.view("api.group_balances")
+async def group_balances(db_session, group_id):
+    group = await _member_group(db_session, group_id)
+    if group is None:
+        return _error("Group not found.", 404)
+    group_matrix = await _matrix(db_session, group)
+    rates = await _converter(db_session, group_matrix.currencies())
+    return jsonify(api.matrix_response(group_matrix, rates))
+
+
+@app.view("api.group_events")
+async def group_events(db_session, group_id):
+    if await _member_group(db_session, group_id) is None:
+        return _error("Group not found.", 404)
+
+    limit = page_size(request.args.get("limit", type=int))
+    before = request.args.get("before", type=int)
+
+    # Fetch one extra row to know whether an older page exists
+    events = (await db_session.scalars(eventlog.events_query(
+        group_id, before=before, limit=limit + 1))).all()
+    return jsonify(api.events_response(events, limit))
+
+
+@app.view("api.group_balances_as_of")
+async def group_balances_as_of(db_session, group_id):
+    if await _member_group(db_session, group_id) is None:
+        return _error("Group not found.", 404)
+    try:
+        day = date.fromisoformat(request.args.get("date", ""))
+    except ValueError:
+        return _error("date must be YYYY-MM-DD.", 400)
+
+    # BalanceSnapshot.replay, awaiting its queries
+    until = eventlog.end_of(day)
+    snapshot = await db_session.scalar(
+        BalanceSnapshot.nearest_query(group_id, until))
+    if snapshot is None:
+        try:
+            BalanceSnapshot.check_first((await db_session.execute(
+                BalanceSnapshot.first_query(group_id))).first())
+        except LookupError as error:
+            return _error(str(error), 404)
+    _, balances = BalanceSnapshot.fold(snapshot, await db_session.execute(
+        BalanceSnapshot.events_query(group_id, snapshot, until)))
+
+    by_member = eventlog.by_member(balances)
+    names = dict((await db_session.execute(
+        eventlog.names_query(list(by_member)))).all())
+    rates = await _converter(
+        db_session,
+        {code for amounts in by_member.values() for code in amounts},
+        converter=fx.Converter(fx.viewer_currency(), day))
+    try:
+        return jsonify(api.as_of_response(day, by_member, names, rates))
+    except fx.MissingRate as error:
+        return _error(str(error), 404)
+
+
+@app.view("api.group_analytics")
+async def group_analytics(db_session, group_id):
+    if await _member_group(db_session, group_id) is None:
+        return _error("Group not found.", 404)
+
+    months = page_size(request.args.get("months", type=int),
+                       default=analytics.DEFAULT_MONTHS,
+                       maximum=analytics.MAX_MONTHS)
+    labels = analytics.month_range(months)
+    rows = (await db_session.execute(
+        MonthlySpend.for_group_query(group_id, labels[0]))).all()
+    rates = await _converter(db_session, {row.currency for row in rows})
+    return jsonify(api.analytics_response(
+        analytics.report_from_rows(labels, rows, rates), rates))
+
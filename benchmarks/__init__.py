@@ -0,0 +1 @@
+"""Benchmarks for Splitr; each runs with `python -m benchmarks.<name>`."""
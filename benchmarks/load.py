@@ -0,0 +1,344 @@
+"""Concurrent load test of one hot group, looking for write contention.
+
+Worker processes log in as different members of the seeded database's
+largest group and replay a mix of page views, new expenses and edits to a
+handful of shared expenses against a served instance. Every request is
+timed; writes that fail with a 503 (the app's answer to a lock timeout)
+are retried with backoff.
+
+Once the run ends the database is checked for lost updates:
+
+    lost_adds           acknowledged expenses that are not in the database
+    unacknowledged      expenses in the database whose request failed
+    split_mismatches    expenses whose splits don't add up to the amount
+    balance_drift       members whose stored balance differs from the ledger
+
+    python -m benchmarks.seed
+    python -m benchmarks.load [--db PATH] [--workers 8] [--duration 30]
+        [--mix read=60,add=25,edit=15] [--url http://127.0.0.1:5000]
+
+Without `--url` the app is served from a subprocess on `--port` with
+Werkzeug's threaded server; with it, the load goes to whatever is already
+serving `--db` (gunicorn, say). Results are printed as JSON.
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import multiprocessing
+import os
+import random
+import secrets
+import sqlite3
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+
+from benchmarks.seed import DEFAULT_PATH
+
+MIX = "read=60,add=25,edit=15"
+
+# Shared expenses every worker edits, so edits collide on the same rows
+HOT_EXPENSES = 5
+
+# Seconds a request may take before the client gives up on it
+REQUEST_TIMEOUT = 30
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # The redirect target tells a saved form apart from a rejected one
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect)
+
+    def request(self, path, form=None):
+        """(status, Location header) of one request"""
+        data = urllib.parse.urlencode(form).encode() if form else None
+        try:
+            with self.opener.open(self.base_url + path, data,
+                                  timeout=REQUEST_TIMEOUT) as response:
+                response.read()
+                return response.status, None
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get("Location")
+
+    def login(self, username):
+        status, location = self.request(
+            "/login", {"username": username, "password": "password"})
+        if status != 302 or not location.endswith("/"):
+            raise RuntimeError(f"Could not log in as {username}")
+
+
+def serve(db_path, port):
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(db_path)}"
+    os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+    from werkzeug.serving import make_server
+    from app import app
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.config["SLOW_REQUEST_QUERIES"] = sys.maxsize
+    app.config["SLOW_REQUEST_MS"] = sys.maxsize
+    make_server("127.0.0.1", port, app, threaded=True).serve_forever()
+
+
+def wait_for(base_url, deadline=30):
+    start = time.monotonic()
+    while time.monotonic() - start < deadline:
+        try:
+            urllib.request.urlopen(base_url + "/login", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{base_url} did not come up")
+
+
+def hot_group(db_path):
+    """(group id, [(user id, username)]) of the largest regular group"""
+    with sqlite3.connect(db_path) as conn:
+        (group_id,) = conn.execute(
+            "SELECT gm.group_id FROM group_members gm"
+            " JOIN groups g ON g.id = gm.group_id"
+            " WHERE NOT g.is_friend_group"
+            " GROUP BY gm.group_id ORDER BY count(*) DESC LIMIT 1"
+        ).fetchone()
+        members = conn.execute(
+            "SELECT u.id, u.username FROM group_members gm"
+            " JOIN users u ON u.id = gm.user_id"
+            " WHERE gm.group_id = ? ORDER BY u.id", (group_id,)
+        ).fetchall()
+    return group_id, members
+
+
+def create_hot_expenses(base_url, db_path, group_id, member, run_id):
+    user_id, username = member
+    client = Client(base_url)
+    client.login(username)
+    for i in range(HOT_EXPENSES):
+        client.request(f"/group/{group_id}/add_expense", {
+            "description": f"load {run_id} hot {i}",
+            "amount": "10.00",
+            "paid_by": str(user_id),
+        })
+    with sqlite3.connect(db_path) as conn:
+        return [expense_id for (expense_id,) in conn.execute(
+            "SELECT id FROM expenses WHERE description LIKE ?",
+            (f"load {run_id} hot %",))]
+
+
+def with_retries(client, path, form, retries, stats):
+    """Submit a form, retrying lock timeouts; (status, Location header)"""
+    for attempt in range(retries + 1):
+        try:
+            status, location = client.request(path, form)
+        except OSError:
+            stats["client_timeouts"] += 1
+            return None, None
+        if status != 503:
+            return status, location
+        stats["lock_timeouts"] += 1
+        if attempt < retries:
+            stats["retries"] += 1
+            time.sleep(0.05 * 2 ** attempt * (1 + random.random()))
+    return status, location
+
+
+def worker(index, base_url, group_id, member, hot_ids, mix, duration,
+           retries, run_id, results):
+    user_id, username = member
+    client = Client(base_url)
+    client.login(username)
+    operations, weights = zip(*mix.items())
+    group_path = f"/group/{group_id}"
+
+    stats = Counter()
+    timings = defaultdict(list)
+    acknowledged = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        operation = random.choices(operations, weights)[0]
+        start = time.perf_counter()
+        if operation == "read":
+            try:
+                status, _ = client.request(group_path)
+            except OSError:
+                stats["client_timeouts"] += 1
+                status = None
+            saved = status == 200
+        else:
+            if operation == "add":
+                path = f"{group_path}/add_expense"
+                description = f"load {run_id} {index} {stats['add']}"
+            else:
+                path = f"{group_path}/edit_expense/{random.choice(hot_ids)}"
+                description = f"load {run_id} hot edited"
+            form = {
+                "description": description,
+                "amount": f"{random.randint(100, 99999) / 100:.2f}",
+                "paid_by": str(user_id),
+            }
+            status, location = with_retries(
+                client, path, form, retries, stats)
+            # Saved forms redirect to the ledger, rejected ones back to the
+            # form
+            saved = status == 302 and location.endswith(group_path)
+            if saved and operation == "add":
+                acknowledged += 1
+        timings[operation].append((time.perf_counter() - start) * 1000)
+        stats[operation] += 1
+        if not saved:
+            stats[f"{operation}_failed"] += 1
+            if status not in (None, 503):
+                stats[f"http_{status}"] += 1
+
+    results.put((dict(stats), dict(timings), acknowledged))
+
+
+def check_consistency(db_path, group_id, run_id, acknowledged):
+    """Lost-update anomalies visible in the database after the run"""
+    with sqlite3.connect(db_path) as conn:
+        (added,) = conn.execute(
+            "SELECT count(*) FROM expenses WHERE description LIKE ?"
+            " AND description NOT LIKE ?",
+            (f"load {run_id} %", f"load {run_id} hot %")).fetchone()
+        (split_mismatches,) = conn.execute(
+            "SELECT count(*) FROM expenses e"
+            " WHERE e.group_id = ? AND e.amount != ("
+            "   SELECT coalesce(sum(s.amount), 0) FROM expense_split s"
+            "   WHERE s.expense_id = e.id)", (group_id,)).fetchone()
+        ledger = dict(conn.execute(
+            "SELECT user_id, sum(amount) FROM ("
+            "  SELECT paid_by_id AS user_id, amount FROM expenses"
+            "  WHERE group_id = :g"
+            "  UNION ALL"
+            "  SELECT s.user_id, -s.amount FROM expense_split s"
+            "  JOIN expenses e ON e.id = s.expense_id WHERE e.group_id = :g"
+            ") GROUP BY user_id", {"g": group_id}))
+        stored = dict(conn.execute(
+            "SELECT user_id, amount FROM balances WHERE group_id = ?",
+            (group_id,)))
+    drift = sum(
+        1 for user_id in ledger.keys() | stored.keys()
+        if ledger.get(user_id, 0) != stored.get(user_id, 0))
+    return {
+        "lost_adds": max(0, acknowledged - added),
+        "unacknowledged": max(0, added - acknowledged),
+        "split_mismatches": split_mismatches,
+        "balance_drift": drift,
+    }
+
+
+def summarize(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {}
+    return {
+        "count": len(timings),
+        "p50_ms": round(statistics.median(timings), 1),
+        "p95_ms": round(timings[int(len(timings) * 0.95) - 1], 1),
+        "p99_ms": round(timings[max(0, int(len(timings) * 0.99) - 1)], 1),
+        "max_ms": round(timings[-1], 1),
+    }
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        operation, _, weight = part.partition("=")
+        if operation not in ("read", "add", "edit"):
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}")
+        mix[operation] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=DEFAULT_PATH)
+    parser.add_argument("--url", help="load an already running server")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(MIX))
+    parser.add_argument("--retries", type=int, default=3)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found; run python -m benchmarks.seed")
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        base_url = f"http://127.0.0.1:{args.port}"
+        server = multiprocessing.Process(
+            target=serve, args=(args.db, args.port), daemon=True)
+        server.start()
+    base_url = base_url.rstrip("/")
+
+    try:
+        wait_for(base_url)
+        run_id = f"{time.time():.0f}"
+        group_id, members = hot_group(args.db)
+        hot_ids = create_hot_expenses(
+            base_url, args.db, group_id, members[0], run_id)
+
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=worker, args=(
+                index, base_url, group_id, members[index % len(members)],
+                hot_ids, args.mix, args.duration, args.retries, run_id,
+                results))
+            for index in range(args.workers)
+        ]
+        start = time.monotonic()
+        for process in workers:
+            process.start()
+        outcomes = [results.get() for _ in workers]
+        elapsed = time.monotonic() - start
+        for process in workers:
+            process.join()
+    finally:
+        if server is not None:
+            server.terminate()
+
+    stats = Counter()
+    timings = defaultdict(list)
+    acknowledged = 0
+    for worker_stats, worker_timings, worker_acknowledged in outcomes:
+        stats.update(worker_stats)
+        for operation, values in worker_timings.items():
+            timings[operation].extend(values)
+        acknowledged += worker_acknowledged
+
+    total = sum(stats[operation] for operation in args.mix)
+    print(json.dumps({
+        "meta": {
+            "url": base_url,
+            "db": os.path.abspath(args.db),
+            "group_id": group_id,
+            "members": len(members),
+            "workers": args.workers,
+            "duration_s": round(elapsed, 1),
+            "mix": args.mix,
+        },
+        "throughput_rps": round(total / elapsed, 1),
+        "latency": {operation: summarize(values)
+                    for operation, values in sorted(timings.items())},
+        "errors": {key: value for key, value in sorted(stats.items())
+                   if key not in args.mix},
+        "anomalies": check_consistency(
+            args.db, group_id, run_id, acknowledged),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
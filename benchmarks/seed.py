@@ -0,0 +1,258 @@
+"""Generate a synthetic Splitr database for benchmarking.
+
+Group sizes follow a power law, so most groups have a handful of members
+and a few have hundreds. Expenses land in groups in proportion to their
+size, and each one is split evenly among the group's members. Balances are
+computed while seeding, and stored with a baseline snapshot of each group
+for the event log to start from (as migration 0008 does for existing
+databases), so the database is ready for the app as it is.
+
+    python -m benchmarks.seed [--scale small|medium|large] [--users N]
+        [--groups N] [--friendships N] [--expenses N] [--seed N]
+        [--path benchmarks/data/splitr.db]
+
+`large` is 100k users, 20k groups and 5M expenses: expect several GB on
+disk and a few tens of minutes.  Every user's password is `password`.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import accumulate
+from datetime import datetime, timedelta
+
+from flask import Flask
+from flask_migrate import Migrate, upgrade
+from werkzeug.security import generate_password_hash
+
+import analytics
+import database
+from helper import allocate, default_currency
+from models import db, Balance, BalanceSnapshot, Expense, ExpenseSplit
+from models import Friendship, Group, GroupMember, User, UserSearch
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), "data", "splitr.db")
+MIGRATIONS = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "migrations")
+
+SCALES = {
+    "small": {"users": 1000, "groups": 200, "friendships": 2000,
+              "expenses": 20000},
+    "medium": {"users": 10000, "groups": 2000, "friendships": 20000,
+               "expenses": 500000},
+    "large": {"users": 100000, "groups": 20000, "friendships": 200000,
+              "expenses": 5000000},
+}
+
+# Rows per executemany INSERT
+CHUNK_SIZE = 10000
+
+# Power-law exponent and bounds for regular group sizes
+SIZE_ALPHA = 1.6
+MIN_GROUP_SIZE = 2
+MAX_GROUP_SIZE = 500
+
+# Expenses are spread over this many days before now
+HISTORY_DAYS = 730
+
+DESCRIPTIONS = [
+    "Groceries", "Dinner", "Rent", "Taxi", "Coffee", "Movie tickets",
+    "Utilities", "Hotel", "Flights", "Gas", "Lunch", "Drinks", "Concert",
+    "Internet", "Train tickets", "Snacks", "Gift", "Car rental",
+]
+
+
+@contextmanager
+def timed(step):
+    start = time.perf_counter()
+    yield
+    db.session.commit()
+    print(f"{step}: {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def make_app(path):
+    app = Flask(__name__)
+    database.configure(app, f"sqlite:///{os.path.abspath(path)}")
+    db.init_app(app)
+    database.init_app(app)
+    Migrate(app, db, directory=MIGRATIONS)
+    return app
+
+
+def group_size(rng, users):
+    size = int(MIN_GROUP_SIZE * rng.paretovariate(SIZE_ALPHA))
+    return min(size, MAX_GROUP_SIZE, users)
+
+
+def insert(model, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(db.insert(model), rows[start:start + CHUNK_SIZE])
+
+
+def seed_users(count):
+    password = generate_password_hash("password")
+    users = [
+        {"id": user_id, "name": f"User {user_id}",
+         "username": f"user{user_id}", "password": password}
+        for user_id in range(1, count + 1)
+    ]
+    insert(User, users)
+    # Bulk inserts skip the ORM events that keep the search index
+    insert(UserSearch, [
+        row for user in users
+        for row in UserSearch.rows(user["id"], user["username"], user["name"])
+    ])
+
+
+def seed_groups(rng, users, groups, friendships):
+    """Members of every group, indexed by group id"""
+    members = {}
+    group_rows, member_rows, friendship_rows = [], [], []
+
+    for group_id in range(1, groups + 1):
+        size = group_size(rng, users)
+        members[group_id] = sorted(rng.sample(range(1, users + 1), size))
+        group_rows.append({"id": group_id, "name": f"Group {group_id}",
+                           "is_friend_group": False})
+
+    pairs = set()
+    while len(pairs) < min(friendships, users * (users - 1) // 2):
+        pair = Friendship.pair(*rng.sample(range(1, users + 1), 2))
+        pairs.add(pair)
+    for group_id, (low_id, high_id) in enumerate(sorted(pairs),
+                                                 start=groups + 1):
+        members[group_id] = [low_id, high_id]
+        group_rows.append({"id": group_id, "name": None,
+                           "is_friend_group": True})
+        friendship_rows.append({"min_user_id": low_id, "max_user_id": high_id,
+                                "group_id": group_id})
+
+    for group_id, user_ids in members.items():
+        member_rows.extend({"user_id": user_id, "group_id": group_id}
+                           for user_id in user_ids)
+
+    insert(Group, group_rows)
+    insert(GroupMember, member_rows)
+    insert(Friendship, friendship_rows)
+    return members
+
+
+def seed_expenses(rng, members, count):
+    """Insert expenses and splits; returns balances by (group, user)"""
+    group_ids = list(members)
+    cum_weights = list(accumulate(len(members[group_id])
+                                  for group_id in group_ids))
+    balances = defaultdict(int)
+    now = datetime.now()
+    code = default_currency()
+    expenses, splits = [], []
+    split_id = 0
+
+    def flush():
+        insert(Expense, expenses)
+        insert(ExpenseSplit, splits)
+        expenses.clear()
+        splits.clear()
+
+    for expense_id in range(1, count + 1):
+        group_id = rng.choices(group_ids, cum_weights=cum_weights)[0]
+        user_ids = members[group_id]
+        payer_id = rng.choice(user_ids)
+        # Log-normal amounts: mostly tens of dollars, occasionally hundreds
+        amount = max(1, int(rng.lognormvariate(7.5, 1.0)))
+        expenses.append({
+            "id": expense_id,
+            "description": rng.choice(DESCRIPTIONS),
+            "amount": amount,
+            "paid_by_id": payer_id,
+            "group_id": group_id,
+            "timestamp": now - timedelta(
+                seconds=rng.randrange(HISTORY_DAYS * 86400)),
+            "kind": Expense.EXPENSE,
+            "currency": code,
+        })
+        balances[group_id, payer_id] += amount
+        for user_id, share in zip(user_ids,
+                                  allocate(amount, [1] * len(user_ids))):
+            if not share:
+                continue
+            split_id += 1
+            splits.append({"id": split_id, "expense_id": expense_id,
+                           "user_id": user_id, "amount": share})
+            balances[group_id, user_id] -= share
+
+        if len(splits) >= CHUNK_SIZE:
+            flush()
+        if expense_id % 100000 == 0:
+            db.session.commit()
+            print(f"  {expense_id:,} expenses", file=sys.stderr)
+    flush()
+    return balances
+
+
+def seed_balances(balances):
+    insert(Balance, [
+        {"group_id": group_id, "user_id": user_id,
+         "currency": default_currency(), "amount": amount}
+        for (group_id, user_id), amount in balances.items()
+    ])
+    seed_snapshots(balances)
+
+
+def seed_snapshots(balances):
+    """A baseline snapshot (event 0) of every group with expenses"""
+    by_group = defaultdict(dict)
+    for (group_id, user_id), amount in balances.items():
+        by_group[group_id][(user_id, default_currency())] = amount
+    taken_at = datetime.now()
+    insert(BalanceSnapshot, [
+        {"group_id": group_id, "event_id": 0, "taken_at": taken_at,
+         "balances": BalanceSnapshot.encode(group)}
+        for group_id, group in by_group.items()
+    ])
+
+
+def seed(path, users, groups, friendships, expenses, seed=0):
+    """Create a fresh database at `path` filled with synthetic data"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    rng = random.Random(seed)
+    app = make_app(path)
+    with app.app_context():
+        upgrade(directory=MIGRATIONS)
+        with timed("users"):
+            seed_users(users)
+        with timed("groups"):
+            members = seed_groups(rng, users, groups, friendships)
+        with timed("expenses"):
+            seed_balances(seed_expenses(rng, members, expenses))
+        with timed("rollups"):
+            analytics.rebuild_rollups()
+        with timed("analyze"):
+            db.session.execute(db.text("ANALYZE"))
+        db.engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    for name in SCALES["small"]:
+        parser.add_argument(f"--{name}", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--path", default=DEFAULT_PATH)
+    args = parser.parse_args()
+
+    sizes = {name: getattr(args, name) or default
+             for name, default in SCALES[args.scale].items()}
+    seed(args.path, seed=args.seed, **sizes)
+    print(args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""Sync (WSGI) versus async (ASGI) serving of the read-heavy pages.
+
+Serves the seeded database twice from uvicorn with the same `--threads`
+WSGI thread pool: once with every request going to the thread pool (the
+sync app, as under a threaded WSGI server), once through asgi.py's async
+views. Clients logged in as members of the largest group then fetch the
+dashboard, lists, group page, activity and JSON endpoints at each
+`--concurrency` level, and throughput and latency are compared.
+
+`--db-latency-ms` adds a sleep to every SQL statement, standing in for a
+database across the network: the sync app holds a pool thread for each
+sleep, the async one doesn't hold anything.
+
+    pip install uvicorn aiosqlite greenlet
+    python -m benchmarks.seed
+    python -m benchmarks.serving [--db PATH] [--concurrency 1,16,64]
+        [--duration 10] [--threads 16] [--db-latency-ms 5]
+
+Results are printed as JSON.
+"""
+import argparse
+import inspect
+import json
+import logging
+import multiprocessing
+import os
+import secrets
+import sys
+import threading
+import time
+
+from benchmarks.load import Client, hot_group, summarize, wait_for
+from benchmarks.seed import DEFAULT_PATH
+
+MODES = ("sync", "async")
+
+
+def pages(group_id):
+    return [
+        "/",
+        "/groups",
+        "/friends",
+        f"/group/{group_id}",
+        "/history",
+        "/api/v1/me/balances",
+        f"/api/v1/groups/{group_id}/expenses",
+    ]
+
+
+def slow_down(engine, seconds):
+    """Make every statement on `engine` take `seconds` longer.
+
+    The sleep runs where SQLite executes the statement: in the request's
+    thread for the sync driver, in aiosqlite's own thread for the async one.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.util import await_only
+
+    def trace(statement):
+        time.sleep(seconds)
+
+    def connect(dbapi_connection, connection_record):
+        driver = connection_record.driver_connection
+        result = driver.set_trace_callback(trace)
+        if inspect.isawaitable(result):
+            await_only(result)
+
+    event.listen(engine, "connect", connect)
+
+
+def serve(mode, db_path, port, threads, latency):
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(db_path)}"
+    os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+    os.environ["WSGI_THREADS"] = str(threads)
+    import uvicorn
+    from asgi import app
+    from models import db
+
+    flask_app = app.app
+    flask_app.config["SLOW_REQUEST_QUERIES"] = sys.maxsize
+    flask_app.config["SLOW_REQUEST_MS"] = sys.maxsize
+    if latency:
+        with flask_app.app_context():
+            slow_down(db.engine, latency)
+        slow_down(app.engine.sync_engine, latency)
+    if mode == "sync":
+        app.views.clear()
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def client(base_url, member, paths, ready, duration, timings, errors):
+    user = Client(base_url)
+    user.login(member[1])
+    # Everyone starts the timed window together, logged in
+    ready.wait()
+    deadline = time.monotonic() + duration
+    i = 0
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            status, _ = user.request(path)
+        except OSError:
+            status = None
+        if status == 200:
+            timings.append((time.perf_counter() - start) * 1000)
+        else:
+            errors.append(status)
+
+
+def run_level(base_url, members, paths, concurrency, duration):
+    timings, errors = [], []
+    ready = threading.Barrier(concurrency)
+    threads = [
+        threading.Thread(target=client, args=(
+            base_url, members[i % len(members)], paths, ready, duration,
+            timings, errors))
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        "throughput_rps": round(len(timings) / duration, 1),
+        "latency": summarize(timings),
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=DEFAULT_PATH)
+    parser.add_argument("--port", type=int, default=5056)
+    parser.add_argument("--concurrency", default="1,16,64")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--db-latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found; run python -m benchmarks.seed")
+    levels = [int(level) for level in args.concurrency.split(",")]
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    group_id, members = hot_group(args.db)
+    paths = pages(group_id)
+    base_url = f"http://127.0.0.1:{args.port}"
+    results = {}
+    for mode in MODES:
+        server = multiprocessing.Process(target=serve, args=(
+            mode, args.db, args.port, args.threads,
+            args.db_latency_ms / 1000), daemon=True)
+        server.start()
+        try:
+            wait_for(base_url)
+            results[mode] = {
+                str(level): run_level(
+                    base_url, members, paths, level, args.duration)
+                for level in levels
+            }
+        finally:
+            server.terminate()
+            server.join()
+
+    print(json.dumps({
+        "meta": {
+            "db": os.path.abspath(args.db),
+            "group_id": group_id,
+            "pages": paths,
+            "threads": args.threads,
+            "duration_s": args.duration,
+            "db_latency_ms": args.db_latency_ms,
+        },
+        **results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Per-request cost of each session backend.
+
+Runs a minimal app (no templates, no queries besides the session store's)
+against every backend in sessions.py, on a scratch SQLite database, and
+reports latency for requests that only read the session and for requests
+that modify it.
+
+    python -m benchmarks.sessions [--requests 2000]
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from flask import Flask, session
+
+import database
+import sessions
+from models import db
+
+BACKENDS = [
+    ("cookie", {}),
+    ("filesystem", {}),
+    ("sql", {}),
+    ("sql (no LRU)", {"SESSION_CACHE_SIZE": 0}),
+]
+
+
+def make_app(backend, settings, workdir):
+    app = Flask(__name__)
+    app.secret_key = "benchmark"
+    app.config["SESSION_BACKEND"] = backend.split()[0]
+    app.config["SESSION_FILE_DIR"] = os.path.join(workdir, "flask_session")
+    app.config["SESSION_SWEEP_INTERVAL"] = 0
+    app.config.update(settings)
+    database.configure(
+        app, f"sqlite:///{os.path.join(workdir, 'sessions.db')}")
+    db.init_app(app)
+    database.init_app(app)
+    sessions.init_app(app)
+    with app.app_context():
+        db.create_all()
+
+    @app.route("/read")
+    def read():
+        return str(session.get("user_id"))
+
+    @app.route("/write")
+    def write():
+        session["hits"] = session.get("hits", 0) + 1
+        return str(session["hits"])
+
+    @app.route("/login")
+    def login():
+        session["user_id"] = 1
+        session["name"] = "Benchmark User"
+        return "ok"
+
+    return app
+
+
+def measure(client, path, requests):
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get(path)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return {
+        "p50_us": round(statistics.median(timings), 1),
+        "p99_us": round(timings[int(len(timings) * 0.99) - 1], 1),
+        "mean_us": round(statistics.fmean(timings), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    results = {}
+    for backend, settings in BACKENDS:
+        with tempfile.TemporaryDirectory() as workdir:
+            app = make_app(backend, settings, workdir)
+            client = app.test_client()
+            client.get("/login")
+            results[backend] = {
+                "read": measure(client, "/read", args.requests),
+                "write": measure(client, "/write", args.requests),
+            }
+            with app.app_context():
+                for engine in db.engines.values():
+                    engine.dispose()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Latency, query count and memory of the main pages on a seeded database.
+
+Drives each view through the Flask test client as the member of the
+largest group, so every page sees the heaviest data the seed produced.
+Results are printed as JSON; pass `--baseline` to compare against an
+earlier run and exit non-zero when a view got slower, ran more queries or
+used more memory than `--tolerance` allows.
+
+    python -m benchmarks.seed --scale medium
+    python -m benchmarks.views [--db PATH] [--requests 200]
+        [--output results.json] [--baseline baseline.json]
+
+The add and edit views write to the database, so reseed before comparing
+runs that must see identical data.
+"""
+import argparse
+import json
+import os
+import platform
+import secrets
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks.seed import DEFAULT_PATH
+
+# Extra relative slowdown or memory growth tolerated against a baseline;
+# query counts must not grow at all
+TOLERANCE = 0.2
+# Latency changes smaller than this are noise on any machine
+MIN_DELTA_MS = 1.0
+
+
+def load_app(path):
+    # app.py reads its database URL and key at import time
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.abspath(path)}"
+    os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+    from app import app
+    app.config["QUERY_COUNT_HEADER"] = True
+    app.config["SLOW_REQUEST_QUERIES"] = sys.maxsize
+    app.config["SLOW_REQUEST_MS"] = sys.maxsize
+    return app
+
+
+def pick_subject():
+    """(user id, group id, friend group id) to benchmark as"""
+    from models import db, Friendship, Group, GroupMember
+
+    size = db.func.count(GroupMember.user_id)
+    group_id = db.session.scalar(
+        db.select(GroupMember.group_id)
+        .join(Group, Group.id == GroupMember.group_id)
+        .where(Group.is_friend_group.is_(False))
+        .group_by(GroupMember.group_id)
+        .order_by(size.desc())
+        .limit(1)
+    )
+    memberships = db.func.count(GroupMember.group_id)
+    user_id = db.session.scalar(
+        db.select(GroupMember.user_id)
+        .where(GroupMember.user_id.in_(
+            db.select(GroupMember.user_id).filter_by(group_id=group_id)))
+        .group_by(GroupMember.user_id)
+        .order_by(memberships.desc())
+        .limit(1)
+    )
+    friendship = db.session.scalars(
+        db.select(Friendship).where(Friendship.involving(user_id)).limit(1)
+    ).first()
+    return user_id, group_id, friendship.group_id if friendship else None
+
+
+def scenarios(app, user_id, group_id, friend_group_id):
+    """(name, method, path, form) for each benchmarked view"""
+    from models import db, Expense
+
+    form = {"description": "Benchmark", "amount": "12.34",
+            "paid_by": str(user_id)}
+    # Edit an expense of our own, so reseeding isn't needed between runs
+    with app.test_client() as client:
+        with client.session_transaction() as session:
+            session["user_id"] = user_id
+        client.post(f"/group/{group_id}/add_expense", data=form)
+    with app.app_context():
+        expense_id = db.session.scalar(
+            db.select(db.func.max(Expense.id))
+            .where(Expense.group_id == group_id))
+
+    yield "index", "GET", "/", None
+    yield "groups_page", "GET", "/groups", None
+    yield "friends_page", "GET", "/friends", None
+    yield "group_page", "GET", f"/group/{group_id}", None
+    if friend_group_id is not None:
+        yield "friend_page", "GET", f"/friend/{friend_group_id}", None
+    yield "activity", "GET", "/history", None
+    yield ("add_group_expense", "POST", f"/group/{group_id}/add_expense",
+           form)
+    yield ("edit_group_expense", "POST",
+           f"/group/{group_id}/edit_expense/{expense_id}",
+           dict(form, amount="43.21"))
+
+
+def request_once(client, method, path, form):
+    response = client.open(path, method=method, data=form)
+    # Streamed pages only do their work as the body is read
+    response.get_data()
+    if response.status_code >= 400:
+        raise RuntimeError(f"{method} {path} returned {response.status}")
+    return int(response.headers.get("X-Query-Count", 0))
+
+
+def measure(client, method, path, form, requests, warmup):
+    for _ in range(warmup):
+        request_once(client, method, path, form)
+
+    timings, queries = [], []
+    for _ in range(requests):
+        start = time.perf_counter()
+        queries.append(request_once(client, method, path, form))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+
+    # Measured apart from the timings, which tracing would distort
+    tracemalloc.start()
+    request_once(client, method, path, form)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": round(statistics.median(timings), 2),
+        "p99_ms": round(timings[max(0, int(len(timings) * 0.99) - 1)], 2),
+        "mean_ms": round(statistics.fmean(timings), 2),
+        "queries": max(queries),
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Human-readable regressions of `results` against `baseline`"""
+    regressions = []
+    for name, current in results["views"].items():
+        before = baseline.get("views", {}).get(name)
+        if before is None:
+            continue
+        for key in ("p50_ms", "p99_ms", "peak_kb"):
+            floor = MIN_DELTA_MS if key.endswith("_ms") else 0
+            if current[key] > max(before[key] * (1 + tolerance),
+                                  before[key] + floor):
+                regressions.append(
+                    f"{name}: {key} {before[key]} -> {current[key]}")
+        if current["queries"] > before["queries"]:
+            regressions.append(
+                f"{name}: queries {before['queries']} -> "
+                f"{current['queries']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=DEFAULT_PATH)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--output", help="also write the results here")
+    parser.add_argument("--baseline", help="results of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error(f"{args.db} not found; run python -m benchmarks.seed")
+
+    app = load_app(args.db)
+    with app.app_context():
+        user_id, group_id, friend_group_id = pick_subject()
+
+    views = {}
+    for name, method, path, form in scenarios(
+            app, user_id, group_id, friend_group_id):
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+            views[name] = measure(
+                client, method, path, form, args.requests, args.warmup)
+        print(f"{name}: {views[name]}", file=sys.stderr)
+
+    results = {
+        "meta": {
+            "db": os.path.abspath(args.db),
+            "requests": args.requests,
+            "user_id": user_id,
+            "group_id": group_id,
+            "python": platform.python_version(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+        },
+        "views": views,
+    }
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Database engine configuration.
+
+Settings come from the app config, falling back to environment variables:
+
+    DATABASE_URL              SQLAlchemy URL (default: sqlite money_split.db)
+    DATABASE_READ_URL         optional replica for the read-only queries
+                              (see reads())
+    DB_POOL_SIZE              pooled connections per process (default 5)
+    DB_MAX_OVERFLOW           extra connections under load (default 10)
+    DB_POOL_TIMEOUT           seconds to wait for a connection (default 30)
+    DB_POOL_RECYCLE           seconds before a connection is replaced
+                              (default 1800)
+    SQLITE_BUSY_TIMEOUT_MS    wait this long on a locked database
+                              (default 5000)
+    SQLITE_CACHE_SIZE_KB      page cache per connection (default 65536)
+    SQLITE_MMAP_SIZE          bytes of the file to memory-map
+                              (default 268435456)
+    ASYNC_DATABASE_URL        URL for the asyncio engine of the ASGI views
+                              (default: DATABASE_URL with its async driver,
+                              aiosqlite or asyncpg)
+
+SQLite connections are switched to WAL, so readers never wait on a writer
+and writers wait `busy_timeout` instead of failing with "database is
+locked". Foreign keys are enforced, as on server databases, so deleting an
+expense cascades to its splits. Server databases get a sized pool with
+pre-ping, so connections dropped by the server are replaced instead of
+failing a request.
+
+Read-heavy queries whose results aren't cached (search, activity,
+analytics and the event log) run on the engine `reads()` names: a pooled
+replica given by DATABASE_READ_URL, or else the primary. Everything else
+reads the primary, so a page cached under a group's version never holds a
+replica's stale rows.
+
+A request that still loses a lock race (the busy timeout ran out, or the
+server gave up on a lock or a serializable transaction) gets a 503 with
+Retry-After instead of a bare 500, so clients know retrying is safe.
+"""
+import os
+import sqlite3
+
+from flask import jsonify, request
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import make_url
+
+from models import db
+
+# Postgres SQLSTATEs for lock timeouts, serialization failures and deadlocks
+RETRYABLE_PGCODES = {"55P03", "40001", "40P01"}
+
+# Seconds a client is asked to wait before retrying a lock timeout
+RETRY_AFTER = 1
+
+# asyncio drivers standing in for the sync ones, by backend
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+DEFAULTS = {
+    "DB_POOL_SIZE": 5,
+    "DB_MAX_OVERFLOW": 10,
+    "DB_POOL_TIMEOUT": 30,
+    "DB_POOL_RECYCLE": 1800,
+    "SQLITE_BUSY_TIMEOUT_MS": 5000,
+    "SQLITE_CACHE_SIZE_KB": 65536,
+    "SQLITE_MMAP_SIZE": 268435456,
+}
+
+
+def _setting(app, name):
+    value = app.config.get(name, os.environ.get(name))
+    return int(value) if value is not None else DEFAULTS[name]
+
+
+def _normalize_url(url):
+    # Many hosts still hand out the pre-SQLAlchemy-1.4 scheme
+    if url.startswith("postgres://"):
+        url = "postgresql://" + url[len("postgres://"):]
+    return url
+
+
+def engine_options(app, url):
+    """Engine keyword arguments suited to the database behind `url`"""
+    if make_url(url).get_backend_name() == "sqlite":
+        # Wait on locks in Python too, matching busy_timeout
+        timeout = _setting(app, "SQLITE_BUSY_TIMEOUT_MS") / 1000
+        return {"connect_args": {"timeout": timeout}}
+    return {
+        "pool_size": _setting(app, "DB_POOL_SIZE"),
+        "max_overflow": _setting(app, "DB_MAX_OVERFLOW"),
+        "pool_timeout": _setting(app, "DB_POOL_TIMEOUT"),
+        "pool_recycle": _setting(app, "DB_POOL_RECYCLE"),
+        "pool_pre_ping": True,
+    }
+
+
+def configure(app, default_url):
+    """Set the SQLAlchemy config keys; call before db.init_app(app)"""
+    url = _normalize_url(app.config.get(
+        "DATABASE_URL", os.environ.get("DATABASE_URL", default_url)))
+    app.config["SQLALCHEMY_DATABASE_URI"] = url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app, url)
+
+    read_url = app.config.get(
+        "DATABASE_READ_URL", os.environ.get("DATABASE_READ_URL"))
+    if read_url:
+        read_url = _normalize_url(read_url)
+        app.config["SQLALCHEMY_BINDS"] = {
+            "read": {"url": read_url, **engine_options(app, read_url)},
+        }
+
+
+def read_engine():
+    """The replica engine if one is configured, else the primary"""
+    return db.engines.get("read", db.engine)
+
+
+def reads():
+    """Bind arguments that run a read-only statement on read_engine():
+
+        db.session.scalars(query, bind_arguments=database.reads())
+    """
+    return {"bind": read_engine()}
+
+
+def is_lock_timeout(error):
+    """Whether a database error means "try again later" rather than a bug"""
+    original = getattr(error, "orig", None)
+    if isinstance(original, sqlite3.OperationalError):
+        return "database is locked" in str(original)
+    return getattr(original, "pgcode", None) in RETRYABLE_PGCODES
+
+
+def handle_lock_timeout(error):
+    if not is_lock_timeout(error):
+        raise error
+    db.session.rollback()
+    message = "The database is busy, please try again."
+    if request.blueprint == "api":
+        response = jsonify({"error": message})
+    else:
+        response = message
+    return response, 503, {"Retry-After": str(RETRY_AFTER)}
+
+
+def _sqlite_pragmas(app, engine):
+    """Run the SQLite settings below on each new connection of `engine`"""
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = [
+        "PRAGMA journal_mode=WAL",
+        f"PRAGMA busy_timeout={_setting(app, 'SQLITE_BUSY_TIMEOUT_MS')}",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA foreign_keys=ON",
+        f"PRAGMA cache_size=-{_setting(app, 'SQLITE_CACHE_SIZE_KB')}",
+        f"PRAGMA mmap_size={_setting(app, 'SQLITE_MMAP_SIZE')}",
+        "PRAGMA temp_store=MEMORY",
+    ]
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    event.listen(engine, "connect", set_sqlite_pragmas)
+
+
+def init_app(app):
+    """Install per-connection settings; call after db.init_app(app)"""
+    with app.app_context():
+        for engine in db.engines.values():
+            _sqlite_pragmas(app, engine)
+
+    app.register_error_handler(OperationalError, handle_lock_timeout)
+
+
+def async_engine(app):
+    """An asyncio engine on the app's database, set up like the sync one.
+
+    Needs the async driver installed (`pip install aiosqlite` or `asyncpg`,
+    plus `greenlet`).
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = app.config.get(
+        "ASYNC_DATABASE_URL", os.environ.get("ASYNC_DATABASE_URL"))
+    if url:
+        url = make_url(_normalize_url(url))
+    else:
+        url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+        backend = url.get_backend_name()
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    engine = create_async_engine(url, **engine_options(app, url))
+    _sqlite_pragmas(app, engine.sync_engine)
+    return engine
+
@@ -0,0 +1,139 @@
+"""History of every group's expenses, from the append-only event log.
+
+Every expense write appends an ExpenseEvent and, every
+`EVENT_SNAPSHOT_EVERY` events, a BalanceSnapshot of the group (see
+models.py). Nothing here rescans the expenses: balances as of a day, and
+the balances `flask rebuild-balances` checks the ledger against, start
+from the nearest snapshot and add up only the events after it.
+
+`flask compact-events` deletes the events, and the snapshots, behind a
+group's last snapshot older than `--keep-days`; history before that
+snapshot is gone, but every balance since can still be replayed.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+import json
+
+from models import db, BalanceSnapshot, Expense, ExpenseEvent, User
+
+DEFAULT_KEEP_DAYS = 365
+
+
+def balances_as_of(group_id, day):
+    """{(user_id, currency): balance} of a group as recorded by the end
+    of `day`: events count from when they were recorded, whatever date
+    their expense carries.
+
+    Raises LookupError if the group's history doesn't go back that far.
+    """
+    _, balances = BalanceSnapshot.replay(group_id, until=end_of(day))
+    return balances
+
+
+def end_of(day):
+    return datetime.combine(day, time.max)
+
+
+def by_member(balances):
+    """{(user_id, currency): balance} as {user_id: {currency: balance}}"""
+    members = {}
+    for (user_id, code), amount in balances.items():
+        members.setdefault(user_id, {})[code] = amount
+    return members
+
+
+def names_query(user_ids):
+    return db.select(User.id, User.name).where(User.id.in_(user_ids))
+
+
+def current_balances():
+    """{(group_id, user_id, currency): balance} of every group, replayed
+    from its latest snapshot; balances of zero are left out"""
+    latest = (
+        db.select(BalanceSnapshot.group_id,
+                  db.func.max(BalanceSnapshot.event_id).label("event_id"))
+        .group_by(BalanceSnapshot.group_id)
+        .subquery()
+    )
+    balances = defaultdict(int)
+    snapshots = (
+        db.select(BalanceSnapshot.group_id, BalanceSnapshot.balances)
+        .join(latest, db.and_(
+            latest.c.group_id == BalanceSnapshot.group_id,
+            latest.c.event_id == BalanceSnapshot.event_id))
+    )
+    for group_id, rows in db.session.execute(snapshots):
+        for user_id, code, amount in json.loads(rows):
+            balances[(group_id, user_id, code)] += amount
+
+    events = (
+        db.select(ExpenseEvent.group_id, ExpenseEvent.deltas)
+        .outerjoin(latest, latest.c.group_id == ExpenseEvent.group_id)
+        .where(ExpenseEvent.id > db.func.coalesce(latest.c.event_id, 0))
+    )
+    for group_id, deltas in db.session.execute(events):
+        for user_id, code, delta in json.loads(deltas):
+            balances[(group_id, user_id, code)] += delta
+    return {key: amount for key, amount in balances.items() if amount}
+
+
+def unlogged_groups():
+    """Ids of the groups with expenses but no snapshot or event to replay,
+    as in a database filled without the app (benchmarks.seed before it
+    wrote snapshots, or by hand)"""
+    logged = db.union(db.select(BalanceSnapshot.group_id),
+                      db.select(ExpenseEvent.group_id))
+    return set(db.session.scalars(
+        db.select(Expense.group_id)
+        .where(Expense.group_id.isnot(None),
+               Expense.group_id.not_in(logged))
+        .distinct()))
+
+
+def events_query(group_id, before=None, limit=50):
+    """One page of a group's events, newest first"""
+    query = db.select(ExpenseEvent).where(ExpenseEvent.group_id == group_id)
+    if before is not None:
+        query = query.where(ExpenseEvent.id < before)
+    return query.order_by(ExpenseEvent.id.desc()).limit(limit)
+
+
+def to_dict(event):
+    return {
+        "id": event.id,
+        "expense_id": event.expense_id,
+        "kind": event.kind,
+        "user_id": event.user_id,
+        "created_at": event.created_at.isoformat(),
+        "expense": json.loads(event.data),
+        "deltas": [
+            {"user_id": user_id, "currency": code, "amount": delta}
+            for user_id, code, delta in json.loads(event.deltas)
+        ],
+    }
+
+
+def compact(keep_days=DEFAULT_KEEP_DAYS, now=None):
+    """Delete what lies behind each group's last snapshot taken more than
+    `keep_days` ago: the events it already accounts for and the older
+    snapshots. Returns how many events and snapshots were deleted.
+    """
+    cutoff = (now or datetime.now()) - timedelta(days=keep_days)
+    kept = (
+        db.select(BalanceSnapshot.group_id,
+                  db.func.max(BalanceSnapshot.event_id).label("event_id"))
+        .where(BalanceSnapshot.taken_at < cutoff)
+        .group_by(BalanceSnapshot.group_id)
+        .subquery()
+    )
+    behind = db.select(kept.c.event_id).where(
+        kept.c.group_id == ExpenseEvent.group_id).scalar_subquery()
+    events = db.session.execute(
+        db.delete(ExpenseEvent).where(ExpenseEvent.id <= behind)).rowcount
+    behind = db.select(kept.c.event_id).where(
+        kept.c.group_id == BalanceSnapshot.group_id).scalar_subquery()
+    snapshots = db.session.execute(
+        db.delete(BalanceSnapshot).where(
+            BalanceSnapshot.event_id < behind)).rowcount
+    db.session.commit()
+    return events, snapshots
@@ -0,0 +1,124 @@
+"""Streaming CSV and JSON export of group and user ledgers.
+
+Rows are read with `yield_per`, so the database cursor is consumed in
+chunks, and every generator yields text as it goes; memory use stays flat
+no matter how large the ledger is. An optional `progress` callback is
+called with the number of rows written so far after every chunk. Group
+exports use the same columns as the importer, so an exported file can be
+imported into another group.
+"""
+import csv
+import io
+import itertools
+import json
+
+from helper import to_major
+from models import db, Expense, ExpenseSplit, User
+
+CHUNK_SIZE = 1000
+
+GROUP_COLUMNS = ["description", "amount", "currency", "paid_by", "splits",
+                 "date", "kind"]
+HISTORY_COLUMNS = ["date", "description", "group", "counterparty", "amount",
+                   "currency", "kind"]
+
+
+def _group_ledger(group_id):
+    """Each expense of a group with its {username: amount} splits"""
+    payer = db.aliased(User)
+    debtor = db.aliased(User)
+    rows = (
+        db.session.query(
+            Expense.id, Expense.description, Expense.amount,
+            Expense.currency, Expense.timestamp, Expense.kind,
+            payer.username, debtor.username, ExpenseSplit.amount,
+        )
+        .join(payer, payer.id == Expense.paid_by_id)
+        .outerjoin(ExpenseSplit, ExpenseSplit.expense_id == Expense.id)
+        .outerjoin(debtor, debtor.id == ExpenseSplit.user_id)
+        .filter(Expense.group_id == group_id)
+        .order_by(Expense.timestamp, Expense.id)
+        .yield_per(CHUNK_SIZE)
+    )
+    for _, splits in itertools.groupby(rows, key=lambda row: row[0]):
+        splits = list(splits)
+        _, description, amount, code, timestamp, kind, paid_by = \
+            splits[0][:7]
+        yield {
+            "description": description,
+            "amount": str(to_major(amount, code)),
+            "currency": code,
+            "paid_by": paid_by,
+            "splits": {
+                username: str(to_major(share, code))
+                for *_, username, share in splits if username
+            },
+            "date": timestamp.isoformat() if timestamp else None,
+            "kind": kind,
+        }
+
+
+def _csv_lines(columns, rows, progress=None):
+    """Encode rows as CSV text, yielding one chunk per CHUNK_SIZE rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    i = 0
+    for i, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if i % CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if progress:
+                progress(i)
+    yield buffer.getvalue()
+    if progress:
+        progress(i)
+
+
+def group_csv(group_id, progress=None):
+    rows = (
+        [
+            expense["description"],
+            expense["amount"],
+            expense["currency"],
+            expense["paid_by"],
+            json.dumps(expense["splits"]),
+            expense["date"],
+            expense["kind"],
+        ]
+        for expense in _group_ledger(group_id)
+    )
+    return _csv_lines(GROUP_COLUMNS, rows, progress)
+
+
+def group_json(group_id, progress=None):
+    """Stream the group ledger as one JSON array"""
+    yield "["
+    i = 0
+    for i, expense in enumerate(_group_ledger(group_id), start=1):
+        yield ("," if i > 1 else "") + "\n" + json.dumps(expense)
+        if progress and i % CHUNK_SIZE == 0:
+            progress(i)
+    yield "\n]\n"
+    if progress:
+        progress(i)
+
+
+def history_csv(user_id, progress=None):
+    rows = (
+        [
+            row.timestamp.isoformat() if row.timestamp else None,
+            row.description,
+            row.group_name or "Personal",
+            row.counterparty_name,
+            str(to_major(row.owed_amount, row.currency)),
+            row.currency,
+            row.kind,
+        ]
+        for row in db.session.execute(
+            ExpenseSplit.activity_query(user_id)
+            .execution_options(yield_per=CHUNK_SIZE))
+    )
+    return _csv_lines(HISTORY_COLUMNS, rows, progress)
@@ -0,0 +1,169 @@
+"""Cached expense-list fragments and conditional GETs for ledger pages.
+
+A group's rendered expense list depends only on its ledger, the page being
+shown and who is looking (the "you owe" badges). Every write to a ledger
+bumps `Group.version`, so fragments are cached under
+(group, version, viewer, page) and never need invalidating: a write makes
+the old keys unreachable and the LRU ages them out. The pages around them
+show balances converted at the current exchange rates, so page keys also
+carry the viewer's currency and when rates were last loaded (see fx.py).
+
+    FRAGMENT_CACHE_SIZE   fragments kept per process (default 1000, 0 to
+                          disable caching)
+    FRAGMENT_CACHE_URL    optional Redis URL (`pip install redis`) to share
+                          fragments between processes instead
+    FRAGMENT_CACHE_TTL    seconds a shared fragment lives (default 3600)
+
+The same key, plus a digest of the templates involved, makes the pages'
+ETag, so browsers revalidate and get a 304 when nothing changed.
+"""
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+import os
+
+from flask import current_app, make_response, request, session
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+
+import fx
+
+DEFAULTS = {
+    "FRAGMENT_CACHE_SIZE": 1000,
+    "FRAGMENT_CACHE_TTL": 3600,
+}
+
+# Templates whose output the cache keys and ETags stand for
+TEMPLATES = ["layout.html", "group.html", "friend.html", "expense_list.html"]
+
+
+class LocalCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            html = self._cache.get(key)
+            if html is not None:
+                self._cache.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._cache[key] = html
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+
+class RedisCache:
+    def __init__(self, url, ttl):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        html = self.client.get(key)
+        return html.decode() if html is not None else None
+
+    def set(self, key, html):
+        self.client.set(key, html, ex=self.ttl)
+
+
+def _setting(app, name):
+    return int(app.config.get(name, os.environ.get(name, DEFAULTS[name])))
+
+
+def _template_digest(app):
+    digest = sha1()
+    for name in TEMPLATES:
+        source, _, _ = app.jinja_loader.get_source(app.jinja_env, name)
+        digest.update(source.encode())
+    return digest.hexdigest()[:12]
+
+
+def init_app(app):
+    """Pick the fragment store from config or environment"""
+    url = app.config.get(
+        "FRAGMENT_CACHE_URL", os.environ.get("FRAGMENT_CACHE_URL"))
+    if url:
+        cache = RedisCache(url, _setting(app, "FRAGMENT_CACHE_TTL"))
+    else:
+        cache = LocalCache(_setting(app, "FRAGMENT_CACHE_SIZE"))
+    app.extensions["fragments"] = cache
+    app.extensions["fragments_digest"] = _template_digest(app)
+
+
+def page_key(group):
+    """Identifies everything a ledger page's content depends on"""
+    return ":".join(str(part) for part in (
+        current_app.extensions["fragments_digest"],
+        group.id,
+        group.version,
+        session["user_id"],
+        fx.converter().key(),
+        request.args.get("before", ""),
+        request.args.get("limit", ""),
+    ))
+
+
+def lookup(group):
+    """The group's cached expense-list fragment, or None"""
+    html = current_app.extensions["fragments"].get(
+        "fragment:" + page_key(group))
+    return Markup(html) if html is not None else None
+
+
+def store(group, html):
+    current_app.extensions["fragments"].set(
+        "fragment:" + page_key(group), str(html))
+    return Markup(html)
+
+
+def cached(group, render):
+    """The group's expense-list fragment, rendered by `render` on a miss"""
+    html = lookup(group)
+    if html is None:
+        html = store(group, render())
+    return html
+
+
+def etag(group):
+    return sha1(page_key(group).encode()).hexdigest()
+
+
+def not_modified(group):
+    """A 304 response if the browser's copy of the page is current, else None.
+
+    Pages carrying flashed messages are one-offs: they are always rendered
+    and sent without validators, so they are never revalidated later.
+    """
+    if "_flashes" in session or is_resource_modified(
+            request.environ, etag=etag(group),
+            last_modified=group.updated_at):
+        return None
+    return add_validators(current_app.response_class(status=304), group)
+
+
+def add_validators(response, group):
+    response.set_etag(etag(group))
+    if group.updated_at is not None:
+        response.last_modified = group.updated_at
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional_page(group, render):
+    """A ledger page from `render`, or a 304 if the browser's copy is
+    current"""
+    if "_flashes" in session:
+        return render()
+    response = not_modified(group)
+    if response is None:
+        response = add_validators(make_response(render()), group)
+    return response
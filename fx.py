@@ -0,0 +1,295 @@
+"""Exchange rates, and converting amounts between currencies.
+
+Expenses stay in the currency they were paid in, and balances, rollups
+and debts are kept per currency; amounts are only converted to be shown,
+into the viewer's currency (User.currency, or DEFAULT_CURRENCY).
+
+Rates are loaded into `fx_rates` from CSV files (`flask import-rates`),
+one row per currency and day: how many units of the currency one unit of
+the base currency (`FX_BASE_CURRENCY`, by default DEFAULT_CURRENCY)
+bought that day. Amounts convert through the base currency, at each
+currency's latest rate on or before the day asked for (today).
+
+    date,currency,rate
+    2026-10-16,EUR,0.9184
+    2026-10-16,INR,84.07
+
+A conversion without a rate for its day raises MissingRate, which
+`init_app` turns into a 404 from the API and a message on the profile
+page elsewhere.
+
+Rates are cached per process for `TTL` seconds. A request converts
+through one `Converter`: views hand it every currency on the page up
+front, it takes what it can from the cache and reads the rest in one
+query, and each conversion after that is arithmetic. Cached rates are
+keyed on when rates were last loaded, so an import is picked up
+everywhere within `TTL`, and pages keyed on `Converter.key()` change
+with it.
+"""
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from threading import Lock
+import csv
+import os
+import time
+
+from flask import current_app, flash, g, jsonify, redirect, request
+from flask import session
+
+from helper import default_currency, minor_digits
+from models import db, FxRate
+
+TTL = 300
+MAX_ENTRIES = 10000
+
+# Rate rows written per statement when importing
+BATCH_SIZE = 1000
+
+_cache = OrderedDict()
+_lock = Lock()
+_MISSING = object()
+
+
+class MissingRate(LookupError):
+    pass
+
+
+def _cached(key):
+    """The cached value under `key`, or _MISSING if missing or expired"""
+    with _lock:
+        entry = _cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            _cache.move_to_end(key)
+            return entry[1]
+    return _MISSING
+
+
+def _remember(key, value):
+    with _lock:
+        _cache[key] = (time.monotonic() + TTL, value)
+        _cache.move_to_end(key)
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+
+
+def base_currency():
+    return (current_app.config.get("FX_BASE_CURRENCY")
+            or os.environ.get("FX_BASE_CURRENCY")
+            or default_currency()).upper()
+
+
+def viewer_currency():
+    """The currency the logged-in user sees balances in"""
+    return session.get("currency") or default_currency()
+
+
+class Converter:
+    """Converts minor units of any currency into `target`, at the rates
+    of `day`"""
+
+    def __init__(self, target, day=None):
+        self.target = target.upper()
+        self.day = day or date.today()
+        self.base = base_currency()
+        self.stamp = _MISSING
+        self.rates = {self.base: Decimal(1)}
+
+    # needs_stamp, set_stamp, pending and learn are the steps of load(),
+    # for callers that run its two queries themselves (see asgi.py)
+
+    def needs_stamp(self):
+        if self.stamp is _MISSING:
+            self.stamp = _cached("stamp")
+        return self.stamp is _MISSING
+
+    def set_stamp(self, imported_at):
+        """Take in the result of FxRate.stamp_query"""
+        self.stamp = imported_at.isoformat() if imported_at else ""
+        _remember("stamp", self.stamp)
+
+    def pending(self, currencies):
+        """Of `currencies` and the target, those whose rate has to be read
+        from the database; the others are taken from the cache"""
+        pending = set()
+        for code in {*currencies, self.target} - self.rates.keys():
+            rate = _cached(("rate", self.stamp, self.day, code))
+            if rate is _MISSING:
+                pending.add(code)
+            else:
+                self.rates[code] = rate
+        return pending
+
+    def learn(self, pending, rows):
+        """Take in the (currency, rate) rows of FxRate.latest_query"""
+        found = {code: rate for code, rate in rows}
+        for code in pending:
+            rate = found.get(code)
+            _remember(("rate", self.stamp, self.day, code), rate)
+            self.rates[code] = rate
+
+    def load(self, currencies=()):
+        """Have the rates of `currencies` at hand, reading the ones the
+        cache doesn't have with one query"""
+        if self.needs_stamp():
+            self.set_stamp(db.session.scalar(FxRate.stamp_query()))
+        pending = self.pending(currencies)
+        if pending:
+            self.learn(pending, db.session.execute(
+                FxRate.latest_query(pending, self.day)))
+        return self
+
+    def key(self):
+        """What converted amounts depend on, for cache keys and ETags"""
+        if self.stamp is _MISSING:
+            self.load()
+        return f"{self.target}:{self.day}:{self.stamp}"
+
+    def rate(self, code):
+        if code not in self.rates:
+            self.load([code])
+        rate = self.rates[code]
+        if rate is None:
+            raise MissingRate(f"No exchange rate for {code} on {self.day}.")
+        return rate
+
+    def convert(self, amount, code):
+        """`amount` minor units of `code` in minor units of the target"""
+        if code == self.target or not amount:
+            return amount
+        major = (Decimal(amount).scaleb(-minor_digits(code))
+                 * self.rate(self.target) / self.rate(code))
+        return int(major.scaleb(minor_digits(self.target))
+                   .quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+    def total(self, amounts):
+        """{currency: amount} as one amount in the target currency"""
+        self.load(amounts)
+        return sum(self.convert(amount, code)
+                   for code, amount in amounts.items())
+
+    def totals(self, amounts):
+        """A total of each of several {currency: amount}, with every rate
+        they need read at once"""
+        amounts = list(amounts)
+        self.load({code for each in amounts for code in each})
+        return [self.total(each) for each in amounts]
+
+
+def handle_missing_rate(error):
+    """A conversion the rates can't make: the API's error, or back to the
+    profile page (which converts nothing) to pick another currency"""
+    if request.blueprint == "api":
+        return jsonify({"error": str(error)}), 404
+    flash(f"{error} Choose another currency, or import its rates.",
+          "danger")
+    return redirect("/profile")
+
+
+def init_app(app):
+    app.register_error_handler(MissingRate, handle_missing_rate)
+
+
+def converter():
+    """The request's Converter, into the viewer's currency"""
+    if "fx_converter" not in g:
+        g.fx_converter = Converter(viewer_currency())
+    return g.fx_converter
+
+
+def currencies():
+    """Currencies amounts can be entered in: the base currency and every
+    one with a rate"""
+    rates = Converter(base_currency()).load()
+    codes = cached_currencies(rates)
+    if codes is None:
+        codes = learn_currencies(rates, db.session.scalars(
+            FxRate.currencies_query(rates.day)))
+    return codes
+
+
+# cached_currencies and learn_currencies are the steps of currencies(),
+# for callers that run its query themselves (see asgi.py)
+
+def cached_currencies(rates):
+    """currencies() from the cache, or None; `rates` is a loaded
+    Converter into the base currency"""
+    codes = _cached(("currencies", rates.stamp, rates.day))
+    return None if codes is _MISSING else codes
+
+
+def learn_currencies(rates, codes):
+    """Take in the result of FxRate.currencies_query"""
+    codes = sorted({rates.base, *codes})
+    _remember(("currencies", rates.stamp, rates.day), codes)
+    return codes
+
+
+def read_rates(stream):
+    """Yield (line number, record) from a CSV file of rates"""
+    reader = csv.DictReader(stream)
+    for record in reader:
+        yield reader.line_num, record
+
+
+def _validate(record, base):
+    """An fx_rates row for a record, or ValueError"""
+    try:
+        day = date.fromisoformat(str(record.get("date") or "").strip())
+    except ValueError:
+        raise ValueError(f"Invalid date: {record.get('date')!r}")
+
+    code = str(record.get("currency") or "").strip().upper()
+    if len(code) != 3 or not code.isalpha():
+        raise ValueError(f"Invalid currency: {record.get('currency')!r}")
+
+    try:
+        rate = Decimal(str(record.get("rate")).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid rate: {record.get('rate')!r}")
+    if not rate.is_finite() or rate <= 0:
+        raise ValueError(f"Invalid rate: {record.get('rate')!r}")
+    if code == base and rate != 1:
+        raise ValueError(f"{base} is the base currency; its rate is 1.")
+    return {"currency": code, "day": day, "rate": rate}
+
+
+def import_rates(records, batch_size=BATCH_SIZE):
+    """Load (line number, record) pairs into fx_rates, a batch at a time.
+
+    Rates already there for the same currency and day are replaced.
+    Returns the number of rates loaded and (line, message) for every
+    record skipped.
+    """
+    base = base_currency()
+    loaded, errors, batch = 0, [], {}
+    for line, record in records:
+        try:
+            row = _validate(record, base)
+        except ValueError as error:
+            errors.append((line, str(error)))
+            continue
+        if row["currency"] != base:
+            batch[(row["currency"], row["day"])] = row
+        if len(batch) >= batch_size:
+            loaded += _write(batch)
+            batch = {}
+    if batch:
+        loaded += _write(batch)
+    clear()
+    return loaded, errors
+
+
+def _write(batch):
+    imported_at = datetime.now()
+    db.session.execute(db.delete(FxRate).where(
+        db.tuple_(FxRate.currency, FxRate.day).in_(list(batch))))
+    db.session.execute(db.insert(FxRate), [
+        {**row, "imported_at": imported_at} for row in batch.values()])
+    db.session.commit()
+    return len(batch)
@@ -1,4 +1,8 @@
-from functools import wraps
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from functools import lru_cache, wraps
+import heapq
+import unicodedata
 from flask import redirect, session, flash, current_app
 
 
@@ -12,16 +16,163 @@ def login_required(f):
     return decorated_function
 
 
+def encode_cursor(timestamp, row_id):
+    """Keyset pagination cursor for a (timestamp, id) position"""
+    return f"{timestamp.isoformat()}_{row_id}"
+
+
+def decode_cursor(cursor):
+    """Parse a cursor from encode_cursor, or None if missing/invalid"""
+    if not cursor:
+        return None
+    try:
+        timestamp, row_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except ValueError:
+        return None
+
+
+def page_size(requested, default=50, maximum=200):
+    """Clamp a user-supplied page size to [1, maximum]"""
+    if not requested or requested < 1:
+        return default
+    return min(requested, maximum)
+
+
+def normalize_term(text):
+    """Lowercase and strip accents, so typing zoe finds Zoë"""
+    decomposed = unicodedata.normalize("NFKD", text.strip().lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def search_terms(username, name):
+    """What a user can be found by: the username and each word of the name"""
+    return {normalize_term(word)
+            for word in [username, *name.split()] if word.strip()}
+
+
+def prefix_bounds(prefix):
+    """[low, high) range of the strings that start with `prefix`.
+
+    A range rather than LIKE 'prefix%', so any index on the column is used
+    whatever the database's LIKE rules.
+    """
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def simplify_debts(balances):
+    """Greedy minimum-transfer plan for a set of net balances.
+
+    `balances` maps user_id -> net balance in cents (positive: is owed).
+    Repeatedly matches the largest debtor with the largest creditor, which
+    settles at least one of them per step, so the plan has at most n - 1
+    transfers and takes O(n log n). Returns (from_id, to_id, cents) tuples.
+    """
+    creditors = [(-cents, uid) for uid, cents in balances.items() if cents > 0]
+    debtors = [(cents, uid) for uid, cents in balances.items() if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        cents = min(-credit, -debt)
+        transfers.append((debtor, creditor, cents))
+        if -credit > cents:
+            heapq.heappush(creditors, (credit + cents, creditor))
+        if -debt > cents:
+            heapq.heappush(debtors, (debt + cents, debtor))
+    return transfers
+
+
+# Digits after the decimal point, for currencies that don't use cents
+MINOR_DIGITS = {
+    "JPY": 0,
+}
+
+# Currencies shown with a symbol; any other is shown with its code
+CURRENCY_SYMBOLS = {
+    "USD": "$",
+    "EUR": "€",
+    "INR": "₹",
+    "GBP": "£",
+    "JPY": "¥",
+}
+
+
+# Amounts are stored as signed 64-bit integers of minor units
+MIN_MINOR = -2 ** 63
+MAX_MINOR = 2 ** 63 - 1
+
+
+def default_currency():
+    return current_app.config.get("DEFAULT_CURRENCY", "USD").upper()
+
+
+def _currency_code(currency_code=None):
+    return (currency_code or default_currency()).upper()
+
+
+def minor_digits(currency_code=None):
+    return MINOR_DIGITS.get(_currency_code(currency_code), 2)
+
+
+def to_minor(value, currency_code=None):
+    """Parse a decimal amount (e.g. "12.5") into integer minor units (1250)"""
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value!r}")
+    if not amount.is_finite():
+        raise ValueError(f"Invalid amount: {value!r}")
+    try:
+        minor = int(amount.scaleb(minor_digits(currency_code))
+                    .quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except InvalidOperation:
+        raise ValueError(f"Amount too large: {value!r}")
+    if not MIN_MINOR <= minor <= MAX_MINOR:
+        raise ValueError(f"Amount too large: {value!r}")
+    return minor
+
+
+def to_major(amount, currency_code=None):
+    """Integer minor units back to an exact Decimal (1250 -> 12.50)"""
+    return Decimal(int(amount)).scaleb(-minor_digits(currency_code))
+
+
+def allocate(total, weights):
+    """Split an integer total in proportion to weights, exactly.
+
+    Uses the largest remainder method: every share is floored, then the
+    leftover units go one each to the largest remainders (earlier entries
+    win ties), so the shares always add up to `total`.
+    """
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        raise ValueError("Weights must add up to a positive number")
+    shares = [total * w // weight_sum for w in weights]
+    remainders = [total * w % weight_sum for w in weights]
+    leftover = total - sum(shares)
+    by_remainder = sorted(
+        range(len(weights)), key=lambda i: remainders[i], reverse=True)
+    for i in by_remainder[:leftover]:
+        shares[i] += 1
+    return shares
+
+
+@lru_cache(maxsize=None)
+def _formatter(currency_code):
+    """A function formatting minor units of one currency, built once"""
+    symbol = CURRENCY_SYMBOLS.get(currency_code, currency_code + " ")
+    digits = minor_digits(currency_code)
+    spec = f",.{digits}f"
+
+    def formatter(amount):
+        return symbol + format(Decimal(int(amount)).scaleb(-digits), spec)
+    return formatter
+
+
 def currency(amount, currency_code=None):
-    symbols = {
-        "USD": "$",
-        "EUR": "€",
-        "INR": "₹",
-        "GBP": "£",
-        "JPY": "¥",
-    }
-    currency_code = (currency_code or 
-                     current_app.config.get("DEFAULT_CURRENCY", "USD")).upper()
-    symbol = symbols.get(currency_code, "")
-  
-    return f"{symbol}{amount:,.2f}"
+    """Format an amount in integer minor units, e.g. 1250 -> $12.50"""
+    return _formatter(_currency_code(currency_code))(amount)
@@ -0,0 +1,302 @@
+"""Bulk import of expenses from CSV, JSON Lines or JSON files.
+
+Records are parsed one line at a time and written in batches: each batch
+resolves its usernames with one query, inserts all of its expenses and then
+all of its splits with single executemany INSERTs, and commits. Invalid rows
+are reported and skipped without aborting the import.
+
+CSV files need a header row with `description`, `amount` and `paid_by`
+columns, plus optional `currency` (DEFAULT_CURRENCY if blank), `splits`,
+`date` (ISO 8601) and `kind` ("expense", the default, or "settlement", as
+the export writes). `splits` is a JSON object of username -> amount, as
+the export writes it, or "alice:12.50;bob:7.50" if no username has a
+semicolon in it. JSON Lines files hold one object per line with the same
+keys, where `splits` is an object too; .json files hold an array of them,
+as the JSON export writes, and are decoded one object at a time too. Rows
+without splits are split evenly among all group members.
+"""
+import csv
+import itertools
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from helper import allocate, default_currency, to_minor
+from models import db, Balance, Expense, ExpenseEvent, ExpenseSplit, Group
+from models import GroupMember, MonthlySpend, User
+import fx
+
+BATCH_SIZE = 1000
+
+# Longest a record of a JSON array may be, in characters
+MAX_RECORD_SIZE = 1 << 20
+
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.expense_ids = []
+        self.errors = []
+
+    def add_error(self, line, message):
+        self.errors.append((line, message))
+
+
+def read_csv(stream):
+    """Yield (line number, record) from a CSV file"""
+    reader = csv.DictReader(stream)
+    for record in reader:
+        record["splits"] = _csv_splits(record.get("splits"))
+        yield reader.line_num, record
+
+
+def _csv_splits(cell):
+    """{username: amount} from a CSV `splits` cell; a cell that isn't
+    valid JSON is left for _validate to reject"""
+    cell = (cell or "").strip()
+    if cell.startswith("{"):
+        try:
+            return json.loads(cell)
+        except ValueError:
+            return cell
+    splits = {}
+    for part in filter(None, cell.split(";")):
+        # Amounts have no colons; usernames may
+        username, _, amount = part.rpartition(":")
+        splits[username.strip()] = amount
+    return splits
+
+
+def read_jsonl(stream):
+    """Yield (line number, record) from a JSON Lines file"""
+    for line_num, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, dict):
+            yield line_num, None
+            continue
+        yield line_num, record
+
+
+def read_json(stream):
+    """Yield (line number, record) from a JSON array, like the app's own
+    export, decoding one element at a time; a file that isn't an array
+    is read as JSON Lines"""
+    lines = []
+    for line in stream:
+        lines.append(line)
+        if line.strip():
+            break
+    if not lines or not lines[-1].lstrip().startswith("["):
+        yield from read_jsonl(itertools.chain(lines, stream))
+        return
+
+    decoder = json.JSONDecoder()
+    line_num = len(lines)
+    # What's left to decode, starting on line `line_num`
+    buffer = lines[-1].lstrip()[1:]
+    first, expect_value = True, True
+    while True:
+        while not buffer.strip():
+            line_num += buffer.count("\n")
+            buffer = stream.readline()
+            if not buffer:
+                yield line_num, None
+                return
+        stripped = buffer.lstrip()
+        line_num += buffer.count("\n", 0, len(buffer) - len(stripped))
+        buffer = stripped
+
+        if buffer[0] == "]" and (first or not expect_value):
+            return
+        if not expect_value:
+            if buffer[0] != ",":
+                yield line_num, None
+                return
+            buffer, expect_value = buffer[1:], True
+            continue
+
+        # An element may span lines: read on until it decodes
+        while True:
+            try:
+                record, end = decoder.raw_decode(buffer)
+                break
+            except ValueError:
+                more = stream.readline()
+                if not more or len(buffer) > MAX_RECORD_SIZE:
+                    yield line_num, None
+                    return
+                buffer += more
+        yield line_num, record
+        line_num += buffer.count("\n", 0, end)
+        buffer = buffer[end:]
+        first, expect_value = False, False
+
+
+READERS = {
+    "csv": read_csv,
+    "jsonl": read_jsonl,
+    "json": read_json,
+}
+
+
+def import_expenses(group, records, batch_size=BATCH_SIZE, progress=None,
+                    user_id=None):
+    """Import (line number, record) pairs into a group.
+
+    `progress`, if given, is called with the number of records read so far
+    after every committed batch. `user_id` is who is importing, for the
+    event log; None for commands.
+    """
+    result = ImportResult()
+    currencies = set(fx.currencies())
+    member_ids = [
+        user_id for (user_id,) in
+        db.session.query(GroupMember.user_id)
+        .filter_by(group_id=group.id)
+        .order_by(GroupMember.user_id)
+    ]
+
+    batch = []
+    read = 0
+    for line, record in records:
+        batch.append((line, record))
+        read += 1
+        if len(batch) >= batch_size:
+            _import_batch(group, member_ids, currencies, batch, result,
+                          user_id)
+            batch = []
+            if progress:
+                progress(read)
+    if batch:
+        _import_batch(group, member_ids, currencies, batch, result, user_id)
+        if progress:
+            progress(read)
+    return result
+
+
+def _import_batch(group, member_ids, currencies, batch, result, by_user_id):
+    usernames = set()
+    for _, record in batch:
+        if not isinstance(record, dict):
+            continue
+        if isinstance(record.get("paid_by"), str):
+            usernames.add(record["paid_by"])
+        if isinstance(record.get("splits"), dict):
+            usernames.update(record["splits"])
+    user_ids = dict(
+        db.session.query(User.username, User.id)
+        .join(GroupMember, GroupMember.user_id == User.id)
+        .filter(GroupMember.group_id == group.id,
+                User.username.in_(usernames))
+    )
+
+    expenses, shares = [], []
+    for line, record in batch:
+        try:
+            expense, split = _validate(
+                record, user_ids, member_ids, currencies)
+        except ValueError as error:
+            result.add_error(line, str(error))
+            continue
+        expense["group_id"] = group.id
+        expenses.append(expense)
+        shares.append(split)
+
+    if not expenses:
+        return
+
+    Group.bump_version(group.id)
+    ids = db.session.scalars(
+        db.insert(Expense).returning(
+            Expense.id, sort_by_parameter_order=True),
+        expenses,
+    ).all()
+
+    splits, changes = [], []
+    deltas = defaultdict(int)
+    spend = defaultdict(lambda: [0, 0, 0])
+    for expense_id, expense, split in zip(ids, expenses, shares):
+        payer_id, code = expense["paid_by_id"], expense["currency"]
+        own = defaultdict(int)
+        own[(payer_id, code)] += expense["amount"]
+        for user_id, amount in split.items():
+            splits.append(
+                {"expense_id": expense_id, "user_id": user_id,
+                 "amount": amount})
+            own[(user_id, code)] -= amount
+        for key, delta in own.items():
+            deltas[key] += delta
+        for key, values in Expense.spend_of(expense, split.items()).items():
+            spend[key] = [a + b for a, b in zip(spend[key], values)]
+        changes.append(ExpenseEvent.change(
+            ExpenseEvent.CREATED, {**expense, "id": expense_id},
+            split.items(), own))
+    db.session.execute(db.insert(ExpenseSplit), splits)
+    Balance.apply(group.id, deltas)
+    MonthlySpend.apply(group.id, spend)
+    ExpenseEvent.record(group.id, changes, user_id=by_user_id)
+    db.session.commit()
+    result.imported += len(expenses)
+    result.expense_ids.extend(ids)
+
+
+def _validate(record, user_ids, member_ids, currencies):
+    """Expense row and {user_id: share} for a record, or ValueError"""
+    if not isinstance(record, dict):
+        raise ValueError("Not a valid record.")
+
+    description = str(record.get("description") or "").strip()
+    if not description:
+        raise ValueError("Missing description.")
+
+    code = str(record.get("currency") or default_currency()).upper()
+    if code not in currencies:
+        raise ValueError(f"No exchange rates for {code!r}.")
+
+    amount = to_minor(record.get("amount"), code)
+    if amount <= 0:
+        raise ValueError("Amount must be positive.")
+
+    kind = str(record.get("kind") or Expense.EXPENSE).lower()
+    if kind not in Expense.KINDS:
+        raise ValueError(f"Unknown kind {kind!r}.")
+
+    payer = record.get("paid_by")
+    if not isinstance(payer, str) or payer not in user_ids:
+        raise ValueError(f"Payer {payer!r} is not a group member.")
+
+    timestamp = datetime.now()
+    if record.get("date"):
+        timestamp = datetime.fromisoformat(str(record["date"]))
+
+    shares = record.get("splits") or {}
+    if not isinstance(shares, dict):
+        raise ValueError("Splits must map usernames to amounts.")
+
+    splits = {}
+    for username, share in shares.items():
+        if username not in user_ids:
+            raise ValueError(f"User {username!r} is not a group member.")
+        share = to_minor(share, code)
+        if share > 0:
+            splits[user_ids[username]] = share
+    if not shares:
+        even = allocate(amount, [1] * len(member_ids))
+        splits = dict(zip(member_ids, even))
+    if sum(splits.values()) != amount:
+        raise ValueError("Split amounts must add up to the total expense.")
+
+    expense = {
+        "description": description[:120],
+        "amount": amount,
+        "currency": code,
+        "paid_by_id": user_ids[payer],
+        "timestamp": timestamp,
+        "kind": kind,
+    }
+    return expense, splits
@@ -0,0 +1,321 @@
+"""Background jobs, persisted in the `jobs` table.
+
+Request handlers `enqueue` work and return at once; a pool of worker
+threads picks jobs up from the table, runs them in an app context and
+records progress, results and errors back on the row, where `/jobs/<id>`
+reads them. The pool runs inside each web process (`JOB_WORKERS` threads,
+started by the first job a request queues) and/or in a separate process
+started with `flask worker`; set `JOB_WORKERS=0` to leave all the work to
+the latter.
+
+A job that raises is retried, with exponential backoff, up to
+`JOB_MAX_ATTEMPTS` times. A job whose worker died (no progress reported
+for `JOB_LEASE` seconds) is picked up again by another worker.
+
+    @jobs.task("rebuild_balances")
+    def rebuild(job, group_id):
+        job.report(done, total)     # progress, also renews the lease
+        return {"rebuilt": done}    # stored as the job's result
+
+Results and payloads are JSON. Files a job writes go in `jobs.files_dir()`
+and are deleted along with jobs older than `JOB_RETENTION_DAYS`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+import json
+import os
+import shutil
+import socket
+import time
+import traceback
+
+from flask import current_app, has_request_context
+
+from models import db
+
+DEFAULTS = {
+    "JOB_WORKERS": 2,
+    "JOB_MAX_ATTEMPTS": 3,
+    "JOB_LEASE": 300,
+    "JOB_POLL_INTERVAL": 2,
+    "JOB_RETENTION_DAYS": 7,
+}
+
+# Seconds before the first retry; doubles with every attempt
+RETRY_DELAY = 10
+
+_tasks = {}
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+    __table_args__ = (
+        db.Index("ix_jobs_status_run_after", "status", "run_after"),
+    )
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default="{}")
+    # Who may see the job; None for jobs queued from the command line
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
+    status = db.Column(db.String(20), nullable=False, default=QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    worker = db.Column(db.String(100))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    # Renewed by progress reports; a stale lease means the worker died
+    leased_until = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "total": self.total,
+            "attempts": self.attempts,
+            "result": json.loads(self.result) if self.result else None,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "finished_at": (self.finished_at.isoformat()
+                            if self.finished_at else None),
+        }
+
+    @property
+    def finished(self):
+        return self.status in (Job.DONE, Job.FAILED)
+
+
+class Context:
+    """What a running task sees of its job.
+
+    `progress` is what an earlier, failed attempt got to, so tasks that
+    commit as they go can resume where it stopped. `user_id` is who queued
+    the job, None from the command line.
+    """
+
+    def __init__(self, job_id, lease, progress=0, user_id=None):
+        self.id = job_id
+        self.lease = lease
+        self.progress = progress
+        self.user_id = user_id
+
+    def report(self, done, total=None):
+        """Record progress; committed at once so status polls see it"""
+        values = {
+            "progress": done,
+            "leased_until": datetime.now() + timedelta(seconds=self.lease),
+        }
+        if total is not None:
+            values["total"] = total
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(Job).where(Job.id == self.id).values(**values))
+
+    def path(self, name):
+        return job_path(self.id, name)
+
+
+def task(kind):
+    """Register a function as the handler of jobs of this kind"""
+    def register(function):
+        _tasks[kind] = function
+        return function
+    return register
+
+
+def files_dir():
+    return current_app.config.get(
+        "JOB_FILES_DIR", os.path.join(current_app.instance_path, "jobs"))
+
+
+def job_path(job_id, name):
+    """A file of a job's, in its own directory under files_dir()"""
+    directory = os.path.join(files_dir(), str(job_id))
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, os.path.basename(name))
+
+
+def _setting(app, name):
+    return int(app.config.get(name, os.environ.get(name, DEFAULTS[name])))
+
+
+def enqueue(kind, owner_id=None, files=None, **payload):
+    """Queue a job for `owner_id`'s user and commit it; returns the Job.
+
+    `files` maps names to uploads (anything with a `save` method), which
+    are saved where the task finds them with `job.path(name)`.
+    """
+    if kind not in _tasks:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    job = Job(kind=kind, user_id=owner_id, payload=json.dumps(payload))
+    db.session.add(job)
+    db.session.flush()
+    for name, upload in (files or {}).items():
+        upload.save(job_path(job.id, name))
+    db.session.commit()
+
+    # Commands that queue work exit right away; leave it to `flask worker`
+    pool = current_app.extensions.get("jobs")
+    if pool is not None and has_request_context():
+        pool.wake()
+    return job
+
+
+def claim(worker, lease):
+    """Atomically take the next due job, or a job whose worker died.
+
+    Returns the job's id, or None when there is nothing to do.
+    """
+    now = datetime.now()
+    due = db.or_(
+        db.and_(Job.status == Job.QUEUED, Job.run_after <= now),
+        db.and_(Job.status == Job.RUNNING, Job.leased_until < now),
+    )
+    candidate = (
+        db.select(Job.id).where(due).order_by(Job.id).limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    with db.engine.begin() as connection:
+        return connection.execute(
+            db.update(Job)
+            .where(Job.id == candidate, due)
+            .values(status=Job.RUNNING, worker=worker,
+                    attempts=Job.attempts + 1,
+                    leased_until=now + timedelta(seconds=lease))
+            .returning(Job.id)
+        ).scalar()
+
+
+def run(job_id, lease, max_attempts):
+    """Run a claimed job and record how it went"""
+    job = db.session.get(Job, job_id)
+    context = Context(job_id, lease, job.progress, job.user_id)
+    try:
+        handler = _tasks[job.kind]
+        result = handler(context, **json.loads(job.payload))
+    except Exception:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.error = traceback.format_exc(limit=5)
+        if job.attempts < max_attempts:
+            job.status = Job.QUEUED
+            job.run_after = datetime.now() + timedelta(
+                seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+        else:
+            job.status = Job.FAILED
+            job.finished_at = datetime.now()
+        current_app.logger.exception(
+            "Job %s (%s), attempt %s failed", job.id, job.kind, job.attempts)
+    else:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.status = Job.DONE
+        job.error = None
+        job.result = json.dumps(result)
+        job.finished_at = datetime.now()
+    job.leased_until = None
+    db.session.commit()
+
+
+def purge(days):
+    """Delete finished jobs, and their files, older than `days` days"""
+    cutoff = datetime.now() - timedelta(days=days)
+    old = db.session.scalars(
+        db.select(Job.id)
+        .where(Job.status.in_([Job.DONE, Job.FAILED]),
+               Job.finished_at < cutoff)
+    ).all()
+    for job_id in old:
+        shutil.rmtree(os.path.join(files_dir(), str(job_id)),
+                      ignore_errors=True)
+    if old:
+        db.session.execute(db.delete(Job).where(Job.id.in_(old)))
+        db.session.commit()
+    return len(old)
+
+
+class Pool:
+    """Worker threads that claim and run jobs until the process exits"""
+
+    def __init__(self, app, threads):
+        self.app = app
+        self.threads = threads
+        self.lease = _setting(app, "JOB_LEASE")
+        self.max_attempts = _setting(app, "JOB_MAX_ATTEMPTS")
+        self.poll_interval = _setting(app, "JOB_POLL_INTERVAL")
+        self.retention_days = _setting(app, "JOB_RETENTION_DAYS")
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = Event()
+        self._lock = Lock()
+        self._dispatcher = None
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        if self._dispatcher is not None or not self.threads:
+            return
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            self._dispatcher = Thread(
+                target=self.serve_forever, daemon=True, name="job-dispatcher")
+            self._dispatcher.start()
+
+    def serve_forever(self):
+        executor = ThreadPoolExecutor(
+            max_workers=self.threads, thread_name_prefix="job")
+        slots = [self.threads]
+        slots_lock = Lock()
+        last_purge = 0
+
+        def finished(future):
+            with slots_lock:
+                slots[0] += 1
+            self._wakeup.set()
+
+        while True:
+            try:
+                with self.app.app_context():
+                    if time.monotonic() - last_purge > 3600:
+                        purge(self.retention_days)
+                        last_purge = time.monotonic()
+                    while slots[0]:
+                        claimed = claim(self.name, self.lease)
+                        if claimed is None:
+                            break
+                        with slots_lock:
+                            slots[0] -= 1
+                        executor.submit(self._run, claimed) \
+                            .add_done_callback(finished)
+            except Exception:
+                self.app.logger.exception("Claiming jobs failed")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            try:
+                run(job_id, self.lease, self.max_attempts)
+            except Exception:
+                # Recording the outcome failed; the lease will run out and
+                # the job be retried
+                self.app.logger.exception("Job %s could not finish", job_id)
+
+
+def init_app(app):
+    """Set up the in-process pool; it starts with the first job enqueued"""
+    app.extensions["jobs"] = Pool(app, _setting(app, "JOB_WORKERS"))
@@ -0,0 +1,192 @@
+"""Who owes whom within a group, for every pair of members.
+
+`Group.get_user_balances` gives one member's net position; the matrix
+splits it by counterparty. It is built from one aggregation of the
+group's splits by (payer, debtor, currency) and netted per pair and
+currency, so a settlement (the debtor paying, the creditor's split)
+cancels the debt it pays off. Every member's debts add up to their
+balance in each currency. `simplified` also cancels circular debts (A
+owes B, B owes C, C owes A), which settle themselves: fewer debts, the
+same balances, but no longer what each pair owes each other.
+
+Like the expense-list fragments, a matrix is cached under the group's
+version in the fragment store (see fragments.py): any write to the
+ledger makes a new key, so it is computed once per change to the group,
+however many pages and API calls read it. It is cached in the ledger's
+own currencies; `converted` nets it again in the viewer's, per request.
+"""
+from collections import defaultdict
+import json
+
+from flask import current_app
+
+from models import db, Group, User
+
+
+class BalanceMatrix:
+    def __init__(self, debts, names):
+        # {(debtor_id, creditor_id, currency): amount}, amounts always
+        # positive
+        self.debts = debts
+        self.names = names
+
+    @classmethod
+    def from_rows(cls, rows, names):
+        """Net the (creditor_id, debtor_id, currency, amount) rows of
+        Group.pair_debts_query per pair and currency"""
+        net = {}
+        for creditor_id, debtor_id, code, amount in rows:
+            low, high = sorted((creditor_id, debtor_id))
+            sign = 1 if debtor_id == low else -1
+            pair = (low, high, code)
+            net[pair] = net.get(pair, 0) + sign * (amount or 0)
+        debts = {}
+        for (low, high, code), amount in net.items():
+            if amount > 0:
+                debts[(low, high, code)] = amount
+            elif amount < 0:
+                debts[(high, low, code)] = -amount
+        return cls(debts, names)
+
+    def simplified(self):
+        """The matrix with circular debts cancelled in each currency"""
+        by_currency = defaultdict(dict)
+        for (debtor, creditor, code), amount in self.debts.items():
+            by_currency[code][(debtor, creditor)] = amount
+        debts = {}
+        for code, in_currency in by_currency.items():
+            _cancel_cycles(in_currency)
+            debts.update(((debtor, creditor, code), amount)
+                         for (debtor, creditor), amount in in_currency.items())
+        return BalanceMatrix(debts, self.names)
+
+    def converted(self, converter):
+        """The matrix in `converter`'s currency, netted again per pair;
+        amounts are rounded per debt"""
+        return BalanceMatrix.from_rows(
+            [(creditor, debtor, converter.target,
+              converter.convert(amount, code))
+             for (debtor, creditor, code), amount in self.debts.items()],
+            self.names)
+
+    def currencies(self):
+        return {code for _, _, code in self.debts}
+
+    @staticmethod
+    def names_query(user_ids):
+        return db.select(User.id, User.name).where(User.id.in_(user_ids))
+
+    @staticmethod
+    def user_ids(rows):
+        return {user_id for row in rows for user_id in row[:2]}
+
+    def between(self, user_id, other_id):
+        """{currency: what `other_id` owes `user_id`}; negative where
+        `user_id` owes"""
+        owed = {}
+        for (debtor, creditor, code), amount in self.debts.items():
+            if (debtor, creditor) == (other_id, user_id):
+                owed[code] = owed.get(code, 0) + amount
+            elif (debtor, creditor) == (user_id, other_id):
+                owed[code] = owed.get(code, 0) - amount
+        return owed
+
+    def name(self, user_id):
+        return self.names.get(user_id, "")
+
+    def pairs(self, first=None):
+        """(debtor_id, creditor_id, amount, currency), largest first; any
+        involving `first` come before the rest"""
+        return sorted(
+            ((debtor, creditor, amount, code)
+             for (debtor, creditor, code), amount in self.debts.items()),
+            key=lambda d: (first not in d[:2], d[3], -d[2], d[0], d[1]))
+
+    def to_dict(self):
+        return {
+            "members": {str(user_id): name
+                        for user_id, name in self.names.items()},
+            "debts": [
+                {"from": debtor, "to": creditor, "amount": amount,
+                 "currency": code}
+                for debtor, creditor, amount, code in self.pairs()
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            {(d["from"], d["to"], d["currency"]): d["amount"]
+             for d in data["debts"]},
+            {int(user_id): name for user_id, name in data["members"].items()},
+        )
+
+
+def _find_cycle(debts):
+    """The (debtor, creditor) edges of one cycle of debts, or None"""
+    owes = {}
+    for debtor, creditor in sorted(debts):
+        owes.setdefault(debtor, []).append(creditor)
+    finished = set()
+    for start in sorted(owes):
+        if start in finished:
+            continue
+        # Depth first, keeping the path: an edge back onto it is a cycle
+        path, position = [start], {start: 0}
+        pending = [iter(owes[start])]
+        while pending:
+            creditor = next(pending[-1], None)
+            if creditor is None:
+                done = path.pop()
+                del position[done]
+                finished.add(done)
+                pending.pop()
+            elif creditor in position:
+                cycle = path[position[creditor]:] + [creditor]
+                return list(zip(cycle, cycle[1:]))
+            elif creditor not in finished:
+                position[creditor] = len(path)
+                path.append(creditor)
+                pending.append(iter(owes.get(creditor, ())))
+    return None
+
+
+def _cancel_cycles(debts):
+    """Take every cycle's smallest debt off all of its debts, in place,
+    until none is left; each member's net position stays the same"""
+    while True:
+        cycle = _find_cycle(debts)
+        if cycle is None:
+            return
+        smallest = min(debts[edge] for edge in cycle)
+        for edge in cycle:
+            debts[edge] -= smallest
+            if not debts[edge]:
+                del debts[edge]
+
+
+def key(group):
+    return f"matrix:{group.id}:{group.version}"
+
+
+def lookup(group):
+    """The group's cached matrix at its current version, or None"""
+    data = current_app.extensions["fragments"].get(key(group))
+    return BalanceMatrix.from_dict(json.loads(data)) if data else None
+
+
+def store(group, matrix):
+    current_app.extensions["fragments"].set(
+        key(group), json.dumps(matrix.to_dict()))
+    return matrix
+
+
+def for_group(group):
+    """The group's matrix, computed on a cache miss"""
+    matrix = lookup(group)
+    if matrix is None:
+        rows = db.session.execute(Group.pair_debts_query(group.id)).all()
+        names = dict(db.session.execute(
+            BalanceMatrix.names_query(BalanceMatrix.user_ids(rows))).all())
+        matrix = store(group, BalanceMatrix.from_rows(rows, names))
+    return matrix
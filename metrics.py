@@ -0,0 +1,160 @@
+"""Per-request SQL instrumentation and a Prometheus /metrics endpoint.
+
+Every statement run on the app's engines during a request is counted and
+timed. When a request runs more than `SLOW_REQUEST_QUERIES` statements or
+takes longer than `SLOW_REQUEST_MS`, it is logged with its slowest
+statements. Responses carry `X-Query-Count` and `X-DB-Time-Ms` headers when
+`QUERY_COUNT_HEADER` is on (it defaults to the app's debug flag), which
+makes N+1 regressions visible from the browser or a test client.
+
+Metrics are kept per process; scrape every worker, or run one worker per
+metrics target.
+"""
+from bisect import bisect_left
+from threading import Lock
+import time
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+DEFAULTS = {
+    "SLOW_REQUEST_QUERIES": 20,
+    "SLOW_REQUEST_MS": 500,
+}
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self._series = {}
+        self._lock = Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            counts, total = self._series.get(
+                labels, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._series[labels] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}",
+                 f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for labels, (counts, total) in series:
+            base = ",".join(f'{key}="{value}"' for key, value in labels)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(
+                    f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{base}}} {total}")
+            lines.append(f"{self.name}_count{{{base}}} {cumulative}")
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    "splitr_request_duration_seconds",
+    "Time spent handling a request.", LATENCY_BUCKETS)
+REQUEST_QUERIES = Histogram(
+    "splitr_request_queries",
+    "SQL statements executed per request.", QUERY_BUCKETS)
+REQUEST_DB_TIME = Histogram(
+    "splitr_request_db_seconds",
+    "Time spent in the database per request.", LATENCY_BUCKETS)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if has_request_context() and "queries" in g:
+        g.queries.append((elapsed, statement))
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and \
+            context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.queries = []
+
+
+def _finish_request(app, response):
+    if "request_start" not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    queries = g.queries
+    db_time = sum(duration for duration, _ in queries)
+
+    labels = (("endpoint", request.endpoint or "unknown"),
+              ("method", request.method))
+    REQUEST_LATENCY.observe(labels, elapsed)
+    REQUEST_QUERIES.observe(labels, len(queries))
+    REQUEST_DB_TIME.observe(labels, db_time)
+
+    show_header = app.config["QUERY_COUNT_HEADER"]
+    if show_header is None:
+        show_header = app.debug
+    if show_header:
+        response.headers["X-Query-Count"] = str(len(queries))
+        response.headers["X-DB-Time-Ms"] = f"{db_time * 1000:.1f}"
+
+    if len(queries) > app.config["SLOW_REQUEST_QUERIES"] or \
+            elapsed * 1000 > app.config["SLOW_REQUEST_MS"]:
+        slowest = sorted(queries, reverse=True)[:5]
+        app.logger.warning(
+            "Slow request %s %s: %.1f ms, %d queries (%.1f ms in db)\n%s",
+            request.method, request.full_path, elapsed * 1000, len(queries),
+            db_time * 1000,
+            "\n".join(f"  {duration * 1000:.1f} ms  {statement}"
+                      for duration, statement in slowest))
+    return response
+
+
+def render_metrics():
+    lines = []
+    for histogram in (REQUEST_LATENCY, REQUEST_QUERIES, REQUEST_DB_TIME):
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
+
+
+def instrument(engine):
+    """Count and time the statements `engine` runs during requests"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def init_app(app):
+    """Instrument the app's engines and requests; after db.init_app(app)"""
+    for name, default in DEFAULTS.items():
+        app.config.setdefault(name, default)
+    app.config.setdefault("QUERY_COUNT_HEADER", None)
+
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument(engine)
+
+    app.before_request(_start_request)
+    app.after_request(lambda response: _finish_request(app, response))
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(render_metrics(),
+                        mimetype="text/plain; version=0.0.4")
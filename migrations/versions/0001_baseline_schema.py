@@ -0,0 +1,222 @@
+"""Baseline schema
+
+Creates every table on an empty database. Databases from before migrations
+(made by `db.create_all()` and patched by the old `flask upgrade-db`) are
+brought to the same shape instead: missing tables and columns are added,
+FLOAT money columns become INTEGER minor units and the friendships index is
+backfilled from existing friend groups, as are balances.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 19:19:10.342101
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from helper import minor_digits
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# Columns added to tables after their first release
+ADDED_COLUMNS = {
+    "expenses": [
+        sa.Column('kind', sa.String(length=20), server_default='expense',
+                  nullable=False),
+    ],
+    "groups": [
+        sa.Column('version', sa.Integer(), server_default='1',
+                  nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+    ],
+}
+
+# Money columns that used to be FLOAT major units
+MINOR_UNIT_COLUMNS = {
+    "expenses": "amount",
+    "expense_split": "amount",
+    "balances": "amount",
+}
+
+
+def upgrade():
+    bind = op.get_bind()
+    existing = set(sa.inspect(bind).get_table_names())
+    _create_tables(existing)
+    if "groups" in existing:
+        _upgrade_legacy(bind, existing)
+
+
+def _create_tables(existing):
+    if 'groups' not in existing:
+        op.create_table('groups',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=True),
+        sa.Column('is_friend_group', sa.Boolean(), nullable=True),
+        sa.Column('version', sa.Integer(), server_default='1', nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'sessions' not in existing:
+        op.create_table('sessions',
+        sa.Column('id', sa.String(length=64), nullable=False),
+        sa.Column('data', sa.Text(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+        )
+        with op.batch_alter_table('sessions', schema=None) as batch_op:
+            batch_op.create_index(batch_op.f('ix_sessions_expires_at'), ['expires_at'], unique=False)
+
+    if 'users' not in existing:
+        op.create_table('users',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=100), nullable=False),
+        sa.Column('username', sa.String(length=50), nullable=False),
+        sa.Column('password', sa.String(length=200), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username')
+        )
+    if 'balances' not in existing:
+        op.create_table('balances',
+        sa.Column('group_id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('group_id', 'user_id')
+        )
+    if 'expenses' not in existing:
+        op.create_table('expenses',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('description', sa.String(length=120), nullable=True),
+        sa.Column('amount', sa.Integer(), nullable=True),
+        sa.Column('paid_by_id', sa.Integer(), nullable=True),
+        sa.Column('group_id', sa.Integer(), nullable=True),
+        sa.Column('timestamp', sa.DateTime(), nullable=True),
+        sa.Column('kind', sa.String(length=20), server_default='expense', nullable=False),
+        sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+        sa.ForeignKeyConstraint(['paid_by_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'friendships' not in existing:
+        op.create_table('friendships',
+        sa.Column('min_user_id', sa.Integer(), nullable=False),
+        sa.Column('max_user_id', sa.Integer(), nullable=False),
+        sa.Column('group_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+        sa.ForeignKeyConstraint(['max_user_id'], ['users.id'], ),
+        sa.ForeignKeyConstraint(['min_user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('min_user_id', 'max_user_id'),
+        sa.UniqueConstraint('group_id')
+        )
+        with op.batch_alter_table('friendships', schema=None) as batch_op:
+            batch_op.create_index('ix_friendships_max_user_id', ['max_user_id'], unique=False)
+
+    if 'group_members' not in existing:
+        op.create_table('group_members',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('group_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['group_id'], ['groups.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'group_id')
+        )
+    if 'expense_split' not in existing:
+        op.create_table('expense_split',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('expense_id', sa.Integer(), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('amount', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['expense_id'], ['expenses.id'], ),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+
+def _upgrade_legacy(bind, existing):
+    inspector = sa.inspect(bind)
+    for table, columns in ADDED_COLUMNS.items():
+        present = {c["name"] for c in inspector.get_columns(table)}
+        for column in columns:
+            if column.name not in present:
+                op.add_column(table, column)
+
+    scale = 10 ** minor_digits()
+    for table, column in MINOR_UNIT_COLUMNS.items():
+        types = {c["name"]: c["type"] for c in inspector.get_columns(table)}
+        if not isinstance(types[column], sa.Float):
+            continue
+        if bind.dialect.name == "sqlite":
+            # Scale in place, then let batch mode copy the table into one
+            # with an INTEGER column
+            op.execute(f"UPDATE {table} SET {column} = "
+                       f"CAST(ROUND({column} * {scale}) AS INTEGER)")
+            with op.batch_alter_table(table) as batch_op:
+                batch_op.alter_column(column, existing_type=sa.Float(),
+                                      type_=sa.Integer())
+        else:
+            op.alter_column(
+                table, column, existing_type=sa.Float(), type_=sa.Integer(),
+                postgresql_using=f"ROUND({column} * {scale})::integer")
+
+    if "friendships" not in existing:
+        _backfill_friendships()
+    if "balances" not in existing:
+        _backfill_balances()
+
+
+def _backfill_friendships():
+    """Index every existing two-member friend group by its user pair.
+
+    The oldest ledger wins if the same pair was ever added twice.
+    """
+    op.execute("""
+        INSERT INTO friendships (min_user_id, max_user_id, group_id)
+        SELECT low_id, high_id, min(group_id) FROM (
+            SELECT min(gm.user_id) AS low_id, max(gm.user_id) AS high_id,
+                   gm.group_id AS group_id
+            FROM group_members gm JOIN groups g ON g.id = gm.group_id
+            WHERE g.is_friend_group
+            GROUP BY gm.group_id
+            HAVING count(*) = 2
+        ) AS pairs
+        GROUP BY low_id, high_id
+    """)
+
+
+def _backfill_balances():
+    """Net balance of every user in every group, from the ledger"""
+    op.execute("""
+        INSERT INTO balances (group_id, user_id, amount)
+        SELECT group_id, user_id, sum(amount) FROM (
+            SELECT group_id, paid_by_id AS user_id, amount FROM expenses
+            UNION ALL
+            SELECT e.group_id, s.user_id, -s.amount
+            FROM expense_split s JOIN expenses e ON e.id = s.expense_id
+        ) AS ledger
+        WHERE group_id IS NOT NULL AND user_id IS NOT NULL
+        GROUP BY group_id, user_id
+    """)
+
+
+def downgrade():
+    # ### commands auto generated by Alembic - please adjust! ###
+    op.drop_table('expense_split')
+    op.drop_table('group_members')
+    with op.batch_alter_table('friendships', schema=None) as batch_op:
+        batch_op.drop_index('ix_friendships_max_user_id')
+
+    op.drop_table('friendships')
+    op.drop_table('expenses')
+    op.drop_table('balances')
+    op.drop_table('users')
+    with op.batch_alter_table('sessions', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_sessions_expires_at'))
+
+    op.drop_table('sessions')
+    op.drop_table('groups')
+    # ### end Alembic commands ###
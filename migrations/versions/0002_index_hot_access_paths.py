@@ -0,0 +1,89 @@
+"""Index hot access paths, cascade split deletes
+
+Every lookup below used to be a full table scan:
+
+    expenses        a group's ledger by (group_id, timestamp DESC, id DESC),
+                    expenses paid by a user
+    expense_split   a user's splits by (user_id, expense_id), an expense's
+                    splits
+    group_members   a group's members (by user is the primary key)
+    balances        a user's balances (by group is the primary key)
+
+Splits are also deleted with their expense by the database now.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 19:20:05.382270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+SPLIT_EXPENSE_FK = 'fk_expense_split_expense_id_expenses'
+
+# Names SQLite's unnamed foreign keys in batch mode, so they can be dropped
+NAMING_CONVENTION = {
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s',
+}
+
+
+def _split_expense_fk():
+    """Current name of the expense_split.expense_id foreign key"""
+    for fk in sa.inspect(op.get_bind()).get_foreign_keys('expense_split'):
+        if fk['constrained_columns'] == ['expense_id']:
+            return fk['name'] or SPLIT_EXPENSE_FK
+    return None
+
+
+def _replace_split_expense_fk(**options):
+    existing = _split_expense_fk()
+    with op.batch_alter_table('expense_split', schema=None,
+                              naming_convention=NAMING_CONVENTION) as batch_op:
+        if existing:
+            batch_op.drop_constraint(existing, type_='foreignkey')
+        batch_op.create_foreign_key(
+            SPLIT_EXPENSE_FK, 'expenses', ['expense_id'], ['id'], **options)
+
+
+def upgrade():
+    with op.batch_alter_table('expenses', schema=None) as batch_op:
+        batch_op.create_index(
+            'ix_expenses_group_id_timestamp',
+            ['group_id', sa.text('timestamp DESC'), sa.text('id DESC')],
+            unique=False)
+        batch_op.create_index(batch_op.f('ix_expenses_paid_by_id'), ['paid_by_id'], unique=False)
+
+    with op.batch_alter_table('expense_split', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_expense_split_expense_id'), ['expense_id'], unique=False)
+        batch_op.create_index('ix_expense_split_user_id_expense_id', ['user_id', 'expense_id'], unique=False)
+    _replace_split_expense_fk(ondelete='CASCADE')
+
+    with op.batch_alter_table('group_members', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_group_members_group_id'), ['group_id'], unique=False)
+
+    with op.batch_alter_table('balances', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_balances_user_id'), ['user_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('balances', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_balances_user_id'))
+
+    with op.batch_alter_table('group_members', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_group_members_group_id'))
+
+    _replace_split_expense_fk()
+    with op.batch_alter_table('expense_split', schema=None) as batch_op:
+        batch_op.drop_index('ix_expense_split_user_id_expense_id')
+        batch_op.drop_index(batch_op.f('ix_expense_split_expense_id'))
+
+    with op.batch_alter_table('expenses', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_expenses_paid_by_id'))
+        batch_op.drop_index('ix_expenses_group_id_timestamp')
@@ -0,0 +1,71 @@
+"""Full-text index of expense descriptions
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 22:37:51.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+# Triggers keep the FTS5 table in step with expenses (see search.py). A
+# later migration that rebuilds `expenses` in batch mode drops them, and
+# must create them again.
+SQLITE_TRIGGERS = {
+    'expenses_search_insert': """
+        CREATE TRIGGER expenses_search_insert AFTER INSERT ON expenses BEGIN
+            INSERT INTO expense_search (rowid, description)
+            VALUES (new.id, new.description);
+        END""",
+    'expenses_search_delete': """
+        CREATE TRIGGER expenses_search_delete AFTER DELETE ON expenses BEGIN
+            INSERT INTO expense_search (expense_search, rowid, description)
+            VALUES ('delete', old.id, old.description);
+        END""",
+    'expenses_search_update': """
+        CREATE TRIGGER expenses_search_update
+        AFTER UPDATE OF description ON expenses BEGIN
+            INSERT INTO expense_search (expense_search, rowid, description)
+            VALUES ('delete', old.id, old.description);
+            INSERT INTO expense_search (rowid, description)
+            VALUES (new.id, new.description);
+        END""",
+}
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.create_index(
+            'ix_expenses_description_fts', 'expenses',
+            [sa.text("to_tsvector('simple'::regconfig, "
+                     "coalesce(description, ''))")],
+            postgresql_using='gin')
+        return
+
+    op.execute("""
+        CREATE VIRTUAL TABLE expense_search USING fts5(
+            description,
+            content='expenses', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )""")
+    for ddl in SQLITE_TRIGGERS.values():
+        op.execute(ddl)
+    # Index the expenses there already are
+    op.execute("INSERT INTO expense_search (expense_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_index('ix_expenses_description_fts', table_name='expenses')
+        return
+
+    for name in SQLITE_TRIGGERS:
+        op.execute(f"DROP TRIGGER {name}")
+    op.execute("DROP TABLE expense_search")
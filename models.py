@@ -1,5 +1,14 @@
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect
+from collections import defaultdict
 from datetime import datetime
+import json
+import os
+
+from helper import (
+    allocate, default_currency, normalize_term, prefix_bounds, search_terms,
+    simplify_debts, to_minor)
 
 db = SQLAlchemy()
 
@@ -10,6 +19,8 @@ class User(db.Model):
     name = db.Column(db.String(100), nullable=False)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
+    # Balances are shown converted into this; None for DEFAULT_CURRENCY
+    currency = db.Column(db.String(3), nullable=True)
 
     # Relationships
     expenses_paid = db.relationship(
@@ -24,15 +35,102 @@ class User(db.Model):
         )
 
     def balance(self):
-        paid = sum(e.amount for e in self.expenses_paid)
-        owed = sum(split.amount for split in self.splits)
-        return paid - owed
+        total = (
+            db.session.query(db.func.sum(Balance.amount))
+            .filter(Balance.user_id == self.id)
+            .scalar()
+        )
+        return total or 0
 
     def get_friends(self):
-        return [
-            g for g in getattr(self, "groups", [])
-            if g.is_friend_group and len(g.users) == 2
-        ]
+        """(friend group id, friend) pairs, via the friendships index"""
+        return Friendship.for_user(self.id)
+
+    @staticmethod
+    def search_query(prefix, limit, exclude_user_id=None,
+                     exclude_group_id=None):
+        """Users whose username or a word of whose name starts with `prefix`.
+
+        A range scan of the user_search index, best (shortest) match
+        first. Rows are (term, User); a user matching on two terms comes
+        back twice, so callers fetch a few extra and drop repeats.
+        """
+        low, high = prefix_bounds(normalize_term(prefix))
+        matches = (
+            db.select(UserSearch.term, UserSearch.user_id)
+            .where(UserSearch.term >= low, UserSearch.term < high)
+            .order_by(UserSearch.term, UserSearch.user_id)
+            .limit(limit)
+        )
+        if exclude_user_id is not None:
+            matches = matches.where(UserSearch.user_id != exclude_user_id)
+        if exclude_group_id is not None:
+            matches = matches.where(~db.exists().where(
+                GroupMember.group_id == exclude_group_id,
+                GroupMember.user_id == UserSearch.user_id))
+        # Limit inside the subquery, so the planner walks the index range
+        # and stops, rather than scanning users and sorting
+        matches = matches.subquery()
+        return (
+            db.select(matches.c.term, User)
+            .join(User, User.id == matches.c.user_id)
+            .order_by(matches.c.term, matches.c.user_id)
+        )
+
+    @staticmethod
+    def search(prefix, limit=10, **exclude):
+        """Up to `limit` distinct users matching `prefix` (see search_query)"""
+        if not normalize_term(prefix):
+            return []
+        return User.distinct(db.session.execute(
+            User.search_query(prefix, limit * 2, **exclude)), limit)
+
+    @staticmethod
+    def distinct(rows, limit):
+        """The first `limit` users of search_query's rows, repeats
+        dropped"""
+        users = {}
+        for _, user in rows:
+            users.setdefault(user.id, user)
+        return list(users.values())[:limit]
+
+
+class UserSearch(db.Model):
+    """Prefix index for finding users, kept in step with `users`.
+
+    One row per (normalized term, user): the username and every word of
+    the name, so "jo" finds both "jo_smith" and "Mary Jones". Searches
+    are range scans of the primary key.
+    """
+    __tablename__ = "user_search"
+    term = db.Column(db.String(100), primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id"), primary_key=True, index=True)
+
+    @staticmethod
+    def rows(user_id, username, name):
+        return [{"term": term, "user_id": user_id}
+                for term in search_terms(username, name)]
+
+
+@event.listens_for(User, "after_insert")
+def _index_new_user(mapper, connection, user):
+    connection.execute(
+        db.insert(UserSearch), UserSearch.rows(user.id, user.username,
+                                               user.name))
+
+
+@event.listens_for(User, "after_update")
+def _reindex_user(mapper, connection, user):
+    state = inspect(user)
+    if not (state.attrs.username.history.has_changes()
+            or state.attrs.name.history.has_changes()):
+        return
+    connection.execute(
+        db.delete(UserSearch).where(UserSearch.user_id == user.id))
+    connection.execute(
+        db.insert(UserSearch), UserSearch.rows(user.id, user.username,
+                                               user.name))
 
 
 class Group(db.Model):
@@ -40,6 +138,11 @@ class Group(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=True)
     is_friend_group = db.Column(db.Boolean, default=False)
+    # Bumped by every write to the group's ledger or membership, so cached
+    # pages and fragments can be keyed on it
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default="1")
+    updated_at = db.Column(db.DateTime, default=datetime.now)
 
     users = db.relationship(
         "User", secondary="group_members", backref="groups")
@@ -48,29 +151,168 @@ class Group(db.Model):
     def user_is_member(self, user_id):
         return any(user.id == user_id for user in self.users)
 
-    def get_group_expenses(self):
+    @staticmethod
+    def bump_version(group_id):
+        """Mark the group changed; call before reading state to be rewritten.
+
+        The UPDATE takes the write lock (SQLite) or the group's row lock
+        (Postgres), so concurrent writers to one group queue up here, and
+        anything read afterwards in the transaction is current.
+        """
+        Group.query.filter_by(id=group_id).update(
+            {Group.version: Group.version + 1,
+             Group.updated_at: datetime.now()},
+            synchronize_session=False)
+
+    @staticmethod
+    def of_user_query(user_id):
+        """The user's regular (not friend) groups"""
         return (
-            Expense.query.filter_by(group_id=self.id)
-            .order_by(Expense.timestamp.desc())
-            .all()
+            db.select(Group)
+            .join(GroupMember, GroupMember.group_id == Group.id)
+            .where(GroupMember.user_id == user_id,
+                   db.not_(Group.is_friend_group))
+            .order_by(Group.id)
         )
 
+    @staticmethod
+    def expenses_query(group_id, before=None, limit=50):
+        """One page of a group's expenses, newest first.
+
+        Splits and payers are loaded up front (one extra query for all the
+        page's splits, payers joined in), so rendering a page costs a fixed
+        number of statements. Pass the last expense's (timestamp, id) as
+        `before` to fetch the next page.
+        """
+        query = (
+            db.select(Expense).filter_by(group_id=group_id)
+            .options(
+                db.selectinload(Expense.splits)
+                .joinedload(ExpenseSplit.user),
+                db.joinedload(Expense.payer),
+            )
+        )
+        if before is not None:
+            timestamp, expense_id = before
+            query = query.where(db.or_(
+                Expense.timestamp < timestamp,
+                db.and_(Expense.timestamp == timestamp,
+                        Expense.id < expense_id),
+            ))
+        return (
+            query.order_by(Expense.timestamp.desc(), Expense.id.desc())
+            .limit(limit)
+        )
+
+    def get_group_expenses(self, before=None, limit=50):
+        return db.session.scalars(
+            Group.expenses_query(self.id, before, limit)).all()
+
     def get_group_balance(self):
-        return sum(e.amount for e in self.expenses)
+        total = (
+            db.session.query(db.func.sum(Expense.amount))
+            .filter(Expense.group_id == self.id)
+            .scalar()
+        )
+        return total or 0
+
+    def get_user_balances(self, user_id):
+        """The member's balance in each currency of the group's ledger"""
+        return dict(db.session.execute(
+            Balance.of_member_query(self.id, user_id)).all())
 
-    def get_user_balance(self, user_id):
-        balance = 0.0
-        for expense in self.expenses:
-            for split in expense.splits:
-                if split.user_id == user_id:
-                    balance -= split.amount
-            if expense.paid_by_id == user_id:
-                balance += expense.amount
-        return balance
+    @staticmethod
+    def pair_debts_query(group_id):
+        """(creditor_id, debtor_id, currency, amount): what each payer
+        fronted for each other member in each currency, over the whole
+        ledger, in one aggregation"""
+        return (
+            db.select(Expense.paid_by_id.label("creditor_id"),
+                      ExpenseSplit.user_id.label("debtor_id"),
+                      Expense.currency.label("currency"),
+                      db.func.sum(ExpenseSplit.amount).label("amount"))
+            .join(Expense, Expense.id == ExpenseSplit.expense_id)
+            .where(Expense.group_id == group_id,
+                   ExpenseSplit.user_id != Expense.paid_by_id)
+            .group_by(Expense.paid_by_id, ExpenseSplit.user_id,
+                      Expense.currency)
+        )
+
+    def get_net_balances(self):
+        """{currency: {user_id: net balance}}, aggregated in a single query"""
+        paid = (
+            db.select(Expense.paid_by_id.label("user_id"),
+                      Expense.currency.label("currency"),
+                      Expense.amount.label("amount"))
+            .where(Expense.group_id == self.id)
+        )
+        owed = (
+            db.select(ExpenseSplit.user_id, Expense.currency,
+                      -ExpenseSplit.amount)
+            .join(Expense, Expense.id == ExpenseSplit.expense_id)
+            .where(Expense.group_id == self.id)
+        )
+        ledger = db.union_all(paid, owed).subquery()
+        rows = db.session.execute(
+            db.select(ledger.c.user_id, ledger.c.currency,
+                      db.func.sum(ledger.c.amount))
+            .group_by(ledger.c.user_id, ledger.c.currency)
+        )
+        balances = defaultdict(dict)
+        for user_id, code, total in rows:
+            balances[code][user_id] = total or 0
+        return dict(balances)
+
+    def settlement_plan(self):
+        """Transfers (from_id, to_id, amount, currency) that settle the
+        whole group.
+
+        Each currency is settled on its own, so paying back the transfers
+        clears every balance exactly, whatever the exchange rates.
+        """
+        return [
+            (debtor, creditor, amount, code)
+            for code, balances in sorted(self.get_net_balances().items())
+            for debtor, creditor, amount in simplify_debts(balances)
+        ]
+
+    def record_settlement(self, plan, user_id=None):
+        """Write each transfer as a settlement expense, in one batch;
+        `user_id` is who settled up, for the event log"""
+        settlements = [
+            Expense(
+                description="Settlement",
+                amount=amount,
+                currency=code,
+                paid_by_id=debtor,
+                group_id=self.id,
+                kind=Expense.SETTLEMENT,
+            )
+            for debtor, _, amount, code in plan
+        ]
+        db.session.add_all(settlements)
+        db.session.flush()
+
+        deltas = defaultdict(int)
+        splits, changes = [], []
+        for expense, (debtor, creditor, amount, code) in zip(
+                settlements, plan):
+            splits.append(ExpenseSplit(
+                expense_id=expense.id, user_id=creditor, amount=amount))
+            deltas[(debtor, code)] += amount
+            deltas[(creditor, code)] -= amount
+            changes.append(ExpenseEvent.change(
+                ExpenseEvent.CREATED, expense, [(creditor, amount)],
+                {(debtor, code): amount, (creditor, code): -amount}))
+        db.session.add_all(splits)
+        Balance.apply(self.id, deltas)
+        ExpenseEvent.record(self.id, changes, user_id=user_id)
+        return settlements
 
 
 class GroupMember(db.Model):
     __tablename__ = "group_members"
+    # The primary key already indexes lookups by user
     user_id = db.Column(
         db.Integer,
         db.ForeignKey("users.id"),
@@ -80,65 +322,847 @@ class GroupMember(db.Model):
         db.Integer,
         db.ForeignKey("groups.id"),
         primary_key=True,
+        index=True,
         )
 
+    @staticmethod
+    def add_many(group_id, user_ids):
+        """Add users to a group in one statement; returns how many were new.
+
+        Ids of users that don't exist or are already members are skipped.
+        """
+        user_ids = set(user_ids)
+        if not user_ids:
+            return 0
+        already = db.exists().where(
+            GroupMember.group_id == group_id,
+            GroupMember.user_id == User.id)
+        result = db.session.execute(
+            db.insert(GroupMember).from_select(
+                ["user_id", "group_id"],
+                db.select(User.id, db.literal(group_id))
+                .where(User.id.in_(user_ids), ~already)
+            )
+        )
+        # Core insert: tell per-user caches (see summary.py) by hand
+        db.session.info.setdefault("touched_users", set()).update(user_ids)
+        return result.rowcount
+
+
+class Friendship(db.Model):
+    """Index of friend pairs, one row per pair, pointing at their ledger.
+
+    The pair is stored ordered (min_user_id < max_user_id) so the primary
+    key is a unique index and lookups don't depend on who added whom.
+    """
+    __tablename__ = "friendships"
+    __table_args__ = (
+        db.Index("ix_friendships_max_user_id", "max_user_id"),
+    )
+    min_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id"),
+        primary_key=True,
+        )
+    max_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id"),
+        primary_key=True,
+        )
+    group_id = db.Column(
+        db.Integer,
+        db.ForeignKey("groups.id"),
+        unique=True,
+        nullable=False,
+        )
+
+    group = db.relationship("Group")
+
+    @staticmethod
+    def pair(user_id, other_id):
+        return min(user_id, other_id), max(user_id, other_id)
+
+    @staticmethod
+    def between(user_id, other_id):
+        return db.session.get(Friendship, Friendship.pair(user_id, other_id))
+
+    @staticmethod
+    def involving(user_id):
+        return db.or_(Friendship.min_user_id == user_id,
+                      Friendship.max_user_id == user_id)
+
+    @staticmethod
+    def for_user_query(user_id):
+        """(group_id, friend) for each of the user's friends, by name"""
+        friend_id = db.case(
+            (Friendship.min_user_id == user_id, Friendship.max_user_id),
+            else_=Friendship.min_user_id,
+        )
+        return (
+            db.select(Friendship.group_id, User)
+            .join(User, User.id == friend_id)
+            .where(Friendship.involving(user_id))
+            .order_by(User.name)
+        )
+
+    @staticmethod
+    def for_user(user_id):
+        return db.session.execute(Friendship.for_user_query(user_id)).all()
+
 
 class Expense(db.Model):
     __tablename__ = "expenses"
+    EXPENSE = "expense"
+    SETTLEMENT = "settlement"
+    KINDS = (EXPENSE, SETTLEMENT)
+
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(120))
-    amount = db.Column(db.Float)
-    paid_by_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # Integer minor units of `currency` (cents for USD), as are its splits
+    amount = db.Column(db.Integer)
+    currency = db.Column(
+        db.String(3), nullable=False, default=default_currency)
+    paid_by_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     group_id = db.Column(db.Integer, db.ForeignKey("groups.id"), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.now)
+    kind = db.Column(
+        db.String(20),
+        nullable=False,
+        default=EXPENSE,
+        server_default=EXPENSE,
+        )
+
+    # Splits go with their expense; unloaded ones via ON DELETE CASCADE
+    splits = db.relationship(
+        "ExpenseSplit", backref="expense", lazy=True,
+        cascade="all, delete", passive_deletes=True)
 
-    splits = db.relationship("ExpenseSplit", backref="expense", lazy=True)
+    @staticmethod
+    def shares_from_form(form_data, users, amount, currency_code=None):
+        """Each user's share in minor units, keyed by user id.
 
-    def add_splits_from_form(self, form_data, users):
-        total_split = 0.0
+        Blank or invalid fields count as no share. If every field is blank
+        the amount is split evenly, exactly, among all users.
+        """
+        shares = {}
         for user in users:
             try:
-                share = round(float(form_data.get(f"user_{user.id}", 0)), 2)
-                if share > 0:
-                    split = ExpenseSplit(
-                        expense_id=self.id,
-                        user_id=user.id,
-                        amount=share
-                    )
-                    db.session.add(split)
-                    total_split += share
+                shares[user.id] = to_minor(
+                    form_data.get(f"user_{user.id}"), currency_code)
             except ValueError:
                 continue
+        if not shares and users:
+            even = allocate(amount, [1] * len(users))
+            shares = {user.id: share for user, share in zip(users, even)}
+        return shares
+
+    def add_splits_from_form(self, form_data, users):
+        shares = Expense.shares_from_form(
+            form_data, users, self.amount, self.currency)
+        total_split = 0
+        for user_id, share in shares.items():
+            if share > 0:
+                split = ExpenseSplit(
+                    expense_id=self.id,
+                    user_id=user_id,
+                    amount=share
+                )
+                db.session.add(split)
+                total_split += share
         return total_split
 
+    def split_amounts(self):
+        """(user_id, amount) of every split, as stored"""
+        return db.session.query(ExpenseSplit.user_id, ExpenseSplit.amount) \
+            .filter_by(expense_id=self.id).all()
+
+    def balance_deltas(self, splits=None):
+        """Net effect of this expense on each user's balance in its group,
+        keyed by (user_id, currency).
+
+        Pass `split_amounts()` as `splits` to save reading them again.
+        """
+        if splits is None:
+            splits = self.split_amounts()
+        deltas = defaultdict(int)
+        deltas[(self.paid_by_id, self.currency)] += self.amount
+        for user_id, amount in splits:
+            deltas[(user_id, self.currency)] -= amount
+        return deltas
+
+    def spend_deltas(self, splits=None):
+        """This expense's part of its group's monthly rollups.
+
+        {(month, user_id, currency): [paid, expenses paid, share]};
+        settlements move money around rather than spend it, so they have
+        none.
+        """
+        if self.kind == Expense.SETTLEMENT:
+            splits = ()
+        elif splits is None:
+            splits = self.split_amounts()
+        return Expense.spend_of(
+            {column: getattr(self, column) for column in (
+                "kind", "timestamp", "paid_by_id", "currency", "amount")},
+            splits)
+
+    @staticmethod
+    def spend_of(expense, splits):
+        """spend_deltas for an expense's column values, as a bulk insert
+        has them, and its (user_id, amount) splits"""
+        deltas = defaultdict(lambda: [0, 0, 0])
+        if expense["kind"] == Expense.SETTLEMENT:
+            return deltas
+        month = MonthlySpend.month_of(expense["timestamp"])
+        code = expense["currency"]
+        payer = (month, expense["paid_by_id"], code)
+        deltas[payer][0] += expense["amount"]
+        deltas[payer][1] += 1
+        for user_id, amount in splits:
+            deltas[(month, user_id, code)][2] += amount
+        return deltas
+
     def update_splits_from_form(self, form, users):
+        """Make the splits match the form; a blank or missing share is no
+        share, and its split is deleted. Returns the total of the splits
+        the expense is left with.
+        """
         existing_splits = {split.user_id: split for split in self.splits}
-        total_split = 0
+        shares = Expense.shares_from_form(
+            form, users, self.amount, self.currency)
 
-        for user in users:
-            key = f"user_{user.id}"
-            if key in form:
-                share = float(form.get(key, 0))
-                total_split += share
+        for user_id, split in existing_splits.items():
+            share = shares.get(user_id, 0)
+            if share:
+                split.amount = share
+            else:
+                db.session.delete(split)
+        for user_id, share in shares.items():
+            if share and user_id not in existing_splits:
+                db.session.add(ExpenseSplit(
+                    expense_id=self.id,
+                    user_id=user_id,
+                    amount=share,
+                    ))
 
-                if share == 0 and user.id in existing_splits:
-                    db.session.delete(existing_splits[user.id])
-                elif user.id in existing_splits:
-                    existing_splits[user.id].amount = share
-                else:
-                    new_split = ExpenseSplit(
-                        expense_id=self.id,
-                        user_id=user.id,
-                        amount=share,
-                        )
-                    db.session.add(new_split)
+        return sum(share for share in shares.values() if share)
 
-        return round(total_split, 2)
+
+# A group's ledger, newest first, as paged by get_group_expenses
+db.Index("ix_expenses_group_id_timestamp",
+         Expense.group_id, Expense.timestamp.desc(), Expense.id.desc())
 
 
 class ExpenseSplit(db.Model):
     __tablename__ = "expense_split"
+    __table_args__ = (
+        db.Index("ix_expense_split_user_id_expense_id",
+                 "user_id", "expense_id"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    expense_id = db.Column(
+        db.Integer,
+        db.ForeignKey("expenses.id", ondelete="CASCADE"),
+        index=True,
+        )
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    amount = db.Column(db.Integer)
+
+    @staticmethod
+    def activity_query(user_id):
+        """All of the user's activity, newest first, as one query.
+
+        Each row is a split the user is on either side of, joined with its
+        expense, group and counterparty.
+        """
+        counterparty = db.aliased(User)
+        you_paid = Expense.paid_by_id == user_id
+        # Narrows the OR below to the user's expenses through the paid_by
+        # and split indexes, instead of scanning every expense
+        involved = db.union(
+            db.select(Expense.id).where(you_paid),
+            db.select(ExpenseSplit.expense_id)
+            .where(ExpenseSplit.user_id == user_id),
+        )
+
+        return (
+            db.select(
+                Expense.description.label("description"),
+                db.case(
+                    (you_paid, ExpenseSplit.amount),
+                    else_=-ExpenseSplit.amount,
+                ).label("owed_amount"),
+                Expense.currency.label("currency"),
+                counterparty.name.label("counterparty_name"),
+                Group.name.label("group_name"),
+                Expense.timestamp.label("timestamp"),
+                Expense.kind.label("kind"),
+                ExpenseSplit.id.label("split_id"),
+            )
+            .select_from(ExpenseSplit)
+            .join(Expense, Expense.id == ExpenseSplit.expense_id)
+            .join(counterparty, counterparty.id == db.case(
+                (you_paid, ExpenseSplit.user_id),
+                else_=Expense.paid_by_id,
+            ))
+            .outerjoin(Group, Group.id == Expense.group_id)
+            .where(Expense.id.in_(involved))
+            .where(db.or_(
+                db.and_(you_paid,
+                        ExpenseSplit.user_id != user_id,
+                        ExpenseSplit.amount > 0),
+                db.and_(ExpenseSplit.user_id == user_id,
+                        Expense.paid_by_id != user_id),
+            ))
+            .order_by(Expense.timestamp.desc(), ExpenseSplit.id.desc())
+        )
+
+    @staticmethod
+    def activity_page_query(user_id, before=None, limit=50):
+        """One page of the user's activity, newest first.
+
+        Pages are keyed on (timestamp, split id); pass the last row's key
+        as `before` to fetch the next page.
+        """
+        query = ExpenseSplit.activity_query(user_id)
+        if before is not None:
+            timestamp, split_id = before
+            query = query.where(db.or_(
+                Expense.timestamp < timestamp,
+                db.and_(Expense.timestamp == timestamp,
+                        ExpenseSplit.id < split_id),
+            ))
+        return query.limit(limit)
+
+
+class Balance(db.Model):
+    """Materialized net balance of a user within a group, per currency.
+
+    Kept in sync by applying the deltas of every expense write, so reading
+    a balance never has to walk the expenses and splits. Each currency is
+    kept apart, exactly; they are only added up after converting (fx.py).
+    """
+    __tablename__ = "balances"
+    group_id = db.Column(
+        db.Integer,
+        db.ForeignKey("groups.id"),
+        primary_key=True,
+        )
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey("users.id"),
+        primary_key=True,
+        index=True,
+        )
+    currency = db.Column(db.String(3), primary_key=True)
+    amount = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def apply(group_id, deltas, sign=1):
+        """Add (or with sign=-1, subtract) {(user_id, currency): delta}
+        for a group"""
+        # Lets per-user caches (see summary.py) drop entries on commit
+        db.session.info.setdefault("touched_users", set()).update(
+            user_id for user_id, _ in deltas)
+        for (user_id, code), delta in deltas.items():
+            delta = sign * delta
+            if not delta:
+                continue
+            updated = (
+                Balance.query
+                .filter_by(group_id=group_id, user_id=user_id, currency=code)
+                .update({Balance.amount: Balance.amount + delta},
+                        synchronize_session=False)
+            )
+            if not updated:
+                db.session.add(Balance(group_id=group_id, user_id=user_id,
+                                       currency=code, amount=delta))
+
+    @staticmethod
+    def of_member_query(group_id, user_id):
+        """(currency, balance) of one member of a group"""
+        return db.select(Balance.currency, Balance.amount) \
+            .filter_by(group_id=group_id, user_id=user_id)
+
+    @staticmethod
+    def for_user_query(user_id):
+        """(group_id, currency, balance) for every group the user has one
+        in"""
+        return db.select(Balance.group_id, Balance.currency, Balance.amount) \
+            .filter_by(user_id=user_id)
+
+    @staticmethod
+    def by_group(rows):
+        """Rows of for_user_query as {group_id: {currency: balance}}"""
+        balances = defaultdict(dict)
+        for group_id, code, amount in rows:
+            if amount:
+                balances[group_id][code] = amount
+        return balances
+
+    @staticmethod
+    def for_user(user_id):
+        return Balance.by_group(
+            db.session.execute(Balance.for_user_query(user_id)))
+
+    @staticmethod
+    def overview_query(user_id):
+        """Every group and friend ledger of a user with their balance.
+
+        One query: memberships joined to groups, the user's balance rows
+        and, for friend ledgers, the friend. A ledger in several
+        currencies has a row for each; see `entries`.
+        """
+        friend = db.aliased(User)
+        friend_id = db.case(
+            (Friendship.min_user_id == user_id, Friendship.max_user_id),
+            else_=Friendship.min_user_id,
+        )
+        return (
+            db.select(
+                Group.id.label("group_id"),
+                Group.name.label("name"),
+                Group.is_friend_group.label("is_friend_group"),
+                friend.id.label("friend_id"),
+                friend.name.label("friend_name"),
+                Balance.currency.label("currency"),
+                db.func.coalesce(Balance.amount, 0).label("balance"),
+            )
+            .select_from(GroupMember)
+            .join(Group, Group.id == GroupMember.group_id)
+            .outerjoin(Balance, db.and_(Balance.group_id == Group.id,
+                                        Balance.user_id == user_id))
+            .outerjoin(Friendship, Friendship.group_id == Group.id)
+            .outerjoin(friend, friend.id == friend_id)
+            .where(GroupMember.user_id == user_id)
+            .order_by(Group.id)
+        )
+
+    @staticmethod
+    def entries(rows):
+        """Rows of overview_query, one dict per ledger, in order, with
+        {currency: balance} as `balances`"""
+        entries = {}
+        for row in rows:
+            entry = entries.setdefault(row.group_id, {
+                "group_id": row.group_id,
+                "name": row.name,
+                "is_friend_group": row.is_friend_group,
+                "friend_id": row.friend_id,
+                "friend_name": row.friend_name,
+                "balances": {},
+            })
+            if row.balance:
+                entry["balances"][row.currency] = row.balance
+        return list(entries.values())
+
+    @staticmethod
+    def overview(user_id):
+        return Balance.entries(
+            db.session.execute(Balance.overview_query(user_id)))
+
+    @staticmethod
+    def compute_all(group_ids=None):
+        """Recompute every (group_id, user_id, currency) balance from the
+        ledger, or only those of `group_ids`"""
+        totals = defaultdict(int)
+        if group_ids is None:
+            in_groups = Expense.group_id.isnot(None)
+        else:
+            in_groups = Expense.group_id.in_(group_ids)
+        paid = (
+            db.session.query(
+                Expense.group_id, Expense.paid_by_id, Expense.currency,
+                db.func.sum(Expense.amount))
+            .filter(in_groups)
+            .group_by(Expense.group_id, Expense.paid_by_id, Expense.currency)
+        )
+        for group_id, user_id, code, amount in paid:
+            totals[(group_id, user_id, code)] += amount or 0
+        owed = (
+            db.session.query(
+                Expense.group_id, ExpenseSplit.user_id, Expense.currency,
+                db.func.sum(ExpenseSplit.amount))
+            .join(Expense, Expense.id == ExpenseSplit.expense_id)
+            .filter(in_groups)
+            .group_by(Expense.group_id, ExpenseSplit.user_id,
+                      Expense.currency)
+        )
+        for group_id, user_id, code, amount in owed:
+            totals[(group_id, user_id, code)] -= amount or 0
+        return totals
+
+
+class MonthlySpend(db.Model):
+    """Monthly rollup of a group's spending, one row per member and month.
+
+    `paid` is what the member paid for the group's expenses that month
+    (over `paid_count` expenses) and `share` their part of them, in each
+    currency they were in. Kept in sync like Balance, by applying the
+    deltas of every expense write; analytics.rebuild_rollups recomputes it
+    from the ledger.
+    """
+    __tablename__ = "monthly_spend"
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("groups.id"), primary_key=True)
+    # "YYYY-MM"
+    month = db.Column(db.String(7), primary_key=True)
+    user_id = db.Column(
+        db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    currency = db.Column(db.String(3), primary_key=True)
+    paid = db.Column(db.Integer, nullable=False, default=0)
+    paid_count = db.Column(db.Integer, nullable=False, default=0)
+    share = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def month_of(timestamp):
+        return timestamp.strftime("%Y-%m")
+
+    @staticmethod
+    def apply(group_id, deltas, sign=1):
+        """Add (or with sign=-1, subtract) spend_deltas for a group.
+
+        Callers hold the group's write lock (Group.bump_version), so the
+        rows can be read and written back whole: three statements at
+        most, however many members and months the deltas touch.
+        """
+        changes = {
+            key: [sign * value for value in values]
+            for key, values in deltas.items() if any(values)
+        }
+        if not changes:
+            return
+        existing = {
+            (row.month, row.user_id, row.currency): row
+            for row in db.session.execute(
+                db.select(MonthlySpend.month, MonthlySpend.user_id,
+                          MonthlySpend.currency, MonthlySpend.paid,
+                          MonthlySpend.paid_count, MonthlySpend.share)
+                .where(MonthlySpend.group_id == group_id,
+                       MonthlySpend.month.in_({m for m, _, _ in changes})))
+        }
+        updates, inserts = [], []
+        for key, (paid, count, share) in changes.items():
+            month, user_id, code = key
+            row = {"group_id": group_id, "month": month, "user_id": user_id,
+                   "currency": code, "paid": paid, "paid_count": count,
+                   "share": share}
+            old = existing.get(key)
+            if old is None:
+                inserts.append(row)
+                continue
+            row["paid"] += old.paid
+            row["paid_count"] += old.paid_count
+            row["share"] += old.share
+            updates.append(row)
+        if updates:
+            db.session.execute(db.update(MonthlySpend), updates)
+        if inserts:
+            db.session.execute(db.insert(MonthlySpend), inserts)
+
+    @staticmethod
+    def change(old, new):
+        """spend_deltas turning `old` into `new`, e.g. for an edit; rows
+        the edit didn't touch come out as zeros, which apply skips"""
+        deltas = defaultdict(lambda: [0, 0, 0])
+        for key, values in new.items():
+            deltas[key] = list(values)
+        for key, values in old.items():
+            deltas[key] = [n - o for n, o in zip(deltas[key], values)]
+        return deltas
+
+    @staticmethod
+    def for_group_query(group_id, since):
+        """A group's rollup rows from month `since` on, with member names"""
+        return (
+            db.select(MonthlySpend.month, MonthlySpend.user_id, User.name,
+                      MonthlySpend.currency, MonthlySpend.paid,
+                      MonthlySpend.paid_count, MonthlySpend.share)
+            .join(User, User.id == MonthlySpend.user_id)
+            .where(MonthlySpend.group_id == group_id,
+                   MonthlySpend.month >= since)
+            .order_by(MonthlySpend.month, MonthlySpend.user_id)
+        )
+
+
+class ExpenseEvent(db.Model):
+    """One expense created, edited or deleted; never updated afterwards.
+
+    Expenses themselves are edited and deleted in place, so this is their
+    history: `data` is the expense after the change (before it, for a
+    delete) and `deltas` the change's net effect on members' balances,
+    both as JSON. Replaying a group's events from a BalanceSnapshot gives
+    its balances at any point since (see eventlog.py). Imports and
+    settlements are logged like any other write.
+    """
+    __tablename__ = "expense_events"
+    __table_args__ = (
+        db.Index("ix_expense_events_group_id_id", "group_id", "id"),
+        # Ids only ever grow, even once compact-events has deleted the
+        # newest rows: snapshots are taken at an id
+        {"sqlite_autoincrement": True},
+    )
+    CREATED = "created"
+    EDITED = "edited"
+    DELETED = "deleted"
+    # What `data` records of an expense, besides its splits
+    FIELDS = ("description", "amount", "currency", "paid_by_id", "kind",
+              "timestamp")
+
     id = db.Column(db.Integer, primary_key=True)
-    expense_id = db.Column(db.Integer, db.ForeignKey("expenses.id"))
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("groups.id"), nullable=False)
+    # No foreign key: the events of a deleted expense stay
+    expense_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    # Who made the change, or queued the job that did; None for commands
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
-    amount = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    data = db.Column(db.Text, nullable=False)
+    # [[user_id, currency, delta], ...]
+    deltas = db.Column(db.Text, nullable=False)
+
+    @staticmethod
+    def change(kind, expense, splits, deltas):
+        """An event's row, for `record`.
+
+        `expense` is an Expense or an expense row as the importer inserts
+        it (with its id), `splits` its (user_id, amount) pairs and
+        `deltas` {(user_id, currency): delta}, as from balance_deltas.
+        """
+        if not isinstance(expense, dict):
+            expense = {name: getattr(expense, name)
+                       for name in ("id", *ExpenseEvent.FIELDS)}
+        data = {name: expense.get(name) for name in ExpenseEvent.FIELDS}
+        if data["timestamp"] is not None:
+            data["timestamp"] = data["timestamp"].isoformat()
+        data["splits"] = {
+            str(user_id): amount for user_id, amount in dict(splits).items()}
+        return {
+            "expense_id": expense["id"],
+            "kind": kind,
+            "data": json.dumps(data),
+            "deltas": BalanceSnapshot.encode(deltas),
+        }
+
+    @staticmethod
+    def record(group_id, changes, user_id=None):
+        """Append the events of one write to a group, and snapshot its
+        balances if enough have built up since the last snapshot.
+
+        Callers hold the group's write lock (Group.bump_version), so
+        events are appended in the order the writes happened.
+        """
+        if not changes:
+            return
+        now = datetime.now()
+        db.session.execute(db.insert(ExpenseEvent), [
+            {**change, "group_id": group_id, "user_id": user_id,
+             "created_at": now}
+            for change in changes
+        ])
+        if BalanceSnapshot.due(group_id):
+            BalanceSnapshot.take(group_id)
+
+
+class BalanceSnapshot(db.Model):
+    """A group's balances as of its event `event_id`, as JSON
+    [[user_id, currency, balance], ...].
+
+    Taken every EVENT_SNAPSHOT_EVERY events by replaying the events since
+    the previous snapshot, so balances as of any time only replay the
+    events after the nearest snapshot. The group's history starts at its
+    first snapshot if there are no events up to it: the baseline of a
+    group whose expenses predate the log (`event_id` 0), or what
+    `flask compact-events` left.
+    """
+    __tablename__ = "balance_snapshots"
+    group_id = db.Column(
+        db.Integer, db.ForeignKey("groups.id"), primary_key=True)
+    event_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # When the event it was taken after happened
+    taken_at = db.Column(db.DateTime, nullable=False)
+    balances = db.Column(db.Text, nullable=False)
+
+    # Events between snapshots, unless EVENT_SNAPSHOT_EVERY says otherwise
+    EVERY = 100
+
+    @staticmethod
+    def every():
+        return int(current_app.config.get(
+            "EVENT_SNAPSHOT_EVERY",
+            os.environ.get("EVENT_SNAPSHOT_EVERY", BalanceSnapshot.EVERY)))
+
+    @staticmethod
+    def latest_id_query(group_id):
+        """The event id of the group's latest snapshot, or 0"""
+        return (
+            db.select(db.func.coalesce(db.func.max(BalanceSnapshot.event_id),
+                                       0))
+            .where(BalanceSnapshot.group_id == group_id)
+            .scalar_subquery()
+        )
+
+    @staticmethod
+    def due(group_id):
+        pending = db.session.scalar(
+            db.select(db.func.count())
+            .select_from(ExpenseEvent)
+            .where(ExpenseEvent.group_id == group_id,
+                   ExpenseEvent.id > BalanceSnapshot.latest_id_query(
+                       group_id)))
+        return pending >= BalanceSnapshot.every()
+
+    @staticmethod
+    def replay(group_id, until=None):
+        """(last event id, {(user_id, currency): balance}) of a group as of
+        `until` (a datetime), or now: its nearest snapshot and the events
+        after it. Balances of zero are left out.
+
+        Raises LookupError if the group's history doesn't go back that
+        far.
+        """
+        snapshot = db.session.scalars(
+            BalanceSnapshot.nearest_query(group_id, until)).first()
+        if snapshot is None and until is not None:
+            BalanceSnapshot.check_history(group_id)
+        return BalanceSnapshot.fold(snapshot, db.session.execute(
+            BalanceSnapshot.events_query(group_id, snapshot, until)))
+
+    # nearest_query, events_query, first_query, check_first and fold are
+    # the steps of replay(), for callers that run its queries themselves
+    # (see asgi.py)
+
+    @staticmethod
+    def nearest_query(group_id, until=None):
+        """The group's latest snapshot, taken by `until` if given"""
+        query = (
+            db.select(BalanceSnapshot)
+            .where(BalanceSnapshot.group_id == group_id)
+            .order_by(BalanceSnapshot.event_id.desc())
+            .limit(1)
+        )
+        if until is not None:
+            query = query.where(BalanceSnapshot.taken_at <= until)
+        return query
+
+    @staticmethod
+    def events_query(group_id, snapshot, until=None):
+        """(id, deltas) of the group's events after `snapshot` (or all of
+        them), recorded by `until` if given"""
+        query = (
+            db.select(ExpenseEvent.id, ExpenseEvent.deltas)
+            .where(ExpenseEvent.group_id == group_id,
+                   ExpenseEvent.id > (snapshot.event_id if snapshot else 0))
+            .order_by(ExpenseEvent.id)
+        )
+        if until is not None:
+            query = query.where(ExpenseEvent.created_at <= until)
+        return query
+
+    @staticmethod
+    def fold(snapshot, events):
+        """replay's result from a snapshot (or None) and the (id, deltas)
+        of the events after it"""
+        last, balances = 0, defaultdict(int)
+        if snapshot is not None:
+            last = snapshot.event_id
+            for user_id, code, amount in json.loads(snapshot.balances):
+                balances[(user_id, code)] = amount
+        for event_id, deltas in events:
+            last = event_id
+            for user_id, code, delta in json.loads(deltas):
+                balances[(user_id, code)] += delta
+        return last, {key: amount for key, amount in balances.items()
+                      if amount}
+
+    @staticmethod
+    def first_query(group_id):
+        """(event_id, taken_at, the group's first event id) of its first
+        snapshot"""
+        first_event = (
+            db.select(db.func.min(ExpenseEvent.id))
+            .where(ExpenseEvent.group_id == group_id)
+            .scalar_subquery()
+        )
+        return (
+            db.select(BalanceSnapshot.event_id, BalanceSnapshot.taken_at,
+                      first_event.label("first_event"))
+            .where(BalanceSnapshot.group_id == group_id)
+            .order_by(BalanceSnapshot.event_id)
+            .limit(1)
+        )
+
+    @staticmethod
+    def check_history(group_id):
+        """Raise LookupError if compact-events has deleted the group's
+        events before its first snapshot; replay() asks when no snapshot
+        was taken by the time it replays to"""
+        BalanceSnapshot.check_first(db.session.execute(
+            BalanceSnapshot.first_query(group_id)).first())
+
+    @staticmethod
+    def check_first(first):
+        """check_history's test of first_query's row"""
+        if first is None:
+            return
+        if first.first_event is None or first.first_event > first.event_id:
+            raise LookupError(
+                f"The group's history starts at {first.taken_at:%Y-%m-%d}.")
+
+    @staticmethod
+    def encode(balances):
+        """{(user_id, currency): amount} as stored, zeros left out"""
+        return json.dumps(sorted(
+            [user_id, code, amount]
+            for (user_id, code), amount in balances.items() if amount))
+
+    @staticmethod
+    def take(group_id):
+        """Snapshot the group's balances as of its latest event"""
+        last, balances = BalanceSnapshot.replay(group_id)
+        taken_at = db.session.scalar(
+            db.select(ExpenseEvent.created_at)
+            .where(ExpenseEvent.id == last))
+        db.session.add(BalanceSnapshot(
+            group_id=group_id, event_id=last, taken_at=taken_at,
+            balances=BalanceSnapshot.encode(balances)))
+
+
+class FxRate(db.Model):
+    """How many units of `currency` one unit of the base currency bought on
+    a day (see fx.py), as loaded by `flask import-rates`."""
+    __tablename__ = "fx_rates"
+    currency = db.Column(db.String(3), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    rate = db.Column(db.Numeric(18, 8), nullable=False)
+    # When the row was last loaded; its latest value stamps the table
+    imported_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.now, index=True)
+
+    @staticmethod
+    def latest_query(currencies, day):
+        """(currency, rate): each currency's latest rate on or before `day`,
+        one primary key lookup per currency"""
+        latest = [
+            db.select(FxRate.currency, FxRate.rate)
+            .where(FxRate.currency == code, FxRate.day <= day)
+            .order_by(FxRate.day.desc())
+            .limit(1)
+            .subquery()
+            for code in sorted(currencies)
+        ]
+        return db.union_all(*(db.select(*rate.c) for rate in latest))
+
+    @staticmethod
+    def currencies_query(day):
+        """Every currency with a rate on or before `day`"""
+        return (
+            db.select(FxRate.currency).where(FxRate.day <= day)
+            .group_by(FxRate.currency).order_by(FxRate.currency)
+        )
+
+    @staticmethod
+    def stamp_query():
+        """When rates were last loaded, so caches can tell they changed"""
+        return db.select(db.func.max(FxRate.imported_at))
@@ -0,0 +1,164 @@
+"""Checks that the app's hot queries are served by indexes.
+
+The main pages are requested through the test client, as a member of the
+busiest group, while every SQL statement they run is recorded. Each one is
+then run through SQLite's EXPLAIN QUERY PLAN, and any step that walks a
+whole table ("SCAN expenses") instead of searching an index is reported.
+A dropped index, or a query rewritten so it no longer uses one, shows up
+here long before it shows up as a slow page on a large database.
+
+On a small database SQLite rightly scans a table of a few hundred rows
+rather than search an index, so scans of tables with fewer than
+`min_rows` rows aren't reported; pass 0 to report them all.
+"""
+from datetime import date
+import re
+
+from sqlalchemy import event
+
+import fragments
+from helper import encode_cursor
+from models import db, Expense, Friendship, Group, GroupMember
+
+# Tables that grow with usage; scanning anything else (a subquery, a CTE)
+# is fine
+TABLES = {"users", "groups", "group_members", "friendships", "expenses",
+          "expense_split", "balances", "sessions", "user_search",
+          "monthly_spend", "expense_events", "balance_snapshots"}
+
+SCAN = re.compile(r"^SCAN (\w+)")
+
+# Tables smaller than this are cheaper to scan than to search
+MIN_ROWS = 10000
+
+
+def pick_subject():
+    """(user id, group id, friend group id, expense id) to check as"""
+    group_id = db.session.scalar(
+        db.select(GroupMember.group_id)
+        .join(Group, Group.id == GroupMember.group_id)
+        .where(Group.is_friend_group.is_(False))
+        .group_by(GroupMember.group_id)
+        .order_by(db.func.count().desc())
+        .limit(1)
+    )
+    if group_id is None:
+        return None
+    user_id = db.session.scalar(
+        db.select(GroupMember.user_id).filter_by(group_id=group_id).limit(1))
+    friend_group_id = db.session.scalar(
+        db.select(Friendship.group_id)
+        .where(Friendship.involving(user_id)).limit(1))
+    expense = db.session.scalars(
+        db.select(Expense).filter_by(group_id=group_id).limit(1)).first()
+    return user_id, group_id, friend_group_id, expense
+
+
+def pages(group_id, friend_group_id, expense):
+    yield "/"
+    yield "/groups"
+    yield "/friends"
+    yield f"/group/{group_id}"
+    yield f"/group/{group_id}/settle"
+    yield "/history"
+    yield "/api/v1/me/balances"
+    yield f"/api/v1/groups/{group_id}/expenses"
+    yield "/create_friend"
+    yield f"/invite-friends/{group_id}"
+    yield "/api/v1/users/search?q=us"
+    yield f"/api/v1/users/search?q=us&group_id={group_id}"
+    yield f"/group/{group_id}/analytics"
+    yield f"/api/v1/groups/{group_id}/balances"
+    yield f"/api/v1/groups/{group_id}/analytics?months=24"
+    yield "/search?q=dinner"
+    yield f"/search?q=din&group_id={group_id}&min_amount=1"
+    yield f"/api/v1/expenses/search?group_id={group_id}&since=2000-01-01"
+    yield f"/group/{group_id}/add_expense"
+    yield "/profile"
+    yield f"/api/v1/groups/{group_id}/events"
+    yield f"/api/v1/groups/{group_id}/balances-as-of?date={date.today()}"
+    if friend_group_id is not None:
+        yield f"/friend/{friend_group_id}"
+    if expense is not None:
+        cursor = encode_cursor(expense.timestamp, expense.id)
+        yield f"/group/{group_id}?before={cursor}"
+        yield f"/history?before={cursor}"
+        yield f"/group/{group_id}/edit_expense/{expense.id}"
+
+
+def record_statements(app, user_id, paths):
+    """{(statement, parameters): first path that ran it}"""
+    statements = {}
+    current = [None]
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.setdefault((statement, parameters), current[0])
+
+    # Rendered fragments would hide the queries behind them
+    cache = app.extensions["fragments"]
+    app.extensions["fragments"] = fragments.LocalCache(0)
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session["user_id"] = user_id
+            for path in paths:
+                current[0] = path
+                response = client.get(path)
+                response.get_data()
+                if response.status_code != 200:
+                    raise RuntimeError(f"GET {path}: {response.status}")
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+        app.extensions["fragments"] = cache
+    return statements
+
+
+def small_tables(min_rows):
+    """The tables of TABLES with fewer than `min_rows` rows"""
+    if not min_rows:
+        return set()
+    with db.engine.connect() as connection:
+        return {
+            table for table in TABLES
+            if connection.exec_driver_sql(
+                f"SELECT count(*) FROM (SELECT 1 FROM {table} "
+                f"LIMIT {int(min_rows)})").scalar() < min_rows
+        }
+
+
+def full_scans(statement, parameters, ignore=()):
+    """Steps of the statement's plan that scan a whole table, other than
+    the tables in `ignore`"""
+    with db.engine.connect() as connection:
+        plan = connection.exec_driver_sql(
+            "EXPLAIN QUERY PLAN " + statement, parameters).all()
+    scans = []
+    for row in plan:
+        detail = row[-1]
+        match = SCAN.match(detail)
+        if match and match.group(1) in TABLES - set(ignore):
+            scans.append(detail)
+    return scans
+
+
+def check(app, min_rows=MIN_ROWS):
+    """(path, statement, scans) for every statement that scans a table of
+    at least `min_rows` rows"""
+    subject = pick_subject()
+    if subject is None:
+        raise ValueError("The database has no groups to check with.")
+    user_id, group_id, friend_group_id, expense = subject
+
+    problems = []
+    small = small_tables(min_rows)
+    paths = list(pages(group_id, friend_group_id, expense))
+    for (statement, parameters), path in record_statements(
+            app, user_id, paths).items():
+        if not statement.lstrip().upper().startswith("SELECT"):
+            continue
+        scans = full_scans(statement, parameters, ignore=small)
+        if scans:
+            problems.append((path, statement, scans))
+    return problems
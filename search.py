@@ -0,0 +1,189 @@
+"""Full-text search over expense descriptions.
+
+On SQLite, descriptions are indexed in `expense_search`, an FTS5 table
+whose content is the expenses table itself; triggers on `expenses` (see
+migration 0005) keep it in step with every insert, edit and delete,
+including the importer's bulk inserts that bypass the ORM. On PostgreSQL
+the same queries use a GIN index on the description's tsvector instead.
+Other databases have no index to search: there, every word has to appear
+in the description (a plain LIKE), and matches are newest first.
+
+Searches only ever see expenses in the groups the user belongs to. Text
+matches are ranked best first (bm25 / ts_rank); without text, results
+are newest first. Filters by group, payer and date narrow the search
+through the expenses indexes; the amount range, which is in one currency
+and only matches expenses in it, is checked on the rows those select.
+"""
+from datetime import date, datetime, time, timedelta
+import re
+
+from helper import to_minor
+from models import db, Expense, GroupMember, User
+import database
+import fx
+
+SEARCH_TABLE = "expense_search"
+POSTGRESQL_INDEX = "ix_expenses_description_fts"
+
+# Most results one page returns
+MAX_RESULTS = 100
+
+_WORD = re.compile(r"\w+")
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Keep autogenerate away from the search index, which isn't a model"""
+    if type_ == "table":
+        return not name.startswith(SEARCH_TABLE)
+    return not (type_ == "index" and name == POSTGRESQL_INDEX)
+
+
+def terms(text):
+    """The words of a search, as the tokenizer would see them"""
+    return _WORD.findall(text or "")
+
+
+def payer_query(username):
+    return db.select(User.id).filter_by(username=username)
+
+
+def parse_filters(args, payer_id=None, currencies=None):
+    """Search filters from a query string.
+
+    Raises ValueError, with a message for the user, for a filter that
+    can't be understood. Callers that look them up themselves (see
+    asgi.py) pass the id of the `payer` username and fx.currencies().
+    """
+    filters = {}
+    group_id = args.get("group_id", "").strip()
+    if group_id:
+        if not group_id.isdigit():
+            raise ValueError("Unknown group.")
+        filters["group_id"] = int(group_id)
+
+    payer = args.get("payer", "").strip()
+    if payer:
+        if payer_id is None:
+            payer_id = db.session.scalar(payer_query(payer))
+        if payer_id is None:
+            raise ValueError(f"No user with the username {payer!r}.")
+        filters["payer_id"] = payer_id
+
+    code = args.get("currency", "").strip().upper()
+    if code:
+        if code not in (currencies or fx.currencies()):
+            raise ValueError(f"Unknown currency: {code!r}")
+        filters["currency"] = code
+
+    for name in ("min_amount", "max_amount"):
+        value = args.get(name, "").strip()
+        if value:
+            # Amounts are in the currency searched for, or the viewer's
+            filters.setdefault("currency", fx.viewer_currency())
+            filters[name] = to_minor(value, filters["currency"])
+
+    for name in ("since", "until"):
+        value = args.get(name, "").strip()
+        if value:
+            try:
+                filters[name] = date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Invalid date: {value!r}")
+    return filters
+
+
+def _sqlite_match(query, words):
+    """Every word, as a prefix, anywhere in the description"""
+    fts = db.table(SEARCH_TABLE, db.column("rowid"), db.column("rank"))
+    expression = " ".join('"%s"*' % word for word in words)
+    query = query.join(fts, fts.c.rowid == Expense.id).where(
+        db.literal_column(SEARCH_TABLE).match(expression))
+    return query, fts.c.rank
+
+
+def _postgresql_match(query, words):
+    # Spelled exactly as the index expression, so the index is used
+    vector = db.func.to_tsvector(
+        db.literal_column("'simple'::regconfig"),
+        db.func.coalesce(Expense.description, db.literal_column("''")))
+    tsquery = db.func.to_tsquery(
+        db.literal_column("'simple'::regconfig"),
+        " & ".join(f"{word}:*" for word in words))
+    query = query.where(vector.op("@@")(tsquery))
+    # Lower is better, as with FTS5's rank
+    return query, -db.func.ts_rank(vector, tsquery)
+
+
+def _like_match(query, words):
+    """Every word anywhere in the description, newest first"""
+    for word in words:
+        query = query.where(
+            Expense.description.icontains(word, autoescape=True))
+    return query, Expense.timestamp.desc()
+
+
+MATCHERS = {
+    "sqlite": _sqlite_match,
+    "postgresql": _postgresql_match,
+}
+
+
+def search_query(user_id, text="", group_id=None, payer_id=None,
+                 currency=None, min_amount=None, max_amount=None,
+                 since=None, until=None):
+    """Expenses visible to `user_id` matching the text and filters.
+
+    `since` and `until` are dates, both inclusive; amounts are minor
+    units of `currency`.
+    """
+    my_groups = db.select(GroupMember.group_id).where(
+        GroupMember.user_id == user_id)
+    query = db.select(Expense).where(Expense.group_id.in_(my_groups))
+
+    if group_id is not None:
+        query = query.where(Expense.group_id == group_id)
+    if payer_id is not None:
+        query = query.where(Expense.paid_by_id == payer_id)
+    if since is not None:
+        query = query.where(
+            Expense.timestamp >= datetime.combine(since, time.min))
+    if until is not None:
+        query = query.where(Expense.timestamp < datetime.combine(
+            until + timedelta(days=1), time.min))
+    if currency is not None:
+        query = query.where(Expense.currency == currency)
+    if min_amount is not None:
+        query = query.where(Expense.amount >= min_amount)
+    if max_amount is not None:
+        query = query.where(Expense.amount <= max_amount)
+
+    words = terms(text)
+    if words:
+        match = MATCHERS.get(db.engine.dialect.name, _like_match)
+        query, rank = match(query, words)
+        return query.order_by(rank, Expense.id.desc())
+    return query.order_by(Expense.timestamp.desc(), Expense.id.desc())
+
+
+def page_query(user_id, text="", page=1, limit=20, **filters):
+    """The query for one page of results, or None if there's nothing to
+    search for"""
+    if not terms(text) and not filters:
+        return None
+    page = max(page, 1)
+    return (
+        search_query(user_id, text, **filters)
+        .options(db.joinedload(Expense.payer), db.joinedload(Expense.group))
+        # Fetch one extra row to know whether another page exists
+        .limit(limit + 1).offset((page - 1) * limit)
+    )
+
+
+def search_expenses(user_id, text="", page=1, limit=20, **filters):
+    """One page of results: (expenses, whether there is a next page)"""
+    query = page_query(user_id, text, page, limit, **filters)
+    if query is None:
+        return [], False
+    expenses = db.session.scalars(
+        query, bind_arguments=database.reads()).all()
+    return expenses[:limit], len(expenses) > limit
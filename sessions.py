@@ -0,0 +1,257 @@
+"""Pluggable session storage.
+
+`SESSION_BACKEND` (app config or environment) selects where session data
+lives:
+
+    cookie      cookie signed with SECRET_KEY, Flask's default; no
+                server-side I/O (default)
+    sql         `sessions` table with an indexed expiry column, fronted by
+                an in-process LRU and pruned by a background sweeper
+    filesystem  Flask-Session's file store (the previous behaviour)
+
+The LRU saves a database read per request, but it is per process: a change
+made by another process (a logout on another host, say) is only seen once
+the cached entry's `SESSION_CACHE_TTL` runs out. Set `SESSION_CACHE_SIZE`
+to 0 to always read through to the table.
+
+Anyone who knows the key can sign a cookie for any user, so the cookie
+backend refuses to start without a SECRET_KEY, or with the placeholder
+the app used to ship with.
+"""
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock, Thread
+import os
+import secrets
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from flask_session import Session
+from werkzeug.datastructures import CallbackDict
+
+from models import db
+
+DEFAULTS = {
+    "SESSION_BACKEND": "cookie",
+    "SESSION_CACHE_SIZE": 10000,
+    "SESSION_CACHE_TTL": 30,
+    "SESSION_SWEEP_INTERVAL": 300,
+    "SESSION_SWEEP_BATCH": 1000,
+}
+
+# Keys that are public knowledge, and sign nothing
+INSECURE_KEYS = {"", "your_secret_key"}
+
+
+class StoredSession(db.Model):
+    __tablename__ = "sessions"
+    id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class SqlSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, cache_size, cache_ttl, sweep_interval, sweep_batch):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.sweep_interval = sweep_interval
+        self.sweep_batch = sweep_batch
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self._sweeper = None
+
+    # In-process LRU of sid -> (cached until, expires_at, data)
+
+    def _cache_get(self, sid):
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._cache[sid]
+                return None
+            self._cache.move_to_end(sid)
+            return entry[1], entry[2]
+
+    def _cache_put(self, sid, expires_at, data):
+        if not self.cache_size:
+            return
+        with self._lock:
+            self._cache[sid] = (
+                time.monotonic() + self.cache_ttl, expires_at, data)
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, sid):
+        with self._lock:
+            self._cache.pop(sid, None)
+
+    def _load(self, sid):
+        cached = self._cache_get(sid)
+        if cached is None:
+            with db.engine.connect() as connection:
+                row = connection.execute(
+                    db.select(StoredSession.expires_at, StoredSession.data)
+                    .where(StoredSession.id == sid)
+                ).first()
+            if row is None:
+                return None
+            cached = tuple(row)
+            self._cache_put(sid, *cached)
+        expires_at, data = cached
+        if expires_at <= datetime.now():
+            return None
+        return expires_at, self.serializer.loads(data)
+
+    def open_session(self, app, request):
+        self._start_sweeper(app)
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            loaded = self._load(sid)
+            if loaded is not None:
+                expires_at, data = loaded
+                session = ServerSideSession(data, sid=sid)
+                session.expires_at = expires_at
+                return session
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self._delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        lifetime = app.permanent_session_lifetime
+        expires_at = getattr(session, "expires_at", None)
+        # Only write when the data changed or half the lifetime has passed,
+        # so most requests cost no database writes at all
+        stale = expires_at is None or \
+            expires_at - datetime.now() < lifetime / 2
+        if session.modified or stale:
+            expires_at = datetime.now() + lifetime
+            data = self.serializer.dumps(dict(session))
+            self._store(session.sid, expires_at, data)
+            self._cache_put(session.sid, expires_at, data)
+
+        if session.modified or session.new or stale:
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    # Session rows are written on their own connection so saving a session
+    # never commits (or is rolled back with) the view's ORM session
+
+    def _store(self, sid, expires_at, data):
+        values = {"data": data, "expires_at": expires_at}
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                db.update(StoredSession)
+                .where(StoredSession.id == sid)
+                .values(**values)
+            ).rowcount
+            if not updated:
+                connection.execute(
+                    db.insert(StoredSession).values(id=sid, **values))
+
+    def _delete(self, sid):
+        self._cache_drop(sid)
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.delete(StoredSession).where(StoredSession.id == sid))
+
+    def _start_sweeper(self, app):
+        if self._sweeper is not None or not self.sweep_interval:
+            return
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = Thread(
+                target=self._sweep_forever, args=(app,), daemon=True,
+                name="session-sweeper")
+            self._sweeper.start()
+
+    def _sweep_forever(self, app):
+        while True:
+            time.sleep(self.sweep_interval)
+            with app.app_context():
+                try:
+                    sweep_expired(self.sweep_batch)
+                except Exception:
+                    app.logger.exception("Session sweep failed")
+
+
+def sweep_expired(batch_size=DEFAULTS["SESSION_SWEEP_BATCH"]):
+    """Delete expired sessions in batches; returns how many were removed.
+
+    Each batch is its own short transaction, found through the expiry
+    index, so sweeping never holds the write lock for long.
+    """
+    removed = 0
+    while True:
+        expired = (
+            db.select(StoredSession.id)
+            .where(StoredSession.expires_at <= datetime.now())
+            .limit(batch_size)
+        )
+        with db.engine.begin() as connection:
+            deleted = connection.execute(
+                db.delete(StoredSession)
+                .where(StoredSession.id.in_(expired))
+            ).rowcount
+        removed += deleted
+        if deleted < batch_size:
+            return removed
+
+
+def _setting(app, name):
+    value = app.config.get(name, os.environ.get(name, DEFAULTS[name]))
+    return value if name == "SESSION_BACKEND" else int(value)
+
+
+def init_app(app):
+    """Install the session backend selected by SESSION_BACKEND"""
+    backend = _setting(app, "SESSION_BACKEND")
+    if backend == "cookie":
+        if app.secret_key is None or app.secret_key in INSECURE_KEYS:
+            raise ValueError(
+                "Session cookies need a SECRET_KEY: set it to a long random "
+                "value, or choose a server-side SESSION_BACKEND.")
+        return
+    if backend == "filesystem":
+        app.config.setdefault("SESSION_TYPE", "filesystem")
+        Session(app)
+    elif backend == "sql":
+        app.session_interface = SqlSessionInterface(
+            cache_size=_setting(app, "SESSION_CACHE_SIZE"),
+            cache_ttl=_setting(app, "SESSION_CACHE_TTL"),
+            sweep_interval=_setting(app, "SESSION_SWEEP_INTERVAL"),
+            sweep_batch=_setting(app, "SESSION_SWEEP_BATCH"),
+        )
+    else:
+        raise ValueError(f"Unknown SESSION_BACKEND {backend!r}")
@@ -0,0 +1,132 @@
+"""Per-user dashboard stats, computed in one query and cached.
+
+Cached summaries are dropped when a commit touches the user: a balance
+change (every expense write goes through `Balance.apply`), an expense they
+paid, a split of theirs or a group membership. Entries also expire after
+`TTL` seconds, bounding staleness when several processes serve the app.
+"""
+from collections import OrderedDict
+from threading import Lock
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Balance, Expense, ExpenseSplit, Friendship, Group
+from models import GroupMember
+
+TTL = 300
+MAX_ENTRIES = 10000
+
+_cache = OrderedDict()
+_lock = Lock()
+
+
+class UserSummary:
+    def __init__(self, net_balance, num_groups, num_friends, total_spent):
+        # Balance and spending are {currency: amount}, converted when shown
+        self.net_balance = net_balance
+        self.num_groups = num_groups
+        self.num_friends = num_friends
+        self.total_spent = total_spent
+
+    @staticmethod
+    def for_user(user_id):
+        summary = UserSummary.cached(user_id)
+        if summary is None:
+            summary = UserSummary.compute(user_id)
+            UserSummary.remember(user_id, summary)
+        return summary
+
+    @staticmethod
+    def cached(user_id):
+        """The user's cached summary, or None if missing or expired"""
+        with _lock:
+            entry = _cache.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                _cache.move_to_end(user_id)
+                return entry[1]
+        return None
+
+    @staticmethod
+    def remember(user_id, summary):
+        with _lock:
+            _cache[user_id] = (time.monotonic() + TTL, summary)
+            _cache.move_to_end(user_id)
+            while len(_cache) > MAX_ENTRIES:
+                _cache.popitem(last=False)
+
+    @staticmethod
+    def compute(user_id):
+        return UserSummary.from_rows(
+            db.session.execute(UserSummary.query(user_id)))
+
+    @staticmethod
+    def query(user_id):
+        """All four stats in a single round trip, as (stat, currency,
+        value) rows: balance and spending per currency, the counts with
+        no currency"""
+        def stat(name):
+            return db.literal(name, db.String).label("stat")
+
+        return db.union_all(
+            db.select(stat("net_balance"), Balance.currency,
+                      db.func.sum(Balance.amount))
+            .where(Balance.user_id == user_id)
+            .group_by(Balance.currency),
+            db.select(stat("num_groups"), db.null(), db.func.count())
+            .select_from(GroupMember)
+            .join(Group, Group.id == GroupMember.group_id)
+            .where(GroupMember.user_id == user_id,
+                   db.not_(Group.is_friend_group)),
+            db.select(stat("num_friends"), db.null(), db.func.count())
+            .select_from(Friendship)
+            .where(Friendship.involving(user_id)),
+            db.select(stat("total_spent"), Expense.currency,
+                      db.func.sum(Expense.amount))
+            .where(Expense.paid_by_id == user_id,
+                   Expense.kind == Expense.EXPENSE)
+            .group_by(Expense.currency),
+        )
+
+    @staticmethod
+    def from_rows(rows):
+        stats = {"net_balance": {}, "num_groups": 0, "num_friends": 0,
+                 "total_spent": {}}
+        for name, code, value in rows:
+            if code is None:
+                stats[name] = value or 0
+            elif value:
+                stats[name][code] = value
+        return UserSummary(**stats)
+
+    @staticmethod
+    def invalidate(user_ids):
+        with _lock:
+            for user_id in user_ids:
+                _cache.pop(user_id, None)
+
+
+def _touched(session):
+    return session.info.setdefault("touched_users", set())
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_touched_users(session, flush_context):
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, (GroupMember, ExpenseSplit)):
+            _touched(session).add(obj.user_id)
+        elif isinstance(obj, Expense):
+            _touched(session).add(obj.paid_by_id)
+        elif isinstance(obj, Friendship):
+            _touched(session).update((obj.min_user_id, obj.max_user_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_touched_users(session):
+    UserSummary.invalidate(session.info.pop("touched_users", ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_touched_users(session):
+    session.info.pop("touched_users", None)
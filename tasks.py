@@ -0,0 +1,127 @@
+"""The heavy operations that run as background jobs (see jobs.py).
+
+Each handler takes the job context plus its JSON payload and returns a
+JSON result, which the job page (templates/job.html) turns into a message.
+"""
+import itertools
+
+import analytics
+import eventlog
+import exporter
+import importer
+import jobs
+from models import db, Balance, Expense, Group
+
+EXPORTS = {
+    "csv": (exporter.group_csv, "text/csv"),
+    "json": (exporter.group_json, "application/json"),
+}
+
+
+@jobs.task("import_expenses")
+def import_expenses(job, group_id, filename):
+    """Import an uploaded file; a retry resumes after the last batch"""
+    group = db.session.get(Group, group_id)
+    reader = importer.READERS[filename.rsplit(".", 1)[-1].lower()]
+    with open(job.path(filename), encoding="utf-8-sig", newline="") as stream:
+        done = job.progress
+        records = itertools.islice(reader(stream), done, None)
+        result = importer.import_expenses(
+            group, records, progress=lambda read: job.report(done + read),
+            user_id=job.user_id)
+    return {
+        "group_id": group_id,
+        "imported": result.imported,
+        "errors": result.errors[:100],
+        "skipped": len(result.errors),
+    }
+
+
+@jobs.task("export_group")
+def export_group(job, group_id, fmt):
+    write, mimetype = EXPORTS[fmt]
+    total = db.session.scalar(
+        db.select(db.func.count(Expense.id)).filter_by(group_id=group_id))
+    job.report(0, total)
+    filename = f"group-{group_id}.{fmt}"
+    _write(job.path(filename), write(group_id, progress=job.report))
+    return {"group_id": group_id, "file": filename, "mimetype": mimetype}
+
+
+@jobs.task("export_history")
+def export_history(job, user_id):
+    filename = "history.csv"
+    _write(job.path(filename),
+           exporter.history_csv(user_id, progress=job.report))
+    return {"file": filename, "mimetype": "text/csv"}
+
+
+def _write(path, chunks):
+    with open(path, "w", encoding="utf-8", newline="") as out:
+        out.writelines(chunks)
+
+
+@jobs.task("settle_group")
+def settle_group(job, group_id):
+    """Record the fewest transfers that settle the group as it is now"""
+    group = db.session.get(Group, group_id)
+    # Lock the ledger first, so the plan settles its current state
+    Group.bump_version(group.id)
+    plan = group.settlement_plan()
+    if plan:
+        group.record_settlement(plan, user_id=job.user_id)
+    db.session.commit()
+    return {"group_id": group_id, "transfers": len(plan)}
+
+
+@jobs.task("rebuild_balances")
+def rebuild_balances_job(job, rescan=False):
+    rebuilt, drifted = rebuild_balances(rescan=rescan)
+    return {"rebuilt": rebuilt, "drifted": len(drifted)}
+
+
+@jobs.task("rebuild_rollups")
+def rebuild_rollups_job(job):
+    rebuilt, drifted = analytics.rebuild_rollups()
+    return {"rebuilt": rebuilt, "drifted": len(drifted)}
+
+
+def rebuild_balances(rescan=False):
+    """Recompute the balances table from each group's latest snapshot and
+    the events since (see eventlog.py), or with `rescan` from every
+    expense. Groups with nothing in the event log to replay are added up
+    from their expenses either way.
+
+    Returns the number of balances and ((group_id, user_id, currency),
+    stored, expected) for every one that had drifted.
+    """
+    if rescan:
+        expected = Balance.compute_all()
+    else:
+        expected = eventlog.current_balances()
+        unlogged = eventlog.unlogged_groups()
+        if unlogged:
+            expected.update(
+                (key, amount)
+                for key, amount in Balance.compute_all(unlogged).items()
+                if amount)
+    stored = {
+        (row.group_id, row.user_id, row.currency): row
+        for row in Balance.query.all()
+    }
+
+    drifted = []
+    for key in set(expected) | set(stored):
+        want = expected.get(key, 0)
+        row = stored.get(key)
+        have = row.amount if row else 0
+        if want != have:
+            drifted.append((key, have, want))
+        if row:
+            row.amount = want
+        elif want:
+            db.session.add(Balance(group_id=key[0], user_id=key[1],
+                                   currency=key[2], amount=want))
+
+    db.session.commit()
+    return len(expected), drifted
@@ -0,0 +1,74 @@
+"""Fixtures: the app on a scratch SQLite database, migrated to head.
+
+The database is shared by the whole run, so each test makes its own
+users and group with names nobody else uses.
+"""
+from itertools import count
+from types import SimpleNamespace
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# The app reads these when it is imported
+os.environ["DATABASE_URL"] = \
+    f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+os.environ["SECRET_KEY"] = "test-" + os.urandom(16).hex()
+
+_names = count(1)
+
+
+@pytest.fixture(scope="session")
+def app():
+    from flask_migrate import upgrade
+    from app import app
+
+    app.config["TESTING"] = True
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, "migrations"))
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def register(client, username):
+    client.post("/register", data={
+        "fullname": username.title(), "username": username,
+        "password": "secret", "confirmation": "secret"})
+    from models import User
+    return User.query.filter_by(username=username).one().id
+
+
+def login(client, username):
+    client.post("/login", data={"username": username, "password": "secret"})
+
+
+@pytest.fixture
+def group(app, client):
+    """A group of three members, logged in as the first"""
+    n = next(_names)
+    with app.app_context():
+        ids = [register(client, f"{name}{n}")
+               for name in ("ann", "ben", "cat")]
+        login(client, f"ann{n}")
+        client.post("/create_group", data={"group_name": f"Group {n}"})
+        from models import Group
+        group_id = Group.query.filter_by(name=f"Group {n}").one().id
+    client.post(f"/invite-friends/{group_id}", data={"user_ids": ids[1:]})
+    return SimpleNamespace(id=group_id, member_ids=ids)
+
+
+def add_expense(client, group, amount, shares, paid_by=None, **fields):
+    """POST the add-expense form; `shares` are one per member"""
+    data = {"description": "Dinner", "amount": amount,
+            "paid_by": paid_by or group.member_ids[0], **fields}
+    data.update({f"user_{user_id}": share
+                 for user_id, share in zip(group.member_ids, shares)})
+    return client.post(f"/group/{group.id}/add_expense", data=data)
@@ -0,0 +1,42 @@
+from flask import Flask
+
+from models import db
+import database
+
+
+def _app(**config):
+    app = Flask(__name__)
+    app.config.update(config)
+    database.configure(app, config["DATABASE_URL"])
+    db.init_app(app)
+    database.init_app(app)
+    return app
+
+
+def test_reads_run_on_the_replica(tmp_path):
+    app = _app(DATABASE_URL=f"sqlite:///{tmp_path / 'primary.db'}",
+               DATABASE_READ_URL=f"sqlite:///{tmp_path / 'replica.db'}")
+    with app.app_context():
+        with database.read_engine().begin() as connection:
+            connection.execute(db.text("CREATE TABLE only_here (x)"))
+            connection.execute(db.text("INSERT INTO only_here VALUES (1)"))
+
+        assert database.read_engine() is not db.engine
+        assert db.session.scalar(db.text("SELECT count(*) FROM only_here"),
+                                 bind_arguments=database.reads()) == 1
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def test_reads_default_to_the_primary(tmp_path):
+    app = _app(DATABASE_URL=f"sqlite:///{tmp_path / 'primary.db'}")
+    with app.app_context():
+        assert database.reads() == {"bind": db.engine}
+        db.engine.dispose()
+
+
+def test_server_databases_get_a_pool(app):
+    options = database.engine_options(app, "postgresql://localhost/splitr")
+    assert options["pool_pre_ping"]
+    assert options["pool_size"] == database.DEFAULTS["DB_POOL_SIZE"]
@@ -0,0 +1,91 @@
+from datetime import date, datetime, time, timedelta
+import random
+
+import pytest
+from flask_migrate import upgrade
+
+from benchmarks import seed
+from conftest import add_expense
+from models import db, Balance, BalanceSnapshot, ExpenseEvent
+import fx
+import tasks
+
+
+@pytest.fixture
+def seeded(tmp_path, monkeypatch):
+    """A small benchmark database, without the rollups (they need NumPy)"""
+    path = str(tmp_path / "seeded.db")
+    # DATABASE_URL, set for the app under test, would win over the path
+    monkeypatch.setenv("DATABASE_URL", f"sqlite:///{path}")
+    app = seed.make_app(path)
+    with app.app_context():
+        upgrade(directory=seed.MIGRATIONS)
+        seed.seed_users(50)
+        members = seed.seed_groups(random.Random(0), 50, 10, 20)
+        seed.seed_balances(
+            seed.seed_expenses(random.Random(0), members, 500))
+        db.session.commit()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+def _balances():
+    return {(row.group_id, row.user_id, row.currency): row.amount
+            for row in Balance.query}
+
+
+def test_rebuild_seeded_database(seeded):
+    before = _balances()
+    assert any(before.values())
+
+    rebuilt, drifted = tasks.rebuild_balances()
+    assert drifted == []
+    assert _balances() == before
+
+
+def test_rebuild_adds_up_groups_without_a_log(seeded):
+    # As seeded before seeding wrote snapshots
+    db.session.execute(db.delete(BalanceSnapshot))
+    db.session.commit()
+    before = _balances()
+
+    rebuilt, drifted = tasks.rebuild_balances()
+    assert drifted == []
+    assert _balances() == before
+
+
+def test_api_import_records_who_imported(app, client, group):
+    ann, ben, cat = group.member_ids
+    with app.app_context():
+        username = db.session.get(seed.User, ann).username
+    response = client.post("/api/v1/expenses", json={"expenses": [
+        {"group_id": group.id, "description": "Tickets", "amount": "30",
+         "paid_by": username}]})
+    assert response.status_code == 201
+
+    with app.app_context():
+        event = db.session.scalars(
+            db.select(ExpenseEvent).filter_by(group_id=group.id)).one()
+        assert event.user_id == ann
+
+
+def test_balances_as_of_a_day_without_rates(app, client, group):
+    add_expense(client, group, "30", ["10", "10", "10"])
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+    with app.app_context():
+        fx.import_rates([(1, {"date": today.isoformat(), "currency": "EUR",
+                              "rate": "0.9"})])
+        db.session.execute(
+            db.update(ExpenseEvent)
+            .where(ExpenseEvent.group_id == group.id)
+            .values(created_at=datetime.combine(yesterday, time(12))))
+        db.session.commit()
+    with client.session_transaction() as session:
+        session["currency"] = "EUR"
+
+    response = client.get(
+        f"/api/v1/groups/{group.id}/balances-as-of?date={yesterday}")
+    assert response.status_code == 404
+    assert "EUR" in response.get_json()["error"]
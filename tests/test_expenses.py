@@ -0,0 +1,77 @@
+import pytest
+
+from conftest import add_expense
+from models import db, Balance, Expense, User
+
+
+def _splits(expense_id):
+    expense = db.session.get(Expense, expense_id)
+    return dict(expense.split_amounts())
+
+
+def _balances(group_id):
+    return {row.user_id: row.amount
+            for row in Balance.query.filter_by(group_id=group_id)}
+
+
+def _edit(client, group, expense_id, amount, shares):
+    data = {"description": "Dinner", "amount": amount,
+            "paid_by": group.member_ids[0]}
+    data.update({f"user_{user_id}": share
+                 for user_id, share in zip(group.member_ids, shares)})
+    return client.post(
+        f"/group/{group.id}/edit_expense/{expense_id}", data=data)
+
+
+def _added(group):
+    return db.session.scalar(
+        db.select(Expense.id).filter_by(group_id=group.id)
+        .order_by(Expense.id.desc()).limit(1))
+
+
+def test_edit_blank_share_deletes_split(app, client, group):
+    add_expense(client, group, "30", ["10", "10", "10"])
+    ann, ben, cat = group.member_ids
+    with app.app_context():
+        expense_id = _added(group)
+
+    response = _edit(client, group, expense_id, "30", ["30", "", ""])
+    assert response.status_code == 302
+
+    with app.app_context():
+        assert _splits(expense_id) == {ann: 3000}
+        balances = _balances(group.id)
+        assert sum(balances.values()) == 0
+        assert balances.get(ben, 0) == balances.get(cat, 0) == 0
+
+
+def test_edit_rejects_splits_left_short(app, client, group):
+    add_expense(client, group, "30", ["10", "10", "10"])
+    ann, ben, cat = group.member_ids
+    with app.app_context():
+        expense_id = _added(group)
+
+    _edit(client, group, expense_id, "30", ["10", "", ""])
+
+    with app.app_context():
+        assert _splits(expense_id) == {ann: 1000, ben: 1000, cat: 1000}
+        assert sum(_balances(group.id).values()) == 0
+
+
+@pytest.mark.parametrize("amount", ["1e30", "1e20"])
+def test_huge_amounts_are_rejected(app, client, group, amount):
+    response = add_expense(client, group, amount, [amount, "0", "0"])
+    assert response.status_code == 302
+    with app.app_context():
+        assert _added(group) is None
+
+    with app.app_context():
+        username = db.session.get(User, group.member_ids[0]).username
+    response = client.post("/api/v1/expenses", json={"expenses": [
+        {"group_id": group.id, "description": "Yacht", "amount": amount,
+         "paid_by": username}]})
+    assert response.status_code == 400
+    assert response.get_json()["errors"][0]["index"] == 0
+
+    response = client.get(f"/api/v1/expenses/search?min_amount={amount}")
+    assert response.status_code == 400
@@ -0,0 +1,25 @@
+from conftest import add_expense
+
+
+def _view_in(client, code):
+    with client.session_transaction() as session:
+        session["currency"] = code
+
+
+def test_missing_rate_is_an_api_error(client, group):
+    add_expense(client, group, "30", ["10", "10", "10"])
+    _view_in(client, "CHF")
+
+    response = client.get("/api/v1/me/balances")
+    assert response.status_code == 404
+    assert "CHF" in response.get_json()["error"]
+
+
+def test_missing_rate_sends_pages_to_the_profile(client, group):
+    add_expense(client, group, "30", ["10", "10", "10"])
+    _view_in(client, "CHF")
+
+    response = client.get("/groups")
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/profile")
+    assert b"CHF" in client.get("/profile").data
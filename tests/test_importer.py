@@ -0,0 +1,112 @@
+import io
+from types import SimpleNamespace
+
+import exporter
+import importer
+from conftest import add_expense
+from models import db, Expense, ExpenseSplit, Group, GroupMember
+from models import MonthlySpend, User
+
+
+def _spend(group_id):
+    return {(row.month, row.user_id, row.currency):
+            [row.paid, row.paid_count, row.share]
+            for row in MonthlySpend.query.filter_by(group_id=group_id)}
+
+
+def _read(text):
+    return list(importer.read_json(io.StringIO(text)))
+
+
+def test_json_export_imports_back(app, client, group):
+    add_expense(client, group, "30", ["10", "10", "10"])
+    add_expense(client, group, "12.5", ["6.25", "6.25", ""],
+                paid_by=group.member_ids[1], description="Taxi")
+
+    with app.app_context():
+        exported = "".join(exporter.group_json(group.id))
+        result = importer.import_expenses(
+            db.session.get(Group, group.id),
+            importer.READERS["json"](io.StringIO(exported)))
+        assert result.errors == []
+        assert result.imported == 2
+        amounts = db.session.scalars(
+            db.select(Expense.amount).filter_by(group_id=group.id)
+            .order_by(Expense.amount)).all()
+        assert amounts == [1250, 1250, 3000, 3000]
+
+
+def test_json_array_reports_lines():
+    text = '[\n{"a": 1},\n{"b":\n 2}, {"c": 3}\n]\n'
+    assert _read(text) == [(2, {"a": 1}), (3, {"b": 2}), (4, {"c": 3})]
+    assert _read("[]") == []
+
+
+def test_json_array_stops_at_malformed_element():
+    assert _read('[\n{"a": 1},\n{"b": }\n]') == [(2, {"a": 1}), (3, None)]
+
+
+def test_json_lines_in_json_file():
+    assert _read('\n{"a": 1}\n{"b": 2}\n') == [(2, {"a": 1}), (3, {"b": 2})]
+
+
+def test_settlements_import_back_as_settlements(app, client, group):
+    add_expense(client, group, "30", ["10", "10", "10"])
+    with app.app_context():
+        trip = db.session.get(Group, group.id)
+        trip.record_settlement(trip.settlement_plan())
+        db.session.commit()
+        spend = _spend(group.id)
+
+        exported = "".join(exporter.group_csv(group.id))
+        result = importer.import_expenses(
+            db.session.get(Group, group.id),
+            importer.READERS["csv"](io.StringIO(exported)))
+        assert result.errors == []
+        kinds = db.session.scalars(
+            db.select(Expense.kind).filter_by(group_id=group.id)).all()
+        assert sorted(kinds) == ["expense"] * 2 + ["settlement"] * 4
+        # Only the expense is spending
+        assert _spend(group.id) == {
+            key: [2 * value for value in values]
+            for key, values in spend.items()}
+
+
+def test_unknown_kinds_are_rejected(app, group):
+    with app.app_context():
+        result = importer.import_expenses(
+            db.session.get(Group, group.id),
+            [(2, {"description": "Gift", "amount": "5", "paid_by": "x",
+                  "kind": "gift"})])
+        assert result.errors == [(2, "Unknown kind 'gift'.")]
+
+
+def test_csv_export_imports_back_odd_usernames(app, client, group):
+    with app.app_context():
+        odd = User(name="Dee", username="dee:x;y", password="-")
+        db.session.add(odd)
+        db.session.flush()
+        GroupMember.add_many(group.id, [odd.id])
+        db.session.commit()
+        members = SimpleNamespace(
+            id=group.id, member_ids=[*group.member_ids, odd.id])
+    add_expense(client, members, "30", ["10", "10", "0", "10"])
+
+    with app.app_context():
+        exported = "".join(exporter.group_csv(group.id))
+        result = importer.import_expenses(
+            db.session.get(Group, group.id),
+            importer.READERS["csv"](io.StringIO(exported)))
+        assert result.errors == []
+        shares = db.session.execute(
+            db.select(ExpenseSplit.user_id, ExpenseSplit.amount)
+            .join(Expense).filter(Expense.group_id == group.id)).all()
+        assert sorted(shares) == sorted(
+            [(user_id, 1000) for user_id in (*group.member_ids[:2], odd.id)]
+            * 2)
+
+
+def test_csv_reads_colon_separated_splits():
+    text = "description,amount,paid_by,splits\nTaxi,5,ann,ann:2;a:b:3\n"
+    [(line, record)] = importer.read_csv(io.StringIO(text))
+    assert record["splits"] == {"ann": "2", "a:b": "3"}
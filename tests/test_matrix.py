@@ -0,0 +1,45 @@
+from conftest import add_expense
+from matrix import BalanceMatrix
+
+
+def _debts(debts):
+    return {(d["from"], d["to"]): d["amount"] for d in debts}
+
+
+def test_circular_debts_only_cancelled_when_simplified():
+    # (creditor, debtor, currency, amount): 1 owes 2, 2 owes 3, 3 owes 1
+    rows = [(2, 1, "USD", 1000), (3, 2, "USD", 1000), (1, 3, "USD", 500)]
+    group_matrix = BalanceMatrix.from_rows(rows, {})
+
+    assert group_matrix.debts == {
+        (1, 2, "USD"): 1000, (2, 3, "USD"): 1000, (3, 1, "USD"): 500}
+    assert group_matrix.simplified().debts == {
+        (1, 2, "USD"): 500, (2, 3, "USD"): 500}
+
+
+def test_balances_api_reports_pairwise_debts(client, group):
+    ann, ben, cat = group.member_ids
+    add_expense(client, group, "10", ["0", "10", "0"], paid_by=ann)
+    add_expense(client, group, "10", ["0", "0", "10"], paid_by=ben)
+    add_expense(client, group, "5", ["5", "0", "0"], paid_by=cat)
+
+    body = client.get(f"/api/v1/groups/{group.id}/balances").get_json()
+    assert _debts(body["debts"]) == {
+        (ben, ann): 1000, (cat, ben): 1000, (ann, cat): 500}
+    assert _debts(body["simplified"]) == {(ben, ann): 500, (cat, ben): 500}
+
+
+def test_group_page_shows_pairwise_debts(client, group):
+    ann, ben, cat = group.member_ids
+    add_expense(client, group, "10", ["0", "10", "0"], paid_by=ann)
+    add_expense(client, group, "10", ["0", "0", "10"], paid_by=ben)
+    add_expense(client, group, "5", ["5", "0", "0"], paid_by=cat)
+
+    page = client.get(f"/group/{group.id}").get_data(as_text=True)
+    sections = page.split("</details>")[:2]
+    who_owes_whom, fewest_payments = sections
+    assert "Fewest payments" in fewest_payments
+    # What each pair owes, as on the friend pages
+    assert "$10.00" in who_owes_whom
+    assert "$5.00" in who_owes_whom
+    assert "$10.00" not in fewest_payments
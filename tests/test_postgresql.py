@@ -0,0 +1,91 @@
+"""The PostgreSQL paths, against the server in TEST_POSTGRESQL_URL.
+
+Skipped unless it is set and the server answers. Point it at a scratch
+database: its public schema is dropped and migrated from scratch.
+
+    TEST_POSTGRESQL_URL=postgresql://localhost/splitr_test pytest tests
+"""
+import os
+
+import pytest
+from flask import Flask
+from flask_migrate import Migrate, upgrade
+from sqlalchemy.exc import OperationalError
+
+from models import db, Expense, Group, GroupMember, User
+import database
+import search
+
+URL = os.environ.get("TEST_POSTGRESQL_URL")
+MIGRATIONS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "migrations")
+
+pytestmark = pytest.mark.skipif(
+    not URL, reason="TEST_POSTGRESQL_URL is not set")
+
+
+@pytest.fixture(scope="module")
+def pg_app():
+    app = Flask(__name__)
+    app.config.update(DATABASE_URL=URL, DATABASE_READ_URL=URL)
+    database.configure(app, URL)
+    try:
+        db.init_app(app)
+    except ImportError as error:
+        pytest.skip(f"No PostgreSQL driver: {error}")
+    database.init_app(app)
+    Migrate(app, db, directory=MIGRATIONS)
+    with app.app_context():
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(db.text("DROP SCHEMA public CASCADE"))
+                connection.execute(db.text("CREATE SCHEMA public"))
+        except OperationalError as error:
+            pytest.skip(f"No PostgreSQL server: {error}")
+        upgrade(directory=MIGRATIONS)
+        yield app
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def ledger(pg_app):
+    user = User(name="Pat", username="pat", password="-")
+    group = Group(name="Trip")
+    db.session.add_all([user, group])
+    db.session.flush()
+    db.session.add(GroupMember(user_id=user.id, group_id=group.id))
+    db.session.add(Expense(
+        description="Museum tickets", amount=2000, currency="USD",
+        paid_by_id=user.id, group_id=group.id, kind=Expense.EXPENSE))
+    db.session.commit()
+    return user, group
+
+
+def test_engines_are_pooled(pg_app):
+    assert db.engine.pool.size() == database.DEFAULTS["DB_POOL_SIZE"]
+    assert database.read_engine().pool._pre_ping
+
+
+def test_search_uses_the_full_text_index(pg_app, ledger):
+    user, _ = ledger
+    expenses, more = search.search_expenses(user.id, "muse")
+    assert [expense.description for expense in expenses] == [
+        "Museum tickets"]
+    assert not more
+
+
+def test_lock_timeouts_are_retryable(pg_app, ledger):
+    _, group = ledger
+    with db.engine.connect() as holder:
+        holder.execute(db.text(
+            "SELECT 1 FROM groups WHERE id = :id FOR UPDATE"),
+            {"id": group.id})
+        db.session.execute(db.text("SET LOCAL lock_timeout = '100ms'"))
+        with pytest.raises(OperationalError) as error:
+            Group.bump_version(group.id)
+        db.session.rollback()
+        holder.rollback()
+    assert database.is_lock_timeout(error.value)
@@ -0,0 +1,12 @@
+import queryplan
+
+
+def test_every_page_query_uses_an_index(app, group):
+    with app.app_context():
+        assert queryplan.check(app) == []
+
+
+def test_small_tables_can_still_be_checked(app, group):
+    with app.app_context():
+        assert queryplan.small_tables(0) == set()
+        assert "users" in queryplan.small_tables(queryplan.MIN_ROWS)
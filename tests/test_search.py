@@ -0,0 +1,36 @@
+from conftest import add_expense
+import search
+
+
+def _descriptions(app, group, text):
+    with app.app_context():
+        expenses, _ = search.search_expenses(group.member_ids[0], text)
+        return [expense.description for expense in expenses]
+
+
+def test_search_matches_word_prefixes(app, client, group):
+    add_expense(client, group, "30", ["10", "10", "10"],
+                description="Museum tickets")
+    add_expense(client, group, "9", ["3", "3", "3"],
+                description="Lunch near the museum")
+
+    assert sorted(_descriptions(app, group, "muse")) == [
+        "Lunch near the museum", "Museum tickets"]
+    assert _descriptions(app, group, "museum lunch") == [
+        "Lunch near the museum"]
+
+
+def test_other_databases_search_with_like(app, client, group, monkeypatch):
+    # As on a database without a full-text matcher
+    monkeypatch.delitem(search.MATCHERS, "sqlite")
+    add_expense(client, group, "30", ["10", "10", "10"],
+                description="Museum tickets")
+    add_expense(client, group, "9", ["3", "3", "3"],
+                description="Lunch near the museum")
+    add_expense(client, group, "6", ["2", "2", "2"],
+                description="100% juice")
+
+    assert _descriptions(app, group, "MUSE") == [
+        "Lunch near the museum", "Museum tickets"]
+    assert _descriptions(app, group, "ticket museum") == ["Museum tickets"]
+    assert _descriptions(app, group, "100") == ["100% juice"]
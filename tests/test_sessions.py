@@ -0,0 +1,45 @@
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+import pytest
+
+import sessions
+from conftest import login, register
+
+
+def _forged_cookie(key, data):
+    forger = Flask("forger")
+    forger.secret_key = key
+    return SecureCookieSessionInterface().get_signing_serializer(
+        forger).dumps(data)
+
+
+@pytest.mark.parametrize("key", [None, "", "your_secret_key"])
+def test_cookie_backend_needs_a_real_key(key):
+    app = Flask("sessions")
+    app.config["SESSION_BACKEND"] = "cookie"
+    app.secret_key = key
+    with pytest.raises(ValueError):
+        sessions.init_app(app)
+
+
+def test_server_side_backend_needs_no_key():
+    app = Flask("sessions")
+    app.config["SESSION_BACKEND"] = "sql"
+    app.config["SESSION_SWEEP_INTERVAL"] = 0
+    sessions.init_app(app)
+    assert isinstance(app.session_interface, sessions.SqlSessionInterface)
+
+
+def test_cookie_signed_with_placeholder_is_rejected(app, client):
+    with app.app_context():
+        user_id = register(client, "mallory")
+    client.set_cookie(app.config["SESSION_COOKIE_NAME"],
+                      _forged_cookie("your_secret_key", {"user_id": user_id}))
+    assert client.get("/api/v1/me/balances").status_code == 401
+
+
+def test_login_cookie_is_accepted(app, client):
+    with app.app_context():
+        register(client, "trent")
+    login(client, "trent")
+    assert client.get("/api/v1/me/balances").status_code == 200